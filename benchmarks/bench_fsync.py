@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""Measure the cost of the durability modes of LocalBackend
+
+Usage:
+
+    python benchmarks/bench_fsync.py --dir /path/on/backup/disk --files 2000
+
+Objects are added from memory to a new repository in --dir for every
+configuration, followed by the flush that precedes a manifest commit. The
+results depend a lot on the filesystem and disk, so run this on the disk
+that holds the repository.
+"""
+import argparse
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from hashedbackup.backends.local import LocalBackend
+from hashedbackup.cmd_init import init_repo
+
+BATCH_SIZES = [16, 64, 256, 1024]
+
+
+def configurations():
+    yield 'none', None
+    for batch in BATCH_SIZES:
+        yield 'batch', batch
+    yield 'file', None
+
+
+def run_one(base_dir, durability, batch, objects):
+    repo = tempfile.mkdtemp(prefix='bench-fsync-', dir=base_dir)
+    try:
+        options = argparse.Namespace(
+            durability=durability, fsync_batch=batch, compress=False,
+            symlink=False, hardlink=False)
+        backend = LocalBackend(repo, options)
+        init_repo(backend)
+        t0 = time.perf_counter()
+        for fhash, data in objects:
+            backend.add_object_data(fhash, data)
+        backend.flush()
+        return time.perf_counter() - t0
+    finally:
+        shutil.rmtree(repo)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--dir', default=tempfile.gettempdir(),
+                        help='directory on the disk to test')
+    parser.add_argument('--files', type=int, default=2000,
+                        help='number of objects (default: 2000)')
+    parser.add_argument('--size', type=int, default=16,
+                        help='object size in KB (default: 16)')
+    args = parser.parse_args()
+
+    objects = []
+    for _ in range(args.files):
+        data = os.urandom(args.size * 1024)
+        objects.append((hashlib.md5(data).hexdigest(), data))
+    total_mb = args.files * args.size / 1024
+
+    print('{:,} objects of {} KB in {}'.format(
+        args.files, args.size, args.dir))
+    print('{:12} {:>6} {:>9} {:>10} {:>9}'.format(
+        'durability', 'batch', 'seconds', 'objects/s', 'overhead'))
+    baseline = None
+    for durability, batch in configurations():
+        elapsed = run_one(args.dir, durability, batch, objects)
+        if baseline is None:
+            baseline = elapsed
+        print('{:12} {:>6} {:9.2f} {:10,.0f} {:8.1f}x'.format(
+            durability, batch or '-', elapsed, args.files / elapsed,
+            elapsed / baseline))
+    print('({:.1f} MB per run)'.format(total_mb))
+
+
+if __name__ == '__main__':
+    main()
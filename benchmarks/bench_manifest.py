@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""Compare manifest versions: encode and decode time and size
+
+Usage:
+
+    python benchmarks/bench_manifest.py --files 300000
+
+Records are generated for a synthetic tree with realistic path lengths, or
+taken from an existing directory with --src. Times include bz2 compression,
+which is part of writing a manifest.
+"""
+import argparse
+import bz2
+import hashlib
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from hashedbackup.manifest_v1 import MAGIC, CompactDecoder
+from hashedbackup.manifests import get_encoder
+from hashedbackup.utils import MB
+
+
+def stat_record(i):
+    return dict(mode=644, uid=1000, gid=1000, user='user', group='staff',
+                mtime=1500000000 + i, mtime_ns=123456789 * (i % 7))
+
+
+def synthetic_records(n_files):
+    rnd = random.Random(42)
+    words = ['photos', 'IMG_{:04}', 'projects', 'src', 'hashedbackup',
+             'documents', 'invoices', '2017', 'music', 'album_{:03}']
+    n = 0
+    while n < n_files:
+        depth = rnd.randint(1, 5)
+        dirname = '/'.join(rnd.choice(words).format(rnd.randint(0, 999))
+                           for _ in range(depth))
+        yield dict(path=dirname, type='d', stat=stat_record(n))
+        for j in range(rnd.randint(1, 50)):
+            path = '{}/file-{:05}.jpg'.format(dirname, j)
+            yield dict(path=path, type='f', size=rnd.randint(0, 10 * MB),
+                       hash=hashlib.md5(path.encode()).hexdigest(),
+                       stat=stat_record(n))
+            n += 1
+
+
+def tree_records(src):
+    from hashedbackup.fileinfo import FileInfo
+    for dirpath, dirnames, filenames in os.walk(src):
+        dirnames.sort()
+        for name in sorted(filenames):
+            fpath = os.path.join(dirpath, name)
+            if not os.path.isfile(fpath):
+                continue
+            info = FileInfo(fpath)
+            yield dict(path=os.path.relpath(fpath, src), type='f',
+                       size=info.size,
+                       hash=hashlib.md5(fpath.encode()).hexdigest(),
+                       stat=info.stat_dict)
+
+
+def encode(version, records):
+    encoder = get_encoder(version)
+    compressor = bz2.BZ2Compressor(9)
+    t0 = time.time()
+    raw = [encoder.start()]
+    raw.extend(encoder.encode(r) for r in records)
+    t1 = time.time()
+    data = compressor.compress(b''.join(raw)) + compressor.flush()
+    t2 = time.time()
+    return data, sum(map(len, raw)), t1 - t0, t2 - t1
+
+
+def decode(data):
+    import json
+    raw = bz2.decompress(data)
+    t0 = time.time()
+    if raw.startswith(MAGIC):
+        n = sum(1 for _ in CompactDecoder([raw[len(MAGIC):]]))
+    else:
+        n = sum(1 for line in raw.split(b'\n') if line and json.loads(line))
+    return n, time.time() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--files', type=int, default=300000,
+                        help='number of synthetic files (default: 300000)')
+    parser.add_argument('--src', help='use the files in this directory')
+    args = parser.parse_args()
+
+    if args.src:
+        records = list(tree_records(args.src))
+    else:
+        records = list(synthetic_records(args.files))
+    print('{:,} records'.format(len(records)))
+    print('{:8} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+        'version', 'raw MB', 'bz2 MB', 'encode s', 'bz2 s', 'decode s'))
+    for version in (0, 1):
+        data, raw_size, t_encode, t_compress = encode(version, records)
+        n, t_decode = decode(data)
+        assert n == len(records)
+        print('{:8} {:10.2f} {:10.2f} {:10.2f} {:10.2f} {:10.2f}'.format(
+            version, raw_size / MB, len(data) / MB, t_encode, t_compress,
+            t_decode))
+
+
+if __name__ == '__main__':
+    main()
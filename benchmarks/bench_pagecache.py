@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""Measure how hashing a tree affects the page cache of other applications
+
+Usage:
+
+    python benchmarks/bench_pagecache.py --dir /path/on/source/disk \\
+        --data 4096 --working-set 256
+
+An application is simulated by a thread that reads random pages of a
+--working-set MB file, which is fully cached when the run starts. For every
+read it checks with mincore() whether the page was still cached, which gives
+its cache hit rate while the main thread hashes --data MB of files with each
+--source-cache mode. After the run, the table also shows how much of the
+hashed data stayed in the page cache, where it competes with applications.
+
+The hit rate of the reader only drops when the kernel needs to evict pages,
+so use more data than the free memory, or run in a memory limited cgroup:
+
+    systemd-run --user --scope -p MemoryMax=1G python benchmarks/...
+
+Linux only. O_DIRECT does not work on tmpfs, so use a directory on a disk.
+"""
+import argparse
+import ctypes
+import ctypes.util
+import mmap
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from hashedbackup import sourceio
+from hashedbackup.fileinfo import FileInfo
+from hashedbackup.utils import MB
+
+PAGE = mmap.PAGESIZE
+FILE_SIZE = 64 * MB
+
+libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+libc.mmap.restype = ctypes.c_void_p
+libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int,
+                      ctypes.c_int, ctypes.c_int, ctypes.c_long]
+libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_char_p]
+
+
+class Residency:
+    """Page cache residency of a file through mincore()"""
+
+    def __init__(self, path):
+        self.size = os.path.getsize(path)
+        self.pages = (self.size + PAGE - 1) // PAGE
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            self.addr = libc.mmap(None, self.size, mmap.PROT_READ,
+                                  mmap.MAP_SHARED, fd, 0)
+        finally:
+            os.close(fd)
+        if self.addr in (None, ctypes.c_void_p(-1).value):
+            raise OSError(ctypes.get_errno(), 'mmap failed')
+        self.vec = ctypes.create_string_buffer(self.pages)
+
+    def _check(self, addr, length):
+        if libc.mincore(addr, length, self.vec) != 0:
+            raise OSError(ctypes.get_errno(), 'mincore failed')
+
+    def is_cached(self, page):
+        self._check(self.addr + page * PAGE, PAGE)
+        return self.vec.raw[0] & 1
+
+    def cached_pages(self):
+        self._check(self.addr, self.size)
+        return sum(b & 1 for b in self.vec.raw[:self.pages])
+
+    def close(self):
+        libc.munmap(self.addr, self.size)
+
+
+def drop_from_cache(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def read_all(path):
+    with open(path, 'rb') as f:
+        while f.read(MB):
+            pass
+
+
+def write_file(path, size):
+    with open(path, 'wb') as f:
+        for _ in range(size // MB):
+            f.write(os.urandom(MB))
+
+
+class Reader(threading.Thread):
+    """Reads random pages of the working set, counting cache hits"""
+
+    def __init__(self, path):
+        super().__init__(daemon=True)
+        self.path = path
+        self.residency = Residency(path)
+        self.hits = 0
+        self.reads = 0
+        self.read_time = 0.0
+        self.stopping = threading.Event()
+
+    def run(self):
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            while not self.stopping.is_set():
+                page = random.randrange(self.residency.pages)
+                self.hits += self.residency.is_cached(page)
+                t0 = time.perf_counter()
+                os.pread(fd, PAGE, page * PAGE)
+                self.read_time += time.perf_counter() - t0
+                self.reads += 1
+        finally:
+            os.close(fd)
+
+    def stop(self):
+        self.stopping.set()
+        self.join()
+        self.residency.close()
+
+
+def run_one(mode, working_set, paths):
+    for path in paths:
+        drop_from_cache(path)
+    read_all(working_set)
+
+    sourceio.configure(mode)
+    reader = Reader(working_set)
+    reader.start()
+    t0 = time.perf_counter()
+    for path in paths:
+        # Bypass the xattr cache, always read the data
+        FileInfo(path)._calc_filehash()
+    elapsed = time.perf_counter() - t0
+    reader.stop()
+
+    cached = total = 0
+    for path in paths:
+        residency = Residency(path)
+        cached += residency.cached_pages()
+        total += residency.pages
+        residency.close()
+    return elapsed, reader, cached / total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--dir', default=tempfile.gettempdir(),
+                        help='directory on the disk to test')
+    parser.add_argument('--data', type=int, default=1024,
+                        help='MB of files to hash (default: 1024)')
+    parser.add_argument('--working-set', type=int, default=256,
+                        help='MB read by the simulated application '
+                             '(default: 256)')
+    parser.add_argument('--modes', nargs='+',
+                        default=list(sourceio.SOURCE_CACHE_MODES),
+                        choices=sourceio.SOURCE_CACHE_MODES,
+                        help='modes to compare (default: all)')
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='bench-pagecache-', dir=args.dir)
+    try:
+        working_set = os.path.join(tmp, 'working-set')
+        write_file(working_set, args.working_set * MB)
+        paths = []
+        for i in range(max(1, args.data * MB // FILE_SIZE)):
+            path = os.path.join(tmp, 'data-{}'.format(i))
+            write_file(path, min(FILE_SIZE, args.data * MB))
+            paths.append(path)
+
+        print('Hashing {} MB in {} with a {} MB working set'.format(
+            args.data, args.dir, args.working_set))
+        print('{:8} {:>9} {:>8} {:>10} {:>12} {:>12}'.format(
+            'mode', 'seconds', 'MB/s', 'hit rate', 'read us', 'data cached'))
+        for mode in args.modes:
+            elapsed, reader, data_cached = run_one(mode, working_set, paths)
+            print('{:8} {:9.2f} {:8.0f} {:9.2f}% {:12.1f} {:11.1f}%'.format(
+                mode, elapsed, args.data / elapsed,
+                100 * reader.hits / max(1, reader.reads),
+                1e6 * reader.read_time / max(1, reader.reads),
+                100 * data_cached))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""Measure SFTP upload throughput of one large file over several streams
+
+Usage:
+
+    python benchmarks/bench_sftp_large_file.py localhost:/tmp --size 512
+
+The destination directory must exist and be writable. For every number of
+streams a temporary file is uploaded with RangeUpload, the way SFTPBackend
+uploads large files without the remote helper, and then removed again. With
+one stream, the file is written over the bulk transport only.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from hashedbackup.backends.sftp import SFTPBackend, RangeUpload
+from hashedbackup.utils import MB, temp_filename
+
+
+def run_one(dst, args, src_path, streams):
+    options = argparse.Namespace(
+        compress=False, ssh_ciphers=args.cipher, ssh_compression='none')
+    backend = SFTPBackend(dst, options=options)
+    path = os.path.join(backend.path, 'hashedbackup-bench-' + temp_filename())
+    # Connect all streams before timing
+    for i in range(streams):
+        backend._stream_client(i)
+    with open(src_path, 'rb') as src:
+        t0 = time.time()
+        with backend._open_bulk(path, 'wb'):
+            pass
+        RangeUpload(backend, path, streams).run(src)
+        elapsed = time.time() - t0
+    backend.sftp.unlink(path)
+    for client in [backend.client, backend.bulk_client] + \
+            backend._stream_clients:
+        client.close()
+    return os.path.getsize(src_path) / elapsed / MB
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('dst', help='remote directory, like host:/tmp')
+    parser.add_argument('--size', type=int, default=256,
+                        help='file size in MB (default: 256)')
+    parser.add_argument('--streams', type=int, nargs='+', default=[1, 2, 4],
+                        help='numbers of streams to compare')
+    parser.add_argument('--cipher', default=None,
+                        help='SSH cipher (default: negotiated)')
+    args = parser.parse_args()
+
+    with tempfile.NamedTemporaryFile() as f:
+        for _ in range(args.size):
+            f.write(os.urandom(MB))
+        f.flush()
+        print('{:>8} {:>10}'.format('streams', 'MB/s'))
+        for streams in args.streams:
+            speed = run_one(args.dst, args, f.name, streams)
+            print('{:8} {:10,.1f}'.format(streams, speed))
+
+
+if __name__ == '__main__':
+    main()
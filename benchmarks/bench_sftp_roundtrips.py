@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""Measure backups to SFTP over emulated links, in time and round trips
+
+Usage:
+
+    python benchmarks/bench_sftp_roundtrips.py --files 200 --size 64 \\
+        --rtt 0 20 100 --bandwidth 10
+
+Runs an initial and an unchanged backup of a generated tree to the
+in-process server of sftpserver.py, with and without the remote helper, for
+every round trip time. The SFTP requests that the server received are
+counted, which catches changes that add round trips per file:
+
+    python benchmarks/bench_sftp_roundtrips.py --max-requests-per-file 10
+
+exits with an error if any run needed more SFTP requests per file.
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from sftpserver import ROOT, SERVE_RUNNER, SFTPTestServer
+from hashedbackup.utils import MB
+
+
+def make_tree(path, files, size):
+    for i in range(files):
+        subdir = os.path.join(path, 'dir{:03}'.format(i // 50))
+        os.makedirs(subdir, exist_ok=True)
+        with open(os.path.join(subdir, 'file{:05}'.format(i)), 'wb') as f:
+            f.write(os.urandom(size))
+
+
+def hashedbackup(server, *args):
+    subprocess.run(
+        [sys.executable, '-c', SERVE_RUNNER, '--no-progress',
+         '--ssh-config', server.ssh_config] + list(args),
+        cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        check=True)
+
+
+def run_one(server, src, repo, extra):
+    server.stats.reset()
+    t0 = time.perf_counter()
+    hashedbackup(server, 'backup', src, '{}:{}'.format(server.alias, repo),
+                 '-n', 'bench', *extra)
+    elapsed = time.perf_counter() - t0
+    stats = server.stats.snapshot()
+    requests = sum(n for name, n in stats.items()
+                   if name not in ('connections', 'exec'))
+    return elapsed, requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--dir', default=tempfile.gettempdir(),
+                        help='directory for the tree and the repositories')
+    parser.add_argument('--files', type=int, default=200,
+                        help='number of files (default: 200)')
+    parser.add_argument('--size', type=int, default=64,
+                        help='file size in KB (default: 64)')
+    parser.add_argument('--rtt', type=float, nargs='+', default=[0, 20, 100],
+                        help='round trip times in ms (default: 0 20 100)')
+    parser.add_argument('--bandwidth', type=float,
+                        help='bandwidth in MB/s (default: no limit)')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='backup --jobs (default: 1)')
+    parser.add_argument('--max-requests-per-file', type=float,
+                        help='fail if a run needs more SFTP requests per '
+                             'file')
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='bench-sftp-', dir=args.dir)
+    failed = False
+    try:
+        src = os.path.join(tmp, 'src')
+        make_tree(src, args.files, args.size * 1024)
+        root = os.path.join(tmp, 'root')
+        os.mkdir(root)
+        total_mb = args.files * args.size / 1024
+
+        print('{} files of {} KB, bandwidth {}'.format(
+            args.files, args.size,
+            '{} MB/s'.format(args.bandwidth) if args.bandwidth
+            else 'unlimited'))
+        print('{:>7} {:7} {:12} {:>8} {:>8} {:>9} {:>9}'.format(
+            'rtt ms', 'helper', 'backup', 'seconds', 'MB/s', 'requests',
+            'per file'))
+        for rtt in args.rtt:
+            for helper in (True, False):
+                server = SFTPTestServer(
+                    root, rtt=rtt / 1000, allow_exec=helper,
+                    bandwidth=int(args.bandwidth * MB) if args.bandwidth
+                    else None)
+                repo = 'repo-{}-{}'.format(rtt, helper)
+                with server:
+                    hashedbackup(server, 'init',
+                                 '{}:{}'.format(server.alias, repo))
+                    for kind in ('initial', 'unchanged'):
+                        elapsed, requests = run_one(
+                            server, src, repo, ['--jobs', str(args.jobs)])
+                        per_file = requests / args.files
+                        speed = '{:.1f}'.format(total_mb / elapsed) \
+                            if kind == 'initial' else '-'
+                        print('{:7g} {:7} {:12} {:8.2f} {:>8} {:9} '
+                              '{:9.2f}'.format(
+                                  rtt, 'yes' if helper else 'no', kind,
+                                  elapsed, speed, requests, per_file))
+                        if args.max_requests_per_file is not None and \
+                                per_file > args.max_requests_per_file:
+                            failed = True
+    finally:
+        shutil.rmtree(tmp)
+    if failed:
+        sys.exit('More than {} SFTP requests per file'.format(
+            args.max_requests_per_file))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""Measure SFTP upload throughput for different SSH transport settings
+
+Usage:
+
+    python benchmarks/bench_sftp_transport.py localhost:/tmp --size 256
+
+The destination directory must exist and be writable. For every
+configuration a temporary file is uploaded over the bulk transport of a new
+SFTPBackend and then removed again.
+"""
+import argparse
+import itertools
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from hashedbackup.backends.sftp import SFTPBackend
+from hashedbackup.utils import MB, temp_filename
+
+CIPHERS = [
+    'aes128-ctr',
+    'aes256-ctr',
+    'aes128-gcm@openssh.com',
+    'aes256-gcm@openssh.com',
+    'chacha20-poly1305@openssh.com',
+]
+WINDOW_SIZES = [None, 2147483647]
+PACKET_SIZES = [None, 256 * 1024]
+
+
+def make_data(kind, size):
+    if kind == 'random':
+        return os.urandom(size)
+    line = b'The quick brown fox jumps over the lazy dog 0123456789\n'
+    return (line * (size // len(line) + 1))[:size]
+
+
+def configurations(args):
+    for cipher, compression in itertools.product(
+            args.ciphers, ['none', 'bulk']):
+        yield dict(ssh_ciphers=cipher, ssh_compression=compression)
+    for window_size, packet_size in itertools.product(
+            WINDOW_SIZES, PACKET_SIZES):
+        yield dict(ssh_ciphers=args.ciphers[0], ssh_compression='none',
+                   ssh_window_size=window_size, ssh_packet_size=packet_size)
+
+
+def run_one(dst, settings, data, chunk_size):
+    options = argparse.Namespace(compress=False, **settings)
+    backend = SFTPBackend(dst, options=options)
+    sftp = backend.bulk_sftp
+    path = os.path.join(backend.path, 'hashedbackup-bench-' + temp_filename())
+    view = memoryview(data)
+    t0 = time.time()
+    with sftp.open(path, 'wb') as f:
+        f.set_pipelined(True)
+        for offset in range(0, len(data), chunk_size):
+            f.write(view[offset:offset + chunk_size])
+    elapsed = time.time() - t0
+    sftp.unlink(path)
+    transport = sftp.get_channel().get_transport()
+    cipher = transport.local_cipher
+    backend.client.close()
+    backend.bulk_client.close()
+    return cipher, len(data) / elapsed / MB
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('dst', help='remote directory, like host:/tmp')
+    parser.add_argument('--size', type=int, default=128,
+                        help='upload size in MB (default: 128)')
+    parser.add_argument('--data', choices=['random', 'text'],
+                        default='random', help='kind of data to upload')
+    parser.add_argument('--ciphers', type=lambda s: s.split(','),
+                        default=CIPHERS, help='comma separated ciphers')
+    args = parser.parse_args()
+
+    data = make_data(args.data, args.size * MB)
+    print('{:32} {:>7} {:>11} {:>8} {:>10}'.format(
+        'cipher', 'compr.', 'window', 'packet', 'MB/s'))
+    for settings in configurations(args):
+        try:
+            cipher, speed = run_one(args.dst, settings, data, MB)
+        except Exception as e:
+            print('{:32} failed: {}'.format(settings['ssh_ciphers'], e))
+            continue
+        print('{:32} {:>7} {:>11} {:>8} {:10,.1f}'.format(
+            cipher, settings['ssh_compression'],
+            settings.get('ssh_window_size') or 'default',
+            settings.get('ssh_packet_size') or 'default',
+            speed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""Measure CLI startup time for commands that exit quickly
+
+Usage:
+
+    python benchmarks/bench_startup.py --runs 20
+
+Every scenario runs the CLI in a new interpreter, like a cron job would.
+A temporary local repository with one backup is used, so the backup with
+--if-older-than is skipped. The heavy modules that each command loaded are
+listed to spot imports that are not needed.
+
+Before timing, the benchmark checks that parsing the command line does not
+import any of the PARSE_FREE_MODULES, and exits with an error if it does.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+HEAVY_MODULES = ['paramiko', 'cryptography', 'asyncio', 'progressbar',
+                 'tabulate', 'colorlog', 'xattr']
+
+# Modules that only commands need, not the argument parser
+PARSE_FREE_MODULES = [
+    'hashedbackup.manifests', 'hashedbackup.manifest_v1',
+    'hashedbackup.tracing', 'hashedbackup.backends.base',
+    'hashedbackup.hashindex', 'hashedbackup.compression',
+    'hashedbackup.sparse', 'hashedbackup.messages', 'hashedbackup.sourceio',
+]
+
+PARSE_RUNNER = """
+import sys
+from hashedbackup.cli import parser
+parser.parse_args(sys.argv[1:])
+print(','.join(m for m in {modules!r} if m in sys.modules))
+""".format(modules=PARSE_FREE_MODULES)
+
+RUNNER = """
+import atexit, sys
+atexit.register(lambda: print('MODULES ' + ','.join(
+    m for m in {heavy!r} if m in sys.modules), file=sys.stderr))
+from hashedbackup.cli import main
+main()
+""".format(heavy=HEAVY_MODULES)
+
+
+def run_cli(args):
+    t0 = time.perf_counter()
+    p = subprocess.run(
+        [sys.executable, '-c', RUNNER] + args, cwd=ROOT,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+    elapsed = time.perf_counter() - t0
+    modules = ''
+    for line in p.stderr.decode().splitlines():
+        if line.startswith('MODULES '):
+            modules = line[len('MODULES '):]
+    return elapsed, modules
+
+
+def check_parse_imports(cli_args):
+    """
+    :return: comma separated PARSE_FREE_MODULES that parsing imported
+    """
+    p = subprocess.run(
+        [sys.executable, '-c', PARSE_RUNNER] + cli_args, cwd=ROOT,
+        stdout=subprocess.PIPE, check=True)
+    return p.stdout.decode().strip()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=10,
+                        help='runs per scenario (default: 10)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        src = os.path.join(tmp, 'src')
+        repo = os.path.join(tmp, 'repo')
+        os.mkdir(src)
+        with open(os.path.join(src, 'file.txt'), 'w') as f:
+            f.write('hello\n')
+        run_cli(['init', repo])
+        run_cli(['backup', src, repo, '-n', 'bench'])
+
+        scenarios = [
+            ('no command', []),
+            ('list-manifests', ['list-manifests', repo]),
+            ('backup --if-older-than (skipped)',
+             ['backup', src, repo, '-n', 'bench', '--if-older-than', '1d']),
+            ('backup -j 4 (nothing new)',
+             ['backup', src, repo, '-n', 'bench', '-j', '4']),
+        ]
+        for name, cli_args in scenarios:
+            loaded = check_parse_imports(cli_args)
+            if loaded:
+                sys.exit('Parsing the arguments of {} imported: {}'.format(
+                    name, loaded))
+
+        print('{:36} {:>9} {:>9}  {}'.format(
+            'scenario', 'median ms', 'min ms', 'heavy modules loaded'))
+        for name, cli_args in scenarios:
+            times = []
+            for _ in range(args.runs):
+                elapsed, modules = run_cli(cli_args)
+                times.append(elapsed * 1000)
+            print('{:36} {:9.1f} {:9.1f}  {}'.format(
+                name, statistics.median(times), min(times), modules or '-'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,538 @@
+#!/usr/bin/env python3
+"""In-process SSH/SFTP server with an emulated network link
+
+Serves a local directory over SFTP with paramiko, for measuring SFTPBackend
+on a single machine. The link between client and server can get a round
+trip time and a bandwidth cap, and `hashedbackup serve` can be allowed or
+denied, to compare the remote helper with plain SFTP.
+
+Use it from Python:
+
+    with SFTPTestServer(root, rtt=0.05, bandwidth=10 * MB) as server:
+        # server.ssh_config has a `testsrv` host with a generated key
+        subprocess.run(['hashedbackup', '--ssh-config', server.ssh_config,
+                        'init', 'testsrv:repo'])
+        print(server.stats.snapshot())
+
+or run it until interrupted:
+
+    python benchmarks/sftpserver.py /tmp/sftproot --port 2222 --rtt 50
+
+Paths are relative to the served directory, with `/` as the directory
+itself. server.stats counts the SFTP requests by type, which is the number
+of round trips for most of them, and the exec requests.
+"""
+import argparse
+import collections
+import functools
+import os
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import paramiko
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+from hashedbackup.utils import MB
+
+# Command line of `hashedbackup serve` on the emulated server
+SERVE_RUNNER = 'from hashedbackup.cli import main; main()'
+RECV_SIZE = 65536
+
+
+class Stats:
+    """Thread safe counters"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = collections.Counter()
+
+    def add(self, name, n=1):
+        with self._lock:
+            self.counts[name] += n
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counts)
+
+    def reset(self):
+        with self._lock:
+            self.counts.clear()
+
+
+class _LinkDirection:
+    """One direction of an emulated link
+
+    Data is delayed by the one way latency and leaves at most at the
+    bandwidth. Like a real link, it only buffers about its bandwidth-delay
+    product, so senders feel back pressure.
+    """
+
+    def __init__(self, src, dst, delay, bandwidth, done):
+        self.src = src
+        self.dst = dst
+        self.delay = delay
+        self.bandwidth = bandwidth
+        self.buffer_size = int(bandwidth * delay) + MB if bandwidth \
+            else 16 * MB
+        self.done = done
+        self.queue = collections.deque()
+        self.queued = 0
+        self.eof = False
+        # When the link has sent everything that is queued
+        self.link_free = 0.0
+        self.cond = threading.Condition()
+        for target in (self._read, self._write):
+            threading.Thread(target=target, daemon=True).start()
+
+    def _read(self):
+        while True:
+            try:
+                data = self.src.recv(RECV_SIZE)
+            except OSError:
+                data = b''
+            with self.cond:
+                if not data:
+                    self.eof = True
+                    self.cond.notify_all()
+                    return
+                while self.queued >= self.buffer_size:
+                    self.cond.wait()
+                start = max(time.monotonic(), self.link_free)
+                self.link_free = start + len(data) / self.bandwidth \
+                    if self.bandwidth else start
+                self.queue.append((self.link_free + self.delay, data))
+                self.queued += len(data)
+                self.cond.notify_all()
+
+    def _write(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.eof:
+                    self.cond.wait()
+                if not self.queue:
+                    break
+                release, data = self.queue.popleft()
+            wait = release - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                self.dst.sendall(data)
+            except OSError:
+                break
+            with self.cond:
+                self.queued -= len(data)
+                self.cond.notify_all()
+        try:
+            self.dst.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        self.done()
+
+
+class LinkEmulator:
+    """TCP proxy that adds latency and a bandwidth cap"""
+
+    def __init__(self, target, *, rtt=0.0, bandwidth=None, port=0):
+        """
+        :param tuple target: (host, port) to forward to
+        :param int port: port to listen on, 0 for any free one
+        :param float rtt: round trip time in seconds
+        :param int bandwidth: bytes per second in each direction, or None
+        """
+        self.target = target
+        self.rtt = rtt
+        self.bandwidth = bandwidth
+        self.listener = _listen(port)
+        self.port = self.listener.getsockname()[1]
+        self.sockets = []
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+
+    def _accept_loop(self):
+        while True:
+            try:
+                client, _ = self.listener.accept()
+            except OSError:
+                return
+            upstream = socket.create_connection(self.target)
+            pair = [client, upstream]
+            self.sockets.extend(pair)
+            for sock in pair:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            done = self._closer(pair)
+            _LinkDirection(client, upstream, self.rtt / 2, self.bandwidth,
+                           done)
+            _LinkDirection(upstream, client, self.rtt / 2, self.bandwidth,
+                           done)
+
+    @staticmethod
+    def _closer(pair):
+        remaining = [2]
+        lock = threading.Lock()
+
+        def done():
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            for sock in pair:
+                sock.close()
+        return done
+
+    def close(self):
+        self.listener.close()
+        for sock in self.sockets:
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+
+def _listen(port):
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', port))
+    sock.listen(16)
+    return sock
+
+
+class _Handle(paramiko.SFTPHandle):
+
+    def __init__(self, f, flags, stats):
+        super().__init__(flags)
+        self.readfile = self.writefile = f
+        self.stats = stats
+
+    def read(self, offset, length):
+        self.stats.add('read')
+        return super().read(offset, length)
+
+    def write(self, offset, data):
+        self.stats.add('write')
+        return super().write(offset, data)
+
+    def stat(self):
+        self.stats.add('fstat')
+        try:
+            return paramiko.SFTPAttributes.from_stat(
+                os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def close(self):
+        self.stats.add('close')
+        super().close()
+
+
+def _errors(func):
+    """Report OSErrors to the client as SFTP status codes"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+    return wrapper
+
+
+class _SFTPInterface(paramiko.SFTPServerInterface):
+    """Serves the root directory of the test server"""
+
+    def __init__(self, server, test_server, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.test_server = test_server
+        self.stats = test_server.stats
+
+    def _local(self, path):
+        return self.test_server.local_path(path)
+
+    def canonicalize(self, path):
+        self.stats.add('realpath')
+        return os.path.normpath('/' + path)
+
+    @_errors
+    def list_folder(self, path):
+        self.stats.add('opendir')
+        local = self._local(path)
+        result = []
+        for name in os.listdir(local):
+            attr = paramiko.SFTPAttributes.from_stat(
+                os.lstat(os.path.join(local, name)))
+            attr.filename = name
+            result.append(attr)
+        return result
+
+    @_errors
+    def stat(self, path):
+        self.stats.add('stat')
+        return paramiko.SFTPAttributes.from_stat(os.stat(self._local(path)))
+
+    @_errors
+    def lstat(self, path):
+        self.stats.add('lstat')
+        return paramiko.SFTPAttributes.from_stat(
+            os.lstat(self._local(path)))
+
+    @_errors
+    def open(self, path, flags, attr):
+        self.stats.add('open')
+        fd = os.open(self._local(path), flags, 0o644)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        return _Handle(os.fdopen(fd, mode), flags, self.stats)
+
+    @_errors
+    def remove(self, path):
+        self.stats.add('remove')
+        os.remove(self._local(path))
+        return paramiko.SFTP_OK
+
+    @_errors
+    def rename(self, oldpath, newpath):
+        self.stats.add('rename')
+        # SFTP rename does not replace existing files
+        os.link(self._local(oldpath), self._local(newpath))
+        os.unlink(self._local(oldpath))
+        return paramiko.SFTP_OK
+
+    @_errors
+    def posix_rename(self, oldpath, newpath):
+        self.stats.add('posix_rename')
+        os.rename(self._local(oldpath), self._local(newpath))
+        return paramiko.SFTP_OK
+
+    @_errors
+    def mkdir(self, path, attr):
+        self.stats.add('mkdir')
+        os.mkdir(self._local(path))
+        return paramiko.SFTP_OK
+
+    @_errors
+    def rmdir(self, path):
+        self.stats.add('rmdir')
+        os.rmdir(self._local(path))
+        return paramiko.SFTP_OK
+
+    @_errors
+    def chattr(self, path, attr):
+        self.stats.add('setstat')
+        return paramiko.SFTP_OK
+
+
+class _ServerInterface(paramiko.ServerInterface):
+
+    def __init__(self, test_server):
+        self.test_server = test_server
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        if key == self.test_server.client_key:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        self.test_server.stats.add('exec')
+        if not self.test_server.allow_exec:
+            return False
+        argv = self.test_server.exec_handler(
+            command.decode('utf-8', 'surrogateescape'))
+        threading.Thread(target=_run_exec, args=(channel, argv),
+                         daemon=True).start()
+        return True
+
+
+def _run_exec(channel, argv):
+    """Run a command for an exec request, connected to the channel"""
+    if argv is None:
+        channel.sendall_stderr(b'command not allowed\n')
+        channel.send_exit_status(127)
+        channel.close()
+        return
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    p = subprocess.Popen(argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE, env=env)
+
+    def feed():
+        while True:
+            data = channel.recv(RECV_SIZE)
+            if not data:
+                break
+            try:
+                p.stdin.write(data)
+                p.stdin.flush()
+            except OSError:
+                break
+        p.stdin.close()
+
+    def errors():
+        for line in p.stderr:
+            channel.sendall_stderr(line)
+
+    threading.Thread(target=feed, daemon=True).start()
+    threading.Thread(target=errors, daemon=True).start()
+    while True:
+        data = p.stdout.read1(RECV_SIZE)
+        if not data:
+            break
+        channel.sendall(data)
+    channel.send_exit_status(p.wait())
+    channel.close()
+
+
+class SFTPTestServer:
+    """SSH server for SFTP and exec on localhost, see the module docstring
+    """
+
+    def __init__(self, root, *, rtt=0.0, bandwidth=None, allow_exec=True,
+                 exec_handler=None, user='test', alias='testsrv', port=0):
+        """
+        :param str root: directory to serve
+        :param int port: port for clients, 0 for any free one
+        :param float rtt: emulated round trip time in seconds
+        :param int bandwidth: emulated bytes per second, None for no cap
+        :param bool allow_exec: False to refuse exec requests, which makes
+            SFTPBackend fall back to plain SFTP
+        :param callable exec_handler: maps an exec command to an argv list,
+            or None to fail it. The default runs `hashedbackup serve` from
+            this tree.
+        """
+        self.root = os.path.abspath(root)
+        self.rtt = rtt
+        self.bandwidth = bandwidth
+        self.allow_exec = allow_exec
+        self.exec_handler = exec_handler or self.serve_handler
+        self.user = user
+        self.alias = alias
+        self.requested_port = port
+        self.stats = Stats()
+        self.host_key = paramiko.ECDSAKey.generate()
+        self.client_key = paramiko.ECDSAKey.generate()
+        self.workdir = None
+        self.ssh_config = None
+        self.listener = None
+        self.link = None
+        self.transports = []
+
+    def local_path(self, path):
+        """Local path of a path on the server"""
+        path = os.path.normpath('/' + path).lstrip('/')
+        return os.path.join(self.root, path)
+
+    def serve_handler(self, command):
+        """Exec handler that allows `hashedbackup serve [options] PATH`"""
+        argv = shlex.split(command)
+        if argv[:2] != ['hashedbackup', 'serve'] or len(argv) < 3:
+            return None
+        return [sys.executable, '-c', SERVE_RUNNER] + argv[1:-1] + [
+            self.local_path(argv[-1])]
+
+    @property
+    def port(self):
+        """Port that clients connect to"""
+        if self.link is not None:
+            return self.link.port
+        return self.listener.getsockname()[1]
+
+    def start(self):
+        emulate = bool(self.rtt or self.bandwidth)
+        self.listener = _listen(0 if emulate else self.requested_port)
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        if emulate:
+            self.link = LinkEmulator(
+                self.listener.getsockname(), rtt=self.rtt,
+                bandwidth=self.bandwidth, port=self.requested_port)
+
+        self.workdir = tempfile.mkdtemp(prefix='sftpserver-')
+        key_path = os.path.join(self.workdir, 'id_ecdsa')
+        self.client_key.write_private_key_file(key_path)
+        self.ssh_config = os.path.join(self.workdir, 'ssh_config')
+        with open(self.ssh_config, 'w') as f:
+            f.write('Host {}\n  HostName 127.0.0.1\n  Port {}\n  User {}\n'
+                    '  IdentityFile {}\n'.format(
+                        self.alias, self.port, self.user, key_path))
+        return self
+
+    def _accept_loop(self):
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                return
+            self.stats.add('connections')
+            transport = paramiko.Transport(sock)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler(
+                'sftp', paramiko.SFTPServer, _SFTPInterface, self)
+            self.transports.append(transport)
+            try:
+                transport.start_server(server=_ServerInterface(self))
+            except (paramiko.SSHException, EOFError):
+                continue
+
+    def stop(self):
+        self.listener.close()
+        if self.link is not None:
+            self.link.close()
+        for transport in self.transports:
+            transport.close()
+        if self.workdir:
+            for name in os.listdir(self.workdir):
+                os.unlink(os.path.join(self.workdir, name))
+            os.rmdir(self.workdir)
+            self.workdir = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('root', help='directory to serve')
+    parser.add_argument('--port', type=int, default=0,
+                        help='port to listen on (default: any free one)')
+    parser.add_argument('--rtt', type=float, default=0,
+                        help='round trip time in ms (default: 0)')
+    parser.add_argument('--bandwidth', type=float,
+                        help='bandwidth in MB/s (default: no limit)')
+    parser.add_argument('--no-exec', action='store_true',
+                        help='refuse exec requests, like an SFTP-only host')
+    args = parser.parse_args()
+
+    server = SFTPTestServer(
+        args.root, port=args.port, rtt=args.rtt / 1000,
+        allow_exec=not args.no_exec,
+        bandwidth=int(args.bandwidth * MB) if args.bandwidth else None)
+    with server:
+        print('Serving {} on port {}, use:\n\n    hashedbackup --ssh-config '
+              '{} ... {}:PATH\n'.format(server.root, server.port,
+                                        server.ssh_config, server.alias))
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+    print(server.stats.snapshot())
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,87 @@
-from hashedbackup.backends.local import LocalBackend
-from hashedbackup.backends.sftp import SFTPBackend
+"""Storage backends, selected by the scheme of the destination
 
+Destinations are local paths, `[user@]host:path` like scp accepts, or URLs
+like `sftp://user@host:2222/backups` and `https://host/backups`. Backend
+classes are only imported once a destination needs them, so that a local
+backup never loads paramiko.
+
+Other packages can add backends for new URL schemes with an entry point:
+
+    entry_points={
+        'hashedbackup.backends': ['s3 = mypackage.s3:S3Backend'],
+    }
+
+The class is called with the full destination and the options, like the
+built-in backends.
+"""
+import importlib
+import re
+
+ENTRY_POINT_GROUP = 'hashedbackup.backends'
+
+# Scheme to 'module:class' of the backends that come with hashedbackup
+BUILTIN_BACKENDS = {
+    'file': 'hashedbackup.backends.local:LocalBackend',
+    'sftp': 'hashedbackup.backends.sftp:SFTPBackend',
+    'http': 'hashedbackup.backends.http:HTTPBackend',
+    'https': 'hashedbackup.backends.http:HTTPBackend',
+}
+
+_url_re = re.compile(r'^([a-zA-Z][a-zA-Z0-9+.-]*)://')
 _backend_cache = {}
+_class_cache = {}
+
+
+def parse_scheme(path):
+    """
+    :param str path: path or url as passed by user
+    :return: tuple of (scheme, path for the backend)
+    """
+    m = _url_re.match(path)
+    if m:
+        scheme = m.group(1).lower()
+        if scheme == 'file':
+            return scheme, path[len('file://'):]
+        return scheme, path
+    if ':' in path:
+        return 'sftp', path
+    return 'file', path
+
+
+def _entry_point_backends():
+    from importlib.metadata import entry_points
+    eps = entry_points()
+    if hasattr(eps, 'select'):
+        eps = eps.select(group=ENTRY_POINT_GROUP)
+    else:
+        # Python < 3.10
+        eps = eps.get(ENTRY_POINT_GROUP, [])
+    return {ep.name: ep for ep in eps}
+
+
+def get_backend_class(scheme):
+    """
+    :param str scheme: url scheme, like 'sftp'
+    :rtype: type
+    :raises ValueError: if no backend handles this scheme
+    """
+    if scheme in _class_cache:
+        return _class_cache[scheme]
+
+    if scheme in BUILTIN_BACKENDS:
+        module_name, class_name = BUILTIN_BACKENDS[scheme].split(':')
+        cls = getattr(importlib.import_module(module_name), class_name)
+    else:
+        # Only scan the installed packages for schemes we do not know
+        entry_point = _entry_point_backends().get(scheme)
+        if entry_point is None:
+            raise ValueError('No backend for {}:// destinations'.format(
+                scheme))
+        cls = entry_point.load()
+
+    _class_cache[scheme] = cls
+    return cls
+
 
 def get_backend(path, options, *, nocache=False):
     """
@@ -13,10 +93,8 @@ def get_backend(path, options, *, nocache=False):
     if not nocache and path in _backend_cache:
         return _backend_cache[path]
 
-    if ':' in path:
-        backend = SFTPBackend(path, options=options)
-    else:
-        backend = LocalBackend(path, options=options)
+    scheme, backend_path = parse_scheme(path)
+    backend = get_backend_class(scheme)(backend_path, options=options)
 
     _backend_cache[path] = backend
     return backend
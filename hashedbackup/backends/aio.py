@@ -0,0 +1,66 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+
+class AsyncBackend:
+    """Asyncio interface to a backend
+
+    The storage libraries we use are blocking, so the calls run in a thread
+    pool owned by the backend. The pool size limits the number of concurrent
+    operations. Remote backends are limited by round trips, so that more
+    workers keep more requests in flight. SFTP workers each use their own
+    channels on the shared control and bulk transports.
+    """
+
+    def __init__(self, backend, *, max_workers):
+        """
+        :type backend: hashedbackup.backends.base.BackendBase
+        :param int max_workers: max number of concurrent operations
+        """
+        self.backend = backend
+        self.path = backend.path
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='upload')
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    async def add_object(self, fhash, fpath):
+        return await self._run(self.backend.add_object, fhash, fpath)
+
+    async def add_object_data(self, fhash, data):
+        return await self._run(self.backend.add_object_data, fhash, data)
+
+    async def exists(self, path):
+        return await self._run(self.backend.exists, path)
+
+    async def open(self, *args, **kwargs):
+        # An SFTP file is bound to the channel of the worker that opened it,
+        # so it must be used from a single thread at a time.
+        return await self._run(lambda: self.backend.open(*args, **kwargs))
+
+    async def rename(self, src, dst):
+        return await self._run(self.backend.rename, src, dst)
+
+    async def get_object_hashes(self):
+        return await self._run(self.backend.get_object_hashes)
+
+    async def have_objects(self, hashes):
+        return await self._run(self.backend.have_objects, hashes)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+def get_async_backend(backend, *, max_workers):
+    """
+    :type backend: hashedbackup.backends.base.BackendBase
+    :param int max_workers: max number of concurrent operations
+    :rtype: AsyncBackend
+    """
+    return AsyncBackend(backend, max_workers=max_workers)
@@ -1,21 +1,64 @@
 import abc
+import hashlib
 import json
 import os
 import logging
 import sys
+import threading
 
+from hashedbackup.defaults import DURABILITY_MODES, DEFAULT_DURABILITY, \
+    DEFAULT_FSYNC_BATCH
+from hashedbackup.hashindex import load_object_hashes
+from hashedbackup.compression import COMPRESSED_SUFFIX, DecompressingReader, \
+    is_compressible, compress_data
+from hashedbackup.sparse import SPARSE_SUFFIX, SparseReader, restore_sparse
 from hashedbackup.messages import UPGRADE_TO_REPOSITORY_V1
-from hashedbackup.utils import temp_filename, printerr
+from hashedbackup.utils import temp_filename, printerr, copy_and_hash_fo, \
+    MB
 
 log = logging.getLogger(__name__)
 
+# Suffixes after the hash for each way an object can be stored, in the order
+# in which we look for them.
+OBJECT_SUFFIXES = ('', COMPRESSED_SUFFIX, SPARSE_SUFFIX)
+
+# Names in hashedbackup.json of the object formats other than plain data,
+# by their suffix
+OBJECT_FORMATS = {COMPRESSED_SUFFIX: 'zlib', SPARSE_SUFFIX: 'sparse'}
+
+# Version 2 repositories list the object formats other than plain data that
+# they contain in object_formats. A backup raises the version to 2 before it
+# writes the first object in such a format, so that older versions of
+# hashedbackup, which only know version 1, refuse the repository instead of
+# missing these objects.
+REPOSITORY_VERSIONS = (1, 2)
+
+
+def parse_object_name(fname):
+    """
+    :param str fname: filename in an object bucket
+    :return: the hash, or None if this is not an object
+    :rtype: str
+    """
+    for suffix in OBJECT_SUFFIXES[1:]:
+        if fname.endswith(suffix):
+            fname = fname[:-len(suffix)]
+            break
+    if len(fname) == 32 and not fname.startswith('.'):
+        return fname
+    return None
+
 
 class BackendBase(abc.ABC):
 
+    # True if have_objects() checks many objects in one request
+    bulk_have_objects = False
+
     def __init__(self, path, options):
         self.path = path
         self.options = options
         self.repo_config = None
+        self._repo_config_lock = threading.Lock()
 
     @abc.abstractmethod
     def try_mkdir(self, path): pass
@@ -29,12 +72,25 @@ class BackendBase(abc.ABC):
     @abc.abstractmethod
     def rename(self, src, dst): pass
 
+    @abc.abstractmethod
+    def replace(self, src, dst):
+        """Rename, atomically replacing dst if it exists"""
+
     @abc.abstractmethod
     def delete(self, path): pass
 
     @abc.abstractmethod
     def add_object(self, fhash, fpath): pass
 
+    @abc.abstractmethod
+    def add_object_data(self, fhash, data):
+        """Add an object from memory, used for small files
+
+        :param str fhash: hash of the data
+        :param bytes data: the complete file contents
+        :return: True if added, False if it already existed
+        """
+
     @abc.abstractmethod
     def listdir(self, path): pass
 
@@ -42,28 +98,235 @@ class BackendBase(abc.ABC):
     def isdir(self, path): pass
 
     @abc.abstractmethod
-    def get_object_hashes(self): pass
+    def scan_object_hashes(self):
+        """List the objects directory
+
+        :return: set of hex hashes in the repository
+        :rtype: set[str]
+        """
+
+    def get_object_hashes(self):
+        """Get all object hashes, from the repository index if it is usable
+
+        :return: set of hex hashes in the repository
+        :rtype: set[str]
+        """
+        return load_object_hashes(
+            self, rescan=getattr(self.options, 'rescan_objects', False))
 
     def temppath(self):
         return os.path.join(self.path, 'tmp', temp_filename())
 
-    def object_path(self, fhash):
-        return os.path.join(self.path, 'objects', fhash[0:2], fhash)
+    def object_path(self, fhash, suffix=''):
+        return os.path.join(self.path, 'objects', fhash[0:2], fhash + suffix)
+
+    def encode_object_data(self, fhash, data):
+        """Verify object data and encode it for storage
+
+        :return: tuple of (object path, data to store)
+        :raises ValueError: if the data does not match the hash
+        """
+        if hashlib.md5(data).hexdigest() != fhash:
+            # TODO: can we recover by retrying process_file() ?
+            raise ValueError('Data for {} does not match its hash'.format(
+                fhash))
+        if self.compress and is_compressible(data):
+            return (self.object_path(fhash, COMPRESSED_SUFFIX),
+                    compress_data(data))
+        return self.object_path(fhash), data
+
+    def object_exists(self, fhash):
+        """Check if an object exists in any of its stored forms"""
+        for suffix in OBJECT_SUFFIXES:
+            if self.exists(self.object_path(fhash, suffix)):
+                return True
+        return False
+
+    def stored_form_exists(self, dst_path):
+        """Check if an object exists in the form that an upload would store
+
+        Uploads use this instead of object_exists(), which takes a round trip
+        for every form. An object that exists in another form is stored
+        again, which only costs space.
+
+        :param str dst_path: path returned by object_path() for the form
+        """
+        return self.exists(dst_path)
+
+    def have_objects(self, hashes):
+        """Check which of the given objects exist
+
+        Backends that can check many objects in one request override this.
+
+        :param iterable[str] hashes: hashes to check
+        :return: the hashes that exist
+        :rtype: set[str]
+        """
+        return {fhash for fhash in hashes if self.object_exists(fhash)}
+
+    def open_object(self, fhash):
+        """Open an object for reading, independent of its stored form
+
+        :return: readable file object with the original file data
+        :raises FileNotFoundError: if the object does not exist
+        """
+        for suffix in OBJECT_SUFFIXES:
+            try:
+                f = self.open(self.object_path(fhash, suffix), 'rb')
+            except FileNotFoundError:
+                continue
+            if suffix == COMPRESSED_SUFFIX:
+                return DecompressingReader(f)
+            if suffix == SPARSE_SUFFIX:
+                return SparseReader(f)
+            return f
+        raise FileNotFoundError('Object {} not found'.format(fhash))
+
+    def read_tail(self, path, size):
+        """Read the end of a file
+
+        Backends that can read a range without opening the file override
+        this.
+
+        :param int size: max number of bytes
+        :return: the last size bytes of the file, or all of a smaller one
+        :rtype: bytes
+        :raises FileNotFoundError: if the file does not exist
+        """
+        with self.open(path, 'rb') as f:
+            if f.seekable():
+                f.seek(0, os.SEEK_END)
+                f.seek(max(0, f.tell() - size))
+                return f.read()
+            tail = b''
+            for buf in iter(lambda: f.read(MB), b''):
+                tail = (tail + buf)[-size:]
+            return tail
+
+    def restore_object(self, fhash, dst_path):
+        """Write the original data of an object to a local file
+
+        The holes of sparse files are recreated.
+
+        :raises FileNotFoundError: if the object does not exist
+        """
+        try:
+            f = self.open(self.object_path(fhash, SPARSE_SUFFIX), 'rb')
+        except FileNotFoundError:
+            pass
+        else:
+            with f, open(dst_path, 'wb') as dst:
+                restore_sparse(f, dst)
+            return
+        with self.open_object(fhash) as src, open(dst_path, 'wb') as dst:
+            copy_and_hash_fo(src, dst)
+
+    def flush(self):
+        """Make all objects added so far durable
+
+        Called before a manifest that refers to them is committed.
+        """
+
+    def sync_file(self, f):
+        """Make the data written to a file opened with open() durable"""
+
+    def sync_dir(self, path):
+        """Make renames into a directory durable"""
+
+    def release_threads(self):
+        """Drop what the backend keeps per thread, like SFTP channels
+
+        Processes that keep a backend for several backups call this after
+        each one, since its threads are gone by then.
+        """
+
+    @property
+    def connected(self):
+        """False if the connection to the repository was lost"""
+        return True
+
+    def close(self):
+        """Close the connections to the repository"""
+        self.release_threads()
+
+    @property
+    def durability(self):
+        return getattr(self.options, 'durability', DEFAULT_DURABILITY)
+
+    @property
+    def compress(self):
+        """True if objects are compressed when that saves space"""
+        return getattr(self.options, 'compress', False)
+
+    def read_repo_config(self):
+        """
+        :return: the contents of hashedbackup.json
+        :rtype: dict
+        """
+        path = os.path.join(self.path, 'hashedbackup.json')
+        with self.open(path, 'rb') as f:
+            return json.loads(f.read().decode('utf-8'))
+
+    def record_object_format(self, objpath):
+        """Make sure that hashedbackup.json lists the format of an object
+
+        Called before the object gets its final path.
+
+        :param str objpath: path the object will be stored at
+        """
+        for suffix, name in OBJECT_FORMATS.items():
+            if objpath.endswith(suffix):
+                break
+        else:
+            return
+        if self.repo_config is not None and \
+                name in self.repo_config.get('object_formats', ()):
+            return
+        with self._repo_config_lock:
+            # Another backup may have changed it since we read it. Two
+            # backups that add different formats at the same time can lose
+            # one of them, which only matters to versions that do not know
+            # that format.
+            config = self.read_repo_config()
+            formats = config.get('object_formats', [])
+            if name not in formats:
+                log.info('Adding the %s object format to the repository',
+                         name)
+                config['version'] = 2
+                config['object_formats'] = sorted(formats + [name])
+                tmp_path = self.temppath()
+                f = self.open(tmp_path, 'w')
+                try:
+                    f.write(json.dumps(config, ensure_ascii=True, indent=2))
+                    self.sync_file(f)
+                finally:
+                    f.close()
+                self.replace(tmp_path,
+                             os.path.join(self.path, 'hashedbackup.json'))
+                self.sync_dir(self.path)
+            self.repo_config = config
 
     def check_destination_valid(self):
         # TODO: create our own exception types
         repo_config_path = os.path.join(self.path, 'hashedbackup.json')
         try:
-            with self.open(repo_config_path, 'rb') as f:
-                self.repo_config = json.loads(f.read().decode('utf-8'))
-                if not 'version' in self.repo_config:
-                    raise Exception("Invalid hashedbackup.json: no version key")
-
-                version = self.repo_config['version']
-                if version != 1:
-                    raise Exception(
-                        "Repository version is {}, while this version of "
-                        "hashedbackup only supports version 1".format(version))
+            self.repo_config = self.read_repo_config()
+            if not 'version' in self.repo_config:
+                raise Exception("Invalid hashedbackup.json: no version key")
+
+            version = self.repo_config['version']
+            if version not in REPOSITORY_VERSIONS:
+                raise Exception(
+                    "Repository version is {}, while this version of "
+                    "hashedbackup only supports versions {}".format(
+                        version, ', '.join(map(str, REPOSITORY_VERSIONS))))
+            unknown = set(self.repo_config.get('object_formats', [])) - \
+                set(OBJECT_FORMATS.values())
+            if unknown:
+                raise Exception(
+                    "Repository contains objects in formats that this "
+                    "version of hashedbackup does not support: {}".format(
+                        ', '.join(sorted(unknown))))
         except OSError:
             if self.exists(repo_config_path):
                 raise Exception("{} is not readable".format(repo_config_path))
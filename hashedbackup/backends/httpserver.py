@@ -0,0 +1,299 @@
+"""Local stand-in server for the HTTP backend
+
+Serves a directory with the protocol described in hashedbackup.backends.http,
+for trying the HTTP backend and for benchmarks without a real object gateway:
+
+    python -m hashedbackup.backends.httpserver /srv/backups --port 8080
+    hashedbackup init http://localhost:8080/pictures
+
+It is not meant to be exposed to untrusted networks.
+"""
+import argparse
+import base64
+import http.server
+import logging
+import os
+import shutil
+import urllib.parse
+
+from hashedbackup.utils import temp_filename, MB
+
+log = logging.getLogger(__name__)
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    # Needed for keep-alive connections
+    protocol_version = 'HTTP/1.1'
+
+    @property
+    def root(self):
+        return self.server.root
+
+    def log_message(self, fmt, *args):
+        log.debug('%s - %s', self.address_string(), fmt % args)
+
+    def _fs_path(self, url_path):
+        """Map a url path to a path below the root, or None if outside"""
+        path = urllib.parse.unquote(urllib.parse.urlsplit(url_path).path)
+        path = os.path.normpath('/' + path).lstrip('/')
+        fs_path = os.path.join(self.root, path)
+        if os.path.commonpath([self.root, fs_path]) != self.root:
+            return None
+        return fs_path
+
+    def _reply(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body and self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _authorized(self):
+        if not self.server.credentials:
+            return True
+        expected = 'Basic ' + base64.b64encode(
+            self.server.credentials.encode('utf-8')).decode('ascii')
+        if self.headers.get('Authorization') == expected:
+            return True
+        self._reply(401, headers={'WWW-Authenticate': 'Basic'})
+        return False
+
+    def _start(self):
+        """Common checks, return the filesystem path or None if handled"""
+        if not self._authorized():
+            return None
+        path = self._fs_path(self.path)
+        if path is None:
+            self._reply(403)
+        return path
+
+    def _read_body(self, f):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if size == 0:
+                    # Trailers end with an empty line
+                    while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                        pass
+                    return
+                self._copy(size, f)
+                self.rfile.readline()
+        else:
+            self._copy(int(self.headers.get('Content-Length', 0)), f)
+
+    def _copy(self, size, f):
+        while size:
+            data = self.rfile.read(min(size, MB))
+            if not data:
+                raise ConnectionError('Client disconnected')
+            f.write(data)
+            size -= len(data)
+
+    def _send_chunked(self, lines):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        buf = []
+        size = 0
+        for line in lines:
+            data = line.encode('utf-8', 'surrogateescape') + b'\n'
+            buf.append(data)
+            size += len(data)
+            if size >= 64 * 1024:
+                self._write_chunk(b''.join(buf))
+                buf = []
+                size = 0
+        if buf:
+            self._write_chunk(b''.join(buf))
+        self.wfile.write(b'0\r\n\r\n')
+
+    def _write_chunk(self, data):
+        self.wfile.write(b'%x\r\n' % len(data) + data + b'\r\n')
+
+    def do_HEAD(self):
+        path = self._start()
+        if path is None:
+            return
+        if os.path.isdir(path):
+            self._reply(200, headers={'X-Hashedbackup-Type': 'directory'})
+        elif os.path.isfile(path):
+            self.send_response(200)
+            self.send_header('X-Hashedbackup-Type', 'file')
+            self.send_header('Content-Length', str(os.path.getsize(path)))
+            self.end_headers()
+        else:
+            self._reply(404)
+
+    def do_GET(self):
+        path = self._start()
+        if path is None:
+            return
+        query = urllib.parse.urlsplit(self.path).query
+        if query == 'list':
+            if not os.path.isdir(path):
+                return self._reply(404)
+            names = sorted(os.listdir(path))
+            return self._reply(200, ''.join(
+                name + '\n' for name in names).encode(
+                    'utf-8', 'surrogateescape'))
+        if query == 'hashes':
+            if not os.path.isdir(path):
+                return self._reply(404)
+            return self._send_chunked(self._iter_objects(path))
+
+        try:
+            f = open(path, 'rb')
+        except (FileNotFoundError, IsADirectoryError):
+            return self._reply(404)
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            tail = self._suffix_range()
+            if tail is not None and size:
+                # Only suffix ranges, which is what the client uses
+                start = max(0, size - tail)
+                f.seek(start)
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                    start, size - 1, size))
+                size -= start
+            else:
+                self.send_response(200)
+            self.send_header('Content-Length', str(size))
+            self.end_headers()
+            shutil.copyfileobj(f, self.wfile, MB)
+
+    def _suffix_range(self):
+        """
+        :return: n of a "Range: bytes=-n" header, or None
+        :rtype: int
+        """
+        value = self.headers.get('Range', '')
+        if not value.startswith('bytes=-'):
+            return None
+        try:
+            n = int(value[len('bytes=-'):])
+        except ValueError:
+            return None
+        return n if n > 0 else None
+
+    @staticmethod
+    def _iter_objects(path):
+        with os.scandir(path) as buckets:
+            for bucket in buckets:
+                if not bucket.is_dir():
+                    continue
+                with os.scandir(bucket.path) as entries:
+                    for entry in entries:
+                        yield entry.name
+
+    def do_PUT(self):
+        path = self._start()
+        if path is None:
+            return
+        if not os.path.isdir(os.path.dirname(path)):
+            with open(os.devnull, 'wb') as f:
+                self._read_body(f)
+            return self._reply(409)
+        # Write next to the destination, so that incomplete uploads never
+        # appear under the final name
+        tmp = os.path.join(os.path.dirname(path),
+                           '.upload-' + temp_filename())
+        try:
+            with open(tmp, 'wb') as f:
+                self._read_body(f)
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        self._reply(201)
+
+    def do_DELETE(self):
+        path = self._start()
+        if path is None:
+            return
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            return self._reply(404)
+        self._reply(204)
+
+    def do_MKCOL(self):
+        path = self._start()
+        if path is None:
+            return
+        try:
+            os.mkdir(path)
+        except FileExistsError:
+            return self._reply(405)
+        except FileNotFoundError:
+            return self._reply(409)
+        self._reply(201)
+
+    def do_MOVE(self):
+        path = self._start()
+        if path is None:
+            return
+        dst = self._fs_path(self.headers.get('Destination', ''))
+        if dst is None:
+            return self._reply(403)
+        overwrite = self.headers.get('Overwrite', 'T') != 'F'
+        if not os.path.exists(path):
+            return self._reply(404)
+        try:
+            if overwrite:
+                os.replace(path, dst)
+            else:
+                # Fails if dst exists, unlike rename
+                os.link(path, dst)
+                os.unlink(path)
+        except FileExistsError:
+            return self._reply(412)
+        except FileNotFoundError:
+            return self._reply(409)
+        self._reply(201)
+
+
+class Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, root, address, *, credentials=None):
+        """
+        :param str root: directory to serve
+        :param tuple address: (host, port), port 0 picks a free port
+        :param str credentials: 'user:password' to require, or None
+        """
+        self.root = os.path.abspath(root)
+        self.credentials = credentials
+        super().__init__(address, RequestHandler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('root', help='directory to serve')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8080,
+                        help='port to listen on (default: 8080)')
+    parser.add_argument('--credentials', metavar='USER:PASSWORD',
+                        help='require basic authentication')
+    parser.add_argument('--debug', action='store_true',
+                        help='log all requests')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+    server = Server(args.root, (args.host, args.port),
+                    credentials=args.credentials)
+    log.info('Serving %s on http://%s:%s/', server.root,
+             *server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
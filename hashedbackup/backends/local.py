@@ -1,13 +1,49 @@
+import hashlib
 import os
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from hashedbackup.backends.base import BackendBase
-from hashedbackup.utils import copy_and_hash, object_bucket_dirs
+from hashedbackup.backends.base import BackendBase, parse_object_name, \
+    DEFAULT_FSYNC_BATCH
+from hashedbackup.compression import CompressingWriter, probe_file, \
+    COMPRESSED_SUFFIX, DecompressingHasher
+from hashedbackup.sourceio import open_source
+from hashedbackup.sparse import SPARSE_SUFFIX, SparseHasher, find_extents, \
+    copy_sparse_and_hash
+from hashedbackup.throttle import ThrottledWriter, upload_limit
+from hashedbackup.utils import copy_and_hash_fo, object_bucket_dirs, MB
 
 log = logging.getLogger(__name__)
 
 
+# A batch is also synced once it holds this many bytes, to bound the amount
+# of dirty data a single fsync round has to write
+FSYNC_BATCH_BYTES = 256 * MB
+# Number of fsync calls of a batch in flight at the same time
+FSYNC_THREADS = 8
+
+
 class LocalBackend(BackendBase):
+    """Repository on a local filesystem
+
+    With durability 'batch', new objects stay in tmp/ until a group of them
+    has been fsynced. Only then they are renamed to their object path and
+    the bucket directories are fsynced, so that a crash never leaves an
+    object with incomplete data. flush() completes the current batch, which
+    happens before a manifest is committed.
+    """
+
+    def __init__(self, path, options):
+        super().__init__(path, options)
+        self.fsync_batch = getattr(options, 'fsync_batch', None) or \
+            DEFAULT_FSYNC_BATCH
+        # Objects waiting for fsync, as tuples of (tmp path, object path,
+        # size) and the set of their hashes
+        self._pending = []
+        self._pending_size = 0
+        self._pending_hashes = set()
+        self._lock = threading.Lock()
 
     def try_mkdir(self, path):
         try:
@@ -27,14 +63,92 @@ class LocalBackend(BackendBase):
         log.debug('rename(%r, %r)', src, dst)
         os.rename(src, dst)
 
+    def replace(self, src, dst):
+        log.debug('replace(%r, %r)', src, dst)
+        os.replace(src, dst)
+
     def delete(self, path):
         log.debug('delete(%r)', path)
         os.unlink(path)
 
+    def sync_file(self, f):
+        if self.durability != 'none':
+            f.flush()
+            os.fsync(f.fileno())
+
+    def sync_dir(self, path):
+        if self.durability != 'none':
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def object_exists(self, fhash):
+        return fhash in self._pending_hashes or super().object_exists(fhash)
+
+    def _commit_object(self, fhash, tmp, objpath, size):
+        """Give a complete temp file its object path, as durable as
+        configured"""
+        self.record_object_format(objpath)
+        if self.durability == 'none':
+            os.rename(tmp, objpath)
+        elif self.durability == 'file':
+            self._fsync_path(tmp)
+            os.rename(tmp, objpath)
+            self.sync_dir(os.path.dirname(objpath))
+        else:
+            batch = None
+            with self._lock:
+                self._pending.append((fhash, tmp, objpath))
+                self._pending_hashes.add(fhash)
+                self._pending_size += size
+                if (len(self._pending) >= self.fsync_batch or
+                        self._pending_size >= FSYNC_BATCH_BYTES):
+                    batch = self._take_batch()
+            if batch:
+                self._sync_batch(batch)
+
+    @staticmethod
+    def _fsync_path(path):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _take_batch(self):
+        batch = self._pending
+        self._pending = []
+        self._pending_size = 0
+        return batch
+
+    def _sync_batch(self, batch):
+        log.debug('Syncing batch of %i objects', len(batch))
+        # Concurrent fsyncs let the filesystem combine them into fewer
+        # journal commits
+        with ThreadPoolExecutor(max_workers=FSYNC_THREADS) as pool:
+            list(pool.map(self._fsync_path, [tmp for _, tmp, _ in batch]))
+        buckets = set()
+        for fhash, tmp, objpath in batch:
+            os.rename(tmp, objpath)
+            buckets.add(os.path.dirname(objpath))
+        for bucket in sorted(buckets):
+            self.sync_dir(bucket)
+        with self._lock:
+            self._pending_hashes.difference_update(
+                fhash for fhash, _, _ in batch)
+
+    def flush(self):
+        with self._lock:
+            batch = self._take_batch()
+        if batch:
+            self._sync_batch(batch)
+
     def add_object(self, fhash, fpath):
         log.debug('add_object(%r, %r)', fhash, fpath)
         objpath = self.object_path(fhash)
-        if os.path.exists(objpath):
+        if self.object_exists(fhash):
             return False
         os.makedirs(os.path.dirname(objpath), exist_ok=True)
 
@@ -44,14 +158,95 @@ class LocalBackend(BackendBase):
             os.link(fpath, objpath)
         else:
             tmp = self.temppath()
-            tmphash = copy_and_hash(fpath, tmp)
+            with open_source(fpath) as src, open(tmp, 'wb') as f:
+                dst = ThrottledWriter(f)
+                src_size = os.fstat(src.fileno()).st_size
+                extents = find_extents(src, src_size)
+                if extents is not None:
+                    objpath = self.object_path(fhash, SPARSE_SUFFIX)
+                    tmphash = copy_sparse_and_hash(src, dst, src_size,
+                                                   extents)
+                elif self.compress and probe_file(src):
+                    objpath = self.object_path(fhash, COMPRESSED_SUFFIX)
+                    writer = CompressingWriter(dst)
+                    tmphash = copy_and_hash_fo(src, writer)
+                    writer.finish()
+                else:
+                    tmphash = copy_and_hash_fo(src, dst)
+                size = dst.tell()
             if tmphash != fhash:
                 # TODO: can we recover by retrying process_file() ?
                 os.unlink(tmp)
                 raise ValueError(
                     'File {} hash does not match after copy!'.format(fpath))
-            os.rename(tmp, objpath)
+            self._commit_object(fhash, tmp, objpath, size)
+
+        return True
 
+    def add_object_data(self, fhash, data):
+        log.debug('add_object_data(%r, <%i bytes>)', fhash, len(data))
+        if self.object_exists(fhash):
+            return False
+        objpath, payload = self.encode_object_data(fhash, data)
+        os.makedirs(os.path.dirname(objpath), exist_ok=True)
+
+        tmp = self.temppath()
+        upload_limit.consume(len(payload))
+        with open(tmp, 'wb') as f:
+            f.write(payload)
+        self._commit_object(fhash, tmp, objpath, len(payload))
+        return True
+
+    def add_object_chunks(self, fhash, chunks, *, compressed=False,
+                          sparse=False):
+        """Add an object from a stream of data, used by `hashedbackup serve`
+
+        The data is verified against the hash before it becomes visible.
+
+        :param str fhash: hash of the original data
+        :param iterable[bytes] chunks: the data in its stored form
+        :param bool compressed: the data is compressed with zlib
+        :param bool sparse: the data is a sparse object
+        :return: True if added, False if it already existed
+        :raises ValueError: if the data does not match the hash
+        """
+        log.debug('add_object_chunks(%r, compressed=%r, sparse=%r)',
+                  fhash, compressed, sparse)
+        if self.object_exists(fhash):
+            for _ in chunks:
+                pass
+            return False
+        if sparse:
+            objpath = self.object_path(fhash, SPARSE_SUFFIX)
+            h = SparseHasher()
+        elif compressed:
+            objpath = self.object_path(fhash, COMPRESSED_SUFFIX)
+            h = DecompressingHasher()
+        else:
+            objpath = self.object_path(fhash)
+            h = hashlib.md5()
+        os.makedirs(os.path.dirname(objpath), exist_ok=True)
+
+        tmp = self.temppath()
+        size = 0
+        try:
+            with open(tmp, 'wb') as f:
+                for chunk in chunks:
+                    h.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            if h.hexdigest() != fhash:
+                raise ValueError('Data for {} does not match its hash'.format(
+                    fhash))
+        except BaseException as e:
+            os.unlink(tmp)
+            if isinstance(e, Exception):
+                # Read the rest of the object, so that a server stays in
+                # sync with the frames of its client
+                for _ in chunks:
+                    pass
+            raise
+        self._commit_object(fhash, tmp, objpath, size)
         return True
 
     def listdir(self, path):
@@ -60,15 +255,16 @@ class LocalBackend(BackendBase):
     def isdir(self, path):
         return os.path.isdir(path)
 
-    def get_object_hashes(self):
+    def scan_object_hashes(self):
         hashes = set()
         for bucket in object_bucket_dirs():
             bucket_path = os.path.join(self.path, 'objects', bucket)
             for fname in os.listdir(bucket_path):
                 if fname.startswith('.'):
                     continue
-                if len(fname) == 32:
-                    hashes.add(fname)
+                fhash = parse_object_name(fname)
+                if fhash:
+                    hashes.add(fhash)
                 else:
                     log.debug('Invalid hash in list, skipping: %s', fname)
         return hashes
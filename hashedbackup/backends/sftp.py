@@ -1,55 +1,469 @@
+import hashlib
+import itertools
 import os
+import queue
+import shlex
 import stat
+import threading
 import time
+import urllib.parse
+import zlib
 import logging
 
 import paramiko
 from paramiko.config import SSH_PORT
 
-from hashedbackup.backends.base import BackendBase
+from hashedbackup.backends.base import BackendBase, parse_object_name
+from hashedbackup.compression import CompressingWriter, probe_file, \
+    COMPRESSED_SUFFIX, LEVEL as COMPRESSION_LEVEL
+from hashedbackup.remote import FrameIO, RemoteSession, RemoteError, \
+    DEFAULT_REMOTE_COMMAND, CODEC_RAW, CODEC_ZLIB, CODEC_SPARSE
+from hashedbackup.sourceio import open_source
+from hashedbackup.sparse import SPARSE_SUFFIX, find_extents, \
+    iter_sparse_object, copy_sparse_and_hash, stored_size
+from hashedbackup.throttle import ThrottledWriter, throttled, \
+    upload_limit
 from hashedbackup.utils import temp_filename, copy_and_hash_fo, MB, Timer, \
     object_bucket_dirs
 
 log = logging.getLogger(__name__)
 
 
+# Defaults for the bulk transport. A large window keeps the pipe full on
+# links with a high bandwidth-delay product.
+# https://github.com/paramiko/paramiko/issues/175
+BULK_WINDOW_SIZE = 2147483647
+# 512MB -> 4GB, this is a security degradation
+REKEY_BYTES = pow(2, 32)
+# Host aliases, users, ports and identity files, like ssh uses
+DEFAULT_SSH_CONFIG = '~/.ssh/config'
+# Files from this size are uploaded over several streams at once when plain
+# SFTP is used, see RangeUpload
+DEFAULT_LARGE_FILE_SIZE = 256 * MB
+DEFAULT_LARGE_FILE_STREAMS = 4
+# Size of the ranges that the streams write, and the number of ranges that
+# are read ahead per stream
+RANGE_SIZE = 4 * MB
+RANGE_QUEUE_SIZE = 2
+
+
+class TransportConfig:
+    """Tuning for one SSH transport"""
+
+    def __init__(self, *, compress=False, ciphers=None, macs=None,
+                 window_size=None, max_packet_size=None):
+        """
+        :param bool compress: enable SSH compression
+        :param list[str] ciphers: ciphers in order of preference, or None for
+            the paramiko defaults
+        :param list[str] macs: MACs in order of preference, or None
+        :param int window_size: SSH channel window size in bytes
+        :param int max_packet_size: SSH channel max packet size in bytes
+        """
+        self.compress = compress
+        self.ciphers = self._supported(
+            'cipher', ciphers, paramiko.Transport._preferred_ciphers)
+        self.macs = self._supported(
+            'MAC', macs, paramiko.Transport._preferred_macs)
+        self.window_size = window_size or paramiko.common.DEFAULT_WINDOW_SIZE
+        self.max_packet_size = (max_packet_size or
+                                paramiko.common.DEFAULT_MAX_PACKET_SIZE)
+
+    @staticmethod
+    def _supported(kind, names, available):
+        if not names:
+            return None
+        supported = [name for name in names if name in available]
+        for name in names:
+            if name not in available:
+                log.warn('SSH %s %s is not supported by paramiko, '
+                         'ignoring it (available: %s)',
+                         kind, name, ', '.join(available))
+        return supported or None
+
+    @classmethod
+    def from_options(cls, options, kind):
+        """
+        :param options: command line options
+        :param str kind: 'control' or 'bulk'
+        :rtype: TransportConfig
+        """
+        def split(value):
+            return [x.strip() for x in value.split(',')] if value else None
+
+        compression = getattr(options, 'ssh_compression', None) or 'auto'
+        if compression == 'auto':
+            # Compression will not speedup picture transfers, but will help
+            # for the remote hash download and for files that are
+            # compressible. With per-object compression, compressible files
+            # are already compressed and compressing everything again only
+            # wastes CPU.
+            compress = kind == 'control' or not getattr(
+                options, 'compress', False)
+        else:
+            compress = compression in (kind, 'both')
+
+        window_size = getattr(options, 'ssh_window_size', None)
+        if not window_size and kind == 'bulk':
+            window_size = BULK_WINDOW_SIZE
+
+        return cls(
+            compress=compress,
+            ciphers=split(getattr(options, 'ssh_ciphers', None)),
+            macs=split(getattr(options, 'ssh_macs', None)),
+            window_size=window_size,
+            max_packet_size=getattr(options, 'ssh_packet_size', None))
+
+    def make_transport(self, sock, **kwargs):
+        """Transport factory for paramiko.SSHClient.connect"""
+        transport = paramiko.Transport(
+            sock,
+            default_window_size=self.window_size,
+            default_max_packet_size=self.max_packet_size,
+            **kwargs)
+        security = transport.get_security_options()
+        if self.ciphers:
+            security.ciphers = self.ciphers
+        if self.macs:
+            security.digests = self.macs
+        return transport
+
+    def __repr__(self):
+        return ('TransportConfig(compress={}, ciphers={}, macs={}, '
+                'window_size={}, max_packet_size={})'.format(
+                    self.compress, self.ciphers, self.macs,
+                    self.window_size, self.max_packet_size))
+
+
+class RangeUpload:
+    """Uploads a file into one remote file over several SFTP streams
+
+    The source is read and hashed sequentially by the calling thread, which
+    hands its ranges out in turn to stream threads. Every stream writes at
+    the offsets of its ranges through its own SFTP channel on its own SSH
+    connection, so that neither the window of one channel nor the cipher
+    of one transport limits the upload.
+    """
+
+    error = None
+
+    def __init__(self, backend, path, streams):
+        """
+        :type backend: SFTPBackend
+        :param str path: remote file to write, created empty by the caller
+        :param int streams: number of concurrent streams
+        """
+        self.backend = backend
+        self.path = path
+        self.queues = [queue.Queue(RANGE_QUEUE_SIZE) for _ in range(streams)]
+
+    def _stream(self, index, ranges):
+        sftp = None
+        got_sentinel = False
+        try:
+            sftp = self.backend._open_sftp(
+                self.backend._stream_client(index), self.backend.bulk_config)
+            with sftp.open(self.path, 'r+b') as f:
+                f.set_pipelined(True)
+                while True:
+                    item = ranges.get()
+                    if item is None:
+                        got_sentinel = True
+                        break
+                    offset, data = item
+                    upload_limit.consume(len(data))
+                    f.seek(offset)
+                    f.write(data)
+                # Closing waits for the replies to the pipelined writes, so
+                # errors like a full disk often only show up here
+        except BaseException as e:
+            self.error = e
+            # Keep consuming, so that the reader never blocks on a full queue
+            if not got_sentinel:
+                while ranges.get() is not None:
+                    pass
+        finally:
+            if sftp is not None:
+                try:
+                    sftp.close()
+                except Exception as e:
+                    log.debug('Closing SFTP channel of stream %i failed: %s',
+                              index, e)
+
+    def _check_error(self):
+        if self.error:
+            raise IOError('Uploading range failed: {}'.format(
+                self.error)) from self.error
+
+    def run(self, src):
+        """
+        :param src: file object of the source, at position 0
+        :return: tuple of (md5 hex digest, size) of the data that was read
+        :rtype: tuple[str,int]
+        """
+        threads = [threading.Thread(target=self._stream, args=(i, q),
+                                    name='sftp-range-{}'.format(i),
+                                    daemon=True)
+                   for i, q in enumerate(self.queues)]
+        for thread in threads:
+            thread.start()
+        h = hashlib.md5()
+        offset = 0
+        try:
+            for i in itertools.count():
+                buf = src.read(RANGE_SIZE)
+                if not buf:
+                    break
+                self._check_error()
+                h.update(buf)
+                self.queues[i % len(self.queues)].put((offset, buf))
+                offset += len(buf)
+        finally:
+            for q in self.queues:
+                q.put(None)
+            for thread in threads:
+                thread.join()
+        self._check_error()
+        return str(h.hexdigest()), offset
+
+
 class SFTPBackend(BackendBase):
+    """Backend for repositories on an SSH server
+
+    Metadata operations (stat, mkdir, rename), the manifest and the hash
+    list go over a control transport. Object data goes over a separate bulk
+    transport that is tuned for throughput and only connected once the first
+    object is uploaded.
+
+    paramiko's SFTPClient cannot be shared between threads, so every thread
+    gets its own SFTP channels on the shared transports.
+
+    If `hashedbackup serve` can be run on the server, objects are uploaded
+    and listed through it instead (see hashedbackup.remote), with one round
+    trip per object instead of five. Every thread runs its own helper
+    session on the bulk transport.
 
-    sftp = None
+    Without the helper, large files are written over several connections
+    at once (see RangeUpload). The extra connections use the bulk settings
+    and are shared by all threads.
+    """
+
+    bulk_client = None
     last_actual_transfer_time = None
+    # None until the first attempt to start the remote helper
+    helper_available = None
 
     def __init__(self, remote_path, options):
         """
         :param str remote_path: like what `scp` accepts:
             user@host:/foo
             hostalias:backup/pictures
+            or an url like sftp://user@host:2222/foo
         :param str password: password or passphrase
         """
         self.options = options
         self.password = None # TODO: implement in options
-        self.hostname, self.path = remote_path.split(':', 1)
-        self.user = None
-        if '@' in self.hostname:
-            self.user, self.hostname = self.hostname.split('@')
+        self.port = None
+        if remote_path.startswith('sftp://'):
+            url = urllib.parse.urlsplit(remote_path)
+            self.hostname = url.hostname
+            self.user = url.username
+            self.port = url.port
+            self.path = urllib.parse.unquote(url.path) or '/'
+        else:
+            self.hostname, self.path = remote_path.split(':', 1)
+            self.user = None
+            if '@' in self.hostname:
+                self.user, self.hostname = self.hostname.split('@')
         super().__init__(self.path, options)
 
         ssh_config = paramiko.SSHConfig()
+        config_path = getattr(options, 'ssh_config', None) or \
+            DEFAULT_SSH_CONFIG
         try:
-            ssh_config.parse(open(os.path.expanduser('~/.ssh/config')))
+            with open(os.path.expanduser(config_path)) as f:
+                ssh_config.parse(f)
         except FileNotFoundError:
-            pass
+            if config_path != DEFAULT_SSH_CONFIG:
+                raise
 
         self.config = ssh_config.lookup(self.hostname)
-        self.client = paramiko.SSHClient()
-        self.client.load_system_host_keys()
-        self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self.control_config = TransportConfig.from_options(options, 'control')
+        self.bulk_config = TransportConfig.from_options(options, 'bulk')
+        self.single_transport = getattr(
+            options, 'ssh_single_transport', False)
+        self.large_file_size = getattr(
+            options, 'ssh_large_file_size', None) or DEFAULT_LARGE_FILE_SIZE
+        self.large_file_streams = getattr(
+            options, 'ssh_large_file_streams', None) or \
+            DEFAULT_LARGE_FILE_STREAMS
+        # Connections of the streams after the first, see _stream_client()
+        self._stream_clients = []
 
         # Will allow us to skip some remote mkdir calls
         self._existing_object_dirs = set()
 
-        self._connect()
+        self.helper_command = getattr(options, 'remote_command', None) or \
+            DEFAULT_REMOTE_COMMAND
+        if getattr(options, 'no_remote_helper', False):
+            self.helper_available = False
+        self._helper_sessions = []
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.client = self._connect(self.control_config)
+        self._local.sftp = self._open_sftp(self.client, self.control_config)
+
+    @property
+    def sftp(self):
+        """SFTP client on the control transport for the calling thread"""
+        sftp = getattr(self._local, 'sftp', None)
+        if sftp is None:
+            sftp = self._open_sftp(self.client, self.control_config)
+            self._local.sftp = sftp
+        return sftp
+
+    @property
+    def bulk_sftp(self):
+        """SFTP client on the bulk transport for the calling thread
+
+        The bulk transport is connected on first use.
+        """
+        if self.single_transport:
+            return self.sftp
+        sftp = getattr(self._local, 'bulk_sftp', None)
+        if sftp is None:
+            sftp = self._open_sftp(self._get_bulk_client(), self.bulk_config)
+            self._local.bulk_sftp = sftp
+        return sftp
+
+    def _get_bulk_client(self):
+        if self.single_transport:
+            return self.client
+        with self._lock:
+            if self.bulk_client is None:
+                log.debug('Connecting bulk transport: %s', self.bulk_config)
+                self.bulk_client = self._connect(self.bulk_config)
+        return self.bulk_client
+
+    def _stream_client(self, index):
+        """Connection for a stream of a RangeUpload
+
+        The first stream uses the bulk transport, every other stream gets a
+        connection of its own, so that the streams do not share a cipher.
+
+        :rtype: paramiko.SSHClient
+        """
+        if index == 0 or self.single_transport:
+            return self._get_bulk_client()
+        with self._lock:
+            while len(self._stream_clients) < index:
+                log.debug('Connecting transport for upload stream %i: %s',
+                          len(self._stream_clients) + 1, self.bulk_config)
+                self._stream_clients.append(self._connect(self.bulk_config))
+            return self._stream_clients[index - 1]
+
+    @property
+    def helper(self):
+        """Remote helper session for the calling thread, or None if the
+        helper is not available on the server
+
+        :rtype: hashedbackup.remote.RemoteSession
+        """
+        if self.helper_available is False:
+            return None
+        session = getattr(self._local, 'helper', None)
+        if session is None:
+            session = self._start_helper()
+            if session is None:
+                return None
+            self._local.helper = session
+        return session
+
+    def _start_helper(self):
+        command = '{} {}'.format(self.helper_command, shlex.quote(self.path))
+        transport = self._get_bulk_client().get_transport()
+        channel = transport.open_session(
+            window_size=self.bulk_config.window_size,
+            max_packet_size=self.bulk_config.max_packet_size)
+        try:
+            channel.exec_command(command)
+            frames = FrameIO(channel.makefile('rb', MB),
+                             channel.makefile('wb', MB))
+            session = RemoteSession(frames, close=channel.close)
+        except (EOFError, IOError, ValueError, paramiko.SSHException) as e:
+            stderr = b''
+            if channel.recv_stderr_ready():
+                stderr = channel.recv_stderr(4096)
+            channel.close()
+            if self.helper_available is None:
+                log.verbose('Remote helper `%s` not available, using SFTP '
+                            '(%s %s)', command, e,
+                            stderr.decode('utf-8', 'replace').strip())
+            self.helper_available = False
+            return None
+
+        if self.helper_available is None:
+            log.verbose('Using remote helper `%s`', command)
+        self.helper_available = True
+        with self._lock:
+            self._helper_sessions.append(session)
+        return session
+
+    def flush(self):
+        with self._lock:
+            sessions = list(self._helper_sessions)
+        for session in sessions:
+            session.flush()
+
+    def release_threads(self):
+        with self._lock:
+            sessions = self._helper_sessions
+            self._helper_sessions = []
+            # The channels of all threads are closed once unreferenced
+            self._local = threading.local()
+        for session in sessions:
+            session.close()
+
+    @property
+    def connected(self):
+        for client in [self.client, self.bulk_client] + self._stream_clients:
+            if client is None:
+                continue
+            transport = client.get_transport()
+            if transport is None or not transport.is_active():
+                return False
+        return True
+
+    def close(self):
+        super().close()
+        with self._lock:
+            clients = [self.client, self.bulk_client] + self._stream_clients
+            self.bulk_client = None
+            self._stream_clients = []
+        for client in clients:
+            if client is not None:
+                client.close()
+
+    @property
+    def bulk_have_objects(self):
+        return self.helper is not None
+
+    def have_objects(self, hashes):
+        session = self.helper
+        if session is None:
+            return super().have_objects(hashes)
+        return session.have(list(hashes))
+
+    def _connect(self, transport_config):
+        """
+        :type transport_config: TransportConfig
+        :rtype: paramiko.SSHClient
+        """
+        client = paramiko.SSHClient()
+        client.load_system_host_keys()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
 
-    def _connect(self):
         if 'proxycommand' in self.config:
             proxy = paramiko.ProxyCommand(self.config['proxycommand'])
             # TODO: check this code, needed?
@@ -61,28 +475,39 @@ class SFTPBackend(BackendBase):
             proxy = None
 
         # Connect to server
-        # Compression will not speedup picture transfers, but will help for
-        # the initial remote hash download and for files that are compressible.
         # noinspection PyTypeChecker
-        self.client.connect(
+        client.connect(
             self.config.get('hostname', self.hostname),
             username=self.user or self.config.get('user', None),
             password=self.password,
-            port=self.config.get('port', SSH_PORT),
+            port=self.port or int(self.config.get('port', SSH_PORT)),
+            key_filename=self.config.get('identityfile'),
             sock=proxy,
-            compress=True)
-
-        transport = self.client.get_transport()
-        # https://github.com/paramiko/paramiko/issues/175
-        transport.window_size = 2147483647
-        # 512MB -> 4GB, this is a security degradation
-        transport.packetizer.REKEY_BYTES = pow(2, 32)
-
-        self.sftp = self.client.open_sftp()
+            compress=transport_config.compress,
+            transport_factory=transport_config.make_transport)
+
+        transport = client.get_transport()
+        transport.packetizer.REKEY_BYTES = REKEY_BYTES
+        log.debug('SSH transport: cipher %s, mac %s, compression %s',
+                  transport.remote_cipher, transport.remote_mac,
+                  transport_config.compress)
+        return client
+
+    @staticmethod
+    def _open_sftp(client, transport_config):
+        return paramiko.SFTPClient.from_transport(
+            client.get_transport(),
+            window_size=transport_config.window_size,
+            max_packet_size=transport_config.max_packet_size)
 
     def rename(self, src, dst):
         self.sftp.rename(src, dst)
 
+    def replace(self, src, dst):
+        # Needs the posix-rename@openssh.com extension, plain SFTP rename
+        # fails if dst exists
+        self.sftp.posix_rename(src, dst)
+
     def delete(self, path):
         self.sftp.unlink(path)
 
@@ -91,6 +516,11 @@ class SFTPBackend(BackendBase):
         f.set_pipelined(True)
         return f
 
+    def _open_bulk(self, *args, **kwargs):
+        f = self.bulk_sftp.open(*args, **kwargs)
+        f.set_pipelined(True)
+        return f
+
     def exists(self, path):
         try:
             self.sftp.stat(path)
@@ -105,13 +535,7 @@ class SFTPBackend(BackendBase):
         except OSError:
             return False
 
-    def add_object(self, fhash, fpath):
-        dst_path = self.object_path(fhash)
-        if self.exists(dst_path):
-            return False
-
-        size = os.path.getsize(fpath)
-
+    def _ensure_bucket(self, fhash):
         # Checking remotely for existence just adds roundtrips
         if fhash[:2] not in self._existing_object_dirs:
             # FIXME: We assume that the only reason for failure is it already
@@ -120,12 +544,110 @@ class SFTPBackend(BackendBase):
                 os.path.join(self.path, 'objects', fhash[:2]))
             self._existing_object_dirs.add(fhash[:2])
 
-        tmp = os.path.join(self.path, 'tmp', temp_filename())
+    def _remove_partial(self, tmp):
+        try:
+            self.sftp.unlink(tmp)
+        except (IOError, paramiko.SSHException) as e:
+            log.debug('Cannot remove partial upload %s: %s', tmp, e)
+
+    def _commit_object(self, tmp, dst_path, size):
+        self.record_object_format(dst_path)
+        self.sftp.rename(tmp, dst_path)
+
+        # Confirm remote size
+        s = self.sftp.stat(dst_path)
+        if s.st_size != size:
+            raise IOError('size mismatch in put!  %d != %d' % (s.st_size, size))
+
+    def _put_with_helper(self, session, fhash, fpath):
+        h = hashlib.md5()
+
+        def read_chunks(src, compress):
+            compressor = zlib.compressobj(COMPRESSION_LEVEL) \
+                if compress else None
+            while True:
+                buf = src.read(MB)
+                if not buf:
+                    break
+                h.update(buf)
+                if compressor:
+                    buf = compressor.compress(buf)
+                if buf:
+                    yield buf
+            if compressor:
+                yield compressor.flush()
 
         t0 = time.time()
-        with open(fpath, 'rb') as src:
-            with self.open(tmp, 'wb') as dst:
-                tmphash = copy_and_hash_fo(src, dst)
+        with open_source(fpath) as src:
+            src_size = os.fstat(src.fileno()).st_size
+            extents = find_extents(src, src_size)
+            if extents is not None:
+                codec = CODEC_SPARSE
+                chunks = iter_sparse_object(src, src_size, extents, h)
+            elif self.compress and probe_file(src):
+                codec = CODEC_ZLIB
+                chunks = read_chunks(src, True)
+            else:
+                codec = CODEC_RAW
+                chunks = read_chunks(src, False)
+            try:
+                added = session.put(fhash, throttled(chunks), codec=codec)
+            except RemoteError:
+                if h.hexdigest() != fhash:
+                    raise ValueError(
+                        'File {} hash does not match after copy!'.format(
+                            fpath))
+                raise
+        self.last_actual_transfer_time = time.time() - t0
+        return added
+
+    def add_object(self, fhash, fpath):
+        session = self.helper
+        if session is not None:
+            return self._put_with_helper(session, fhash, fpath)
+
+        size = os.path.getsize(fpath)
+        t0 = time.time()
+        with open_source(fpath) as src:
+            extents = find_extents(src, size)
+            compress = extents is None and self.compress and probe_file(src)
+            if extents is not None:
+                dst_path = self.object_path(fhash, SPARSE_SUFFIX)
+            elif compress:
+                dst_path = self.object_path(fhash, COMPRESSED_SUFFIX)
+            else:
+                dst_path = self.object_path(fhash)
+            if self.stored_form_exists(dst_path):
+                return False
+
+            self._ensure_bucket(fhash)
+            tmp = os.path.join(self.path, 'tmp', temp_filename())
+            with self._open_bulk(tmp, 'wb') as f:
+                dst = ThrottledWriter(f)
+                if extents is not None:
+                    tmphash = copy_sparse_and_hash(src, dst, size, extents)
+                    size = stored_size(extents)
+                elif compress:
+                    writer = CompressingWriter(dst)
+                    tmphash = copy_and_hash_fo(src, writer)
+                    writer.finish()
+                    size = writer.bytes_written
+                elif size < self.large_file_size or \
+                        self.large_file_streams < 2:
+                    tmphash = copy_and_hash_fo(src, dst)
+                else:
+                    tmphash = None
+            if tmphash is None:
+                # Written after the empty file is closed, so that its
+                # creation is complete before the streams open it
+                log.debug('Uploading %s over %i streams', fpath,
+                          self.large_file_streams)
+                upload = RangeUpload(self, tmp, self.large_file_streams)
+                try:
+                    tmphash, size = upload.run(src)
+                except BaseException:
+                    self._remove_partial(tmp)
+                    raise
         t1 = time.time()
         self.last_actual_transfer_time = t1 - t0
 
@@ -135,13 +657,34 @@ class SFTPBackend(BackendBase):
             raise ValueError(
                 'File {} hash does not match after copy!'.format(fpath))
 
-        self.sftp.rename(tmp, dst_path)
+        self._commit_object(tmp, dst_path, size)
+        return True
 
-        # Confirm remote size
-        s = self.sftp.stat(dst_path)
-        if s.st_size != size:
-            raise IOError('size mismatch in put!  %d != %d' % (s.st_size, size))
+    def add_object_data(self, fhash, data):
+        session = self.helper
+        if session is not None:
+            dst_path, payload = self.encode_object_data(fhash, data)
+            t0 = time.time()
+            codec = CODEC_ZLIB if dst_path.endswith(COMPRESSED_SUFFIX) \
+                else CODEC_RAW
+            upload_limit.consume(len(payload))
+            added = session.put(fhash, [payload], codec=codec)
+            self.last_actual_transfer_time = time.time() - t0
+            return added
+
+        dst_path, payload = self.encode_object_data(fhash, data)
+        if self.stored_form_exists(dst_path):
+            return False
+        self._ensure_bucket(fhash)
+        tmp = os.path.join(self.path, 'tmp', temp_filename())
+
+        t0 = time.time()
+        upload_limit.consume(len(payload))
+        with self._open_bulk(tmp, 'wb') as dst:
+            dst.write(payload)
+        self.last_actual_transfer_time = time.time() - t0
 
+        self._commit_object(tmp, dst_path, len(payload))
         return True
 
     def listdir(self, path):
@@ -150,7 +693,7 @@ class SFTPBackend(BackendBase):
     def isdir(self, path):
         return stat.S_ISDIR(self.sftp.stat(path).st_mode)
 
-    def get_object_hashes(self):
+    def scan_object_hashes(self):
         """Get object hashes on server
 
         This executes a remote shell command to get a list of hashes, since
@@ -169,6 +712,13 @@ class SFTPBackend(BackendBase):
         :return: set of hex hashes on server
         :rtype: set[str]
         """
+        session = self.helper
+        if session is not None:
+            log.verbose('Fetching remote file hashes from remote helper')
+            hashes = session.index()
+            self._existing_object_dirs.update(h[:2] for h in hashes)
+            return hashes
+
         # TODO: implement remote listdir
         hashes = set()
         cmd = """find '{}/objects' -type f | sed 's|.*/||'""".format(
@@ -183,10 +733,10 @@ class SFTPBackend(BackendBase):
             return set()
 
         for line in stdout:
-            line = line.strip()
-            if len(line) == 32:
-                hashes.add(line)
-                self._existing_object_dirs.add(line[:2])
+            fhash = parse_object_name(line.strip())
+            if fhash:
+                hashes.add(fhash)
+                self._existing_object_dirs.add(fhash[:2])
             else:
                 log.debug('Invalid hash in list, skipping: %s', line)
 
@@ -0,0 +1,109 @@
+"""Repository catalog with the latest manifest of every namespace
+
+Finding the latest backup by listing all manifest directories takes a round
+trip per namespace. The catalog is a small JSON file at the repository root
+that is rewritten after every backup:
+
+    {
+        "version": 1,
+        "namespaces": {
+            "laptop-pictures": {
+                "latest": "20170102-030405",
+                "created": 1483326245.0,
+                "hostname": "laptop",
+                "root": "/Users/me/Pictures",
+                "files": 1234,
+                "size": 5678901234
+            }
+        }
+    }
+
+It is only a cache of what the manifest directories contain, and it is
+lossy: backups update it without a lock, so of two backups that finish at
+the same time, one can overwrite the entry of the other. Manifests written
+by older versions have no entry either. Readers therefore list namespaces
+that have no entry, and an entry older than the real latest manifest at
+worst causes an extra backup. `list-manifests --refresh-catalog` rewrites
+the catalog from the manifest directories.
+"""
+import json
+import logging
+import os
+
+log = logging.getLogger(__name__)
+
+CATALOG_FILENAME = 'catalog.json'
+CATALOG_VERSION = 1
+
+
+def catalog_path(backend):
+    return os.path.join(backend.path, CATALOG_FILENAME)
+
+
+def read_catalog(backend):
+    """
+    :type backend: hashedbackup.backends.base.BackendBase
+    :return: dict of namespace to catalog entry, or None if there is no
+        usable catalog
+    """
+    try:
+        with backend.open(catalog_path(backend), 'rb') as f:
+            catalog = json.loads(f.read().decode('utf-8'))
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        log.warn('Ignoring unreadable catalog: %s', e)
+        return None
+    if catalog.get('version') != CATALOG_VERSION:
+        log.debug('Ignoring catalog with version %s', catalog.get('version'))
+        return None
+    return catalog['namespaces']
+
+
+def write_catalog(backend, namespaces):
+    """Atomically replace the catalog
+
+    :type backend: hashedbackup.backends.base.BackendBase
+    :param dict namespaces: namespace to catalog entry
+    """
+    data = json.dumps(dict(version=CATALOG_VERSION, namespaces=namespaces),
+                      indent=2, sort_keys=True)
+    tmp_path = backend.temppath()
+    with backend.open(tmp_path, 'wb') as f:
+        f.write(data.encode('utf-8'))
+    backend.replace(tmp_path, catalog_path(backend))
+
+
+def update_catalog(backend, namespace, entry):
+    """Set the catalog entry of a namespace after a backup
+
+    If there is no catalog yet, it is created from the manifest listing, so
+    that it also covers the other namespaces. This is a read-modify-write
+    without a lock, a concurrent update can be lost, see module docstring.
+
+    :type backend: hashedbackup.backends.base.BackendBase
+    :param str namespace: manifest namespace
+    :param dict entry: catalog entry, see module docstring
+    """
+    namespaces = read_catalog(backend)
+    if namespaces is None:
+        from hashedbackup.cmd_list_manifests import list_remote_manifests
+        namespaces = catalog_from_listing(list_remote_manifests(backend))
+    old = namespaces.get(namespace)
+    if old and old.get('latest', '') > entry['latest']:
+        # Another backup of this namespace finished after us
+        return
+    namespaces[namespace] = entry
+    write_catalog(backend, namespaces)
+
+
+def catalog_from_listing(manifests):
+    """Build catalog entries from a manifest listing
+
+    Stats are unknown for manifests that were not written by a backup that
+    updated the catalog, so only the latest id is set.
+
+    :param dict manifests: result of get_remote_manifests()
+    """
+    return {name: dict(latest=items[-1]['id'])
+            for name, items in manifests.items() if items}
@@ -1,12 +1,12 @@
 import argparse
+import importlib
 import sys
 
 import logging
-import colorlog
 
 
 # Add extra VERBOSE log level between DEBUG and INFO
-from hashedbackup.utils import parse_age
+from hashedbackup.utils import parse_age, parse_rate, parse_size
 
 VERBOSE = 15
 logging.addLevelName(VERBOSE, "VERBOSE")
@@ -15,12 +15,30 @@ def verbose(self, message, *args, **kws):
         self._log(VERBOSE, message, args, **kws)
 logging.Logger.verbose = verbose
 
-from hashedbackup import cmd_init, cmd_backup, cmd_list_manifests, \
-    cmd_backup_profile
+from hashedbackup.defaults import MANIFEST_VERSIONS, \
+    DEFAULT_MANIFEST_VERSION, DURABILITY_MODES, DEFAULT_DURABILITY, \
+    DEFAULT_FSYNC_BATCH, HASH_FETCH_MODES, DEFAULT_HASH_FETCH, \
+    SOURCE_CACHE_MODES, DEFAULT_SOURCE_CACHE
 
 
 log = logging.getLogger(__name__)
 
+# Subcommand to 'module:function'. Modules are only imported when their
+# command runs, so that quick commands do not pay for unused dependencies.
+COMMANDS = {
+    'init': 'hashedbackup.cmd_init:init',
+    'backup': 'hashedbackup.cmd_backup:backup',
+    'backup-profile': 'hashedbackup.cmd_backup_profile:backup_profile',
+    'list-manifests': 'hashedbackup.cmd_list_manifests:list_manifests',
+    'convert-manifests':
+        'hashedbackup.cmd_convert_manifests:convert_manifests',
+    'stats': 'hashedbackup.cmd_stats:stats',
+    'serve': 'hashedbackup.cmd_serve:serve',
+    'watch': 'hashedbackup.cmd_watch:watch',
+    'agent': 'hashedbackup.cmd_agent:agent',
+    'agent-ctl': 'hashedbackup.cmd_agent_ctl:agent_ctl',
+}
+
 parser = argparse.ArgumentParser(prog='hashedbackup')
 parser.add_argument('-u', '--uploaded', action='store_true',
     help='Log all files that were uploaded (even if not --verbose)')
@@ -34,6 +52,39 @@ parser.add_argument('--no-progress', action='store_true',
     help='Do not show progressbar (default if stderr is not a tty)')
 parser.add_argument('--no-color', action='store_true',
     help='Never use colors in output')
+parser.add_argument('--ssh-config', metavar='FILE',
+    help='SSH client configuration with host aliases and identity files '
+         '(default: ~/.ssh/config)')
+parser.add_argument('--ssh-ciphers', type=str,
+    help='SSH ciphers in order of preference, comma separated '
+         '(like aes128-gcm@openssh.com,aes128-ctr)')
+parser.add_argument('--ssh-macs', type=str,
+    help='SSH MACs in order of preference, comma separated '
+         '(ignored for AEAD ciphers like AES-GCM)')
+parser.add_argument('--ssh-window-size', type=int,
+    help='SSH channel window size in bytes (default: 2 GB for the bulk '
+         'transport)')
+parser.add_argument('--ssh-packet-size', type=int,
+    help='SSH channel max packet size in bytes (default: 32768)')
+parser.add_argument('--ssh-compression', default='auto',
+    choices=['auto', 'none', 'control', 'bulk', 'both'],
+    help='Which SSH transports use compression. With "auto" the control '
+         'transport is compressed and the bulk transport only if --compress '
+         'is not used.')
+parser.add_argument('--ssh-single-transport', action='store_true',
+    help='Use one SSH connection for both control and bulk traffic')
+parser.add_argument('--ssh-large-file-size', type=parse_size, metavar='SIZE',
+    help='Upload files from SIZE over several SSH connections at once, when '
+         'the remote helper is not used (default: 256M)')
+parser.add_argument('--ssh-large-file-streams', type=int, metavar='N',
+    help='Number of concurrent streams for large files, 1 disables them '
+         '(default: 4)')
+parser.add_argument('--remote-command', type=str,
+    help='Command that runs `hashedbackup serve` on SFTP servers '
+         '(default: "hashedbackup serve")')
+parser.add_argument('--no-remote-helper', action='store_true',
+    help='Always use plain SFTP, even if the server can run '
+         '`hashedbackup serve`')
 
 subparsers = parser.add_subparsers(
     dest='command',
@@ -52,10 +103,15 @@ p.add_argument('dst', type=str, help='backup destination')
 p.add_argument('-n', '--namespace', type=str,
     help='backup namespace (allows backups of different folders '
          'to share the same hash database)')
+p.add_argument('--refresh-catalog', action='store_true',
+    help='rewrite the repository catalog from the listed manifests')
 
 p = subparsers.add_parser('backup', help='backup a directory')
 p.add_argument('src', type=str, help='directory to backup')
-p.add_argument('dst', type=str, help='backup destination')
+p.add_argument('dst', type=str, nargs='+',
+    help='backup destination. With more than one, the tree is walked and '
+         'hashed once, and new file data is read once for all of them. '
+         'Every destination gets its own manifest.')
 p.add_argument('-n', '--namespace', type=str, required=True,
     help='backup namespace (allows backups of different folders '
          'to share the same hash database)')
@@ -74,6 +130,98 @@ p.add_argument('--hardlink', action='store_true',
 p.add_argument('--if-older-than', type=parse_age,
     help='Only backup if the last one is older than given age. '
          'Age format like "7d", "4h", "15m" or "30s"')
+p.add_argument('--exclude', action='append', metavar='PATTERN',
+    help='Exclude paths matching PATTERN, with the syntax of .gitignore '
+         '(like "node_modules/" or "*.tmp"). Can be used multiple times. '
+         '.hashedbackupignore files in the tree add rules for their '
+         'directory.')
+p.add_argument('--exclude-from', action='append', metavar='FILE',
+    help='Read exclude patterns from FILE, one per line')
+p.add_argument('--no-xattr-exclude', dest='xattr_exclude',
+    action='store_false',
+    help='Do not check every entry for the xattrs that exclude it from '
+         'backups, which saves a syscall per entry')
+p.add_argument('--trace', metavar='FILE',
+    help='Write a timing trace of all stages of every file to FILE, in the '
+         'Chrome trace event format (open in chrome://tracing or '
+         'https://ui.perfetto.dev)')
+p.add_argument('--cprofile', metavar='FILE',
+    help='Profile the main thread with cProfile and write the stats to FILE '
+         '(read with `python -m pstats FILE`)')
+p.add_argument('--hash-fetch', choices=HASH_FETCH_MODES,
+    default=DEFAULT_HASH_FETCH,
+    help='How to find the objects that are already in the repository: '
+         'fetch all hashes first (full), or start from the previous '
+         'manifest and check the other objects in batches (batched). '
+         'auto starts batched and fetches all hashes once many objects '
+         'needed a check (default: {})'.format(DEFAULT_HASH_FETCH))
+p.add_argument('--rescan-objects', action='store_true',
+    help='List all objects in the repository instead of reading its index, '
+         'and rebuild the index')
+p.add_argument('--journal', action='store_true',
+    help='Only process paths recorded as changed by `hashedbackup watch` '
+         'and copy all other entries from the previous manifest. Falls back '
+         'to a full walk if the journal is incomplete.')
+p.add_argument('--compress', action='store_true',
+    help='Store objects compressed if a quick probe of their data shows that '
+         'this saves space. This replaces SSH compression for SFTP '
+         'destinations.')
+p.add_argument('-j', '--jobs', type=int, default=1,
+    help='Number of files to hash and upload concurrently (default: 1)')
+p.add_argument('--max-read-rate', type=parse_rate, metavar='RATE',
+    help='Limit reading source files to RATE bytes per second, like "20M" '
+         'or "500k"')
+p.add_argument('--max-upload-rate', type=parse_rate, metavar='RATE',
+    help='Limit writing object data to the repository to RATE bytes per '
+         'second')
+p.add_argument('--limits-file', metavar='FILE',
+    help='Control file with "max_read_rate = RATE" and "max_upload_rate = '
+         'RATE" lines that override the limits. It is read again when it '
+         'changes and on SIGHUP, to change the limits of a running backup.')
+p.add_argument('--idle', action='store_true',
+    help='Run with the lowest CPU and I/O priority (nice 19, SCHED_IDLE '
+         'and the idle I/O class on Linux)')
+p.add_argument('--source-cache', choices=SOURCE_CACHE_MODES,
+    default=DEFAULT_SOURCE_CACHE,
+    help='How files are read, to keep the page cache for applications on '
+         'the host: "normal" reads through the page cache, "drop" evicts '
+         'what was read, "direct" bypasses the cache with O_DIRECT '
+         '(default: {})'.format(DEFAULT_SOURCE_CACHE))
+p.add_argument('--durability', choices=DURABILITY_MODES,
+    default=DEFAULT_DURABILITY,
+    help='How new objects and manifests in local repositories are synced '
+         'to disk: "none" leaves it to the OS, "batch" fsyncs objects in '
+         'groups before they become visible and "file" fsyncs every object '
+         '(default: {})'.format(DEFAULT_DURABILITY))
+p.add_argument('--fsync-batch', type=int, default=DEFAULT_FSYNC_BATCH,
+    help='Number of objects per fsync group for --durability batch '
+         '(default: {})'.format(DEFAULT_FSYNC_BATCH))
+p.add_argument('--manifest-version', type=int, choices=MANIFEST_VERSIONS,
+    default=DEFAULT_MANIFEST_VERSION,
+    help='Manifest format to write. Version 0 is JSON lines, version 1 is '
+         'a compact binary encoding that older versions of hashedbackup '
+         'cannot read (default: {})'.format(DEFAULT_MANIFEST_VERSION))
+
+p = subparsers.add_parser('convert-manifests',
+    help='Rewrite existing manifests in another manifest version')
+p.add_argument('dst', type=str, help='backup destination')
+p.add_argument('-n', '--namespace', type=str,
+    help='only convert manifests of this namespace')
+p.add_argument('--to-version', type=int, choices=MANIFEST_VERSIONS,
+    required=True, help='manifest version to convert to')
+
+p = subparsers.add_parser('stats',
+    help='Show the size, growth and deduplication of the backups in a '
+         'repository, from the summaries at the end of the manifests')
+p.add_argument('dst', type=str, help='backup destination')
+p.add_argument('-n', '--namespace', type=str,
+    help='only show this namespace')
+p.add_argument('--history', action='store_true',
+    help='Show every backup, to see the growth over time')
+p.add_argument('-j', '--jobs', type=int, default=4,
+    help='Number of manifests read at the same time. Manifests written by '
+         'older versions have no summary and are read completely '
+         '(default: 4)')
 
 p = subparsers.add_parser('backup-profile',
     help='Run a backup profile defined in ~/.hashedbackup/profiles')
@@ -85,6 +233,46 @@ p.add_argument('--if-older-than', type=parse_age,
     help='Only backup if the last one is older than given age. '
          'Age format like "7d", "4h", "15m" or "30s"')
 
+p = subparsers.add_parser('serve',
+    help='Serve a local repository to a client on stdin and stdout. This is '
+         'run on the server through SSH by the SFTP backend.')
+p.add_argument('path', type=str, help='repository to serve')
+p.add_argument('--durability', choices=DURABILITY_MODES,
+    default=DEFAULT_DURABILITY,
+    help='How new objects are synced to disk (default: {})'.format(
+        DEFAULT_DURABILITY))
+p.add_argument('--fsync-batch', type=int, default=DEFAULT_FSYNC_BATCH,
+    help='Number of objects per fsync group for --durability batch '
+         '(default: {})'.format(DEFAULT_FSYNC_BATCH))
+
+p = subparsers.add_parser('watch',
+    help='Watch a directory for changes (Linux only). This maintains a dirty '
+         'journal that allows `backup --journal` to skip unchanged subtrees.')
+p.add_argument('src', type=str, help='directory to watch')
+p.add_argument('--max-journal-size', type=int, default=64,
+    help='Maximum size of the journal in MB, a full walk is done when it '
+         'grows larger (default: 64)')
+
+p = subparsers.add_parser('agent',
+    help='Run the backup agent. It keeps the connections to the repositories '
+         'and their object hashes between backups, runs the profiles that '
+         'have a schedule key, like "schedule=4h", and the ones requested '
+         'with agent-ctl.')
+p.add_argument('--socket', metavar='PATH',
+    help='Unix socket to listen on (default: ~/.hashedbackup/agent.sock)')
+
+p = subparsers.add_parser('agent-ctl',
+    help='Control a running backup agent')
+p.add_argument('action', choices=['status', 'run', 'stop'],
+    help='"status" shows the profiles and destinations of the agent, "run" '
+         'backs up a profile now and "stop" stops the agent after the '
+         'running backup')
+p.add_argument('profile_name', nargs='?', type=str, help='profile to run')
+p.add_argument('--socket', metavar='PATH',
+    help='Unix socket of the agent (default: ~/.hashedbackup/agent.sock)')
+p.add_argument('--no-wait', action='store_true',
+    help='Only queue the backup, do not wait for it and show its log')
+
 
 class StderrProxy:
     """Proxy writes to sys.stderr
@@ -105,6 +293,7 @@ def setup_logging(options):
     handler = logging.StreamHandler(StderrProxy())
 
     if sys.__stderr__.isatty() and not options.no_color:
+        import colorlog
         formatter = colorlog.ColoredFormatter(
             "%(log_color)s%(levelname)-8s%(reset)s "
               "%(message_log_color)s%(message)s",
@@ -154,13 +343,8 @@ def main():
     setup_logging(options)
     log.debug("Command options: %s", options)
 
-    if options.command == 'init':
-        cmd_init.init(options)
-    elif options.command == 'backup':
-        cmd_backup.backup(options)
-    elif options.command == 'backup-profile':
-        cmd_backup_profile.backup_profile(options)
-    elif options.command == 'list-manifests':
-        cmd_list_manifests.list_manifests(options)
-    else:
+    if options.command not in COMMANDS:
         raise NotImplementedError(options.command)
+    module_name, func_name = COMMANDS[options.command].split(':')
+    func = getattr(importlib.import_module(module_name), func_name)
+    func(options)
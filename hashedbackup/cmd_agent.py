@@ -0,0 +1,456 @@
+"""Long-running backup agent
+
+Every backup run by cron pays for starting Python, connecting and
+authenticating to the repositories and finding out which objects they
+have. The agent keeps the backends of the destinations and the object
+hashes that a backup ended with (see WarmDestination) between backups, so
+that the next backup of a profile starts uploading right away.
+
+The agent runs the profiles in ~/.hashedbackup/profiles that have a
+schedule key, like "schedule=4h", at that interval, and any profile that
+`hashedbackup agent-ctl run` requests through its Unix socket (see
+cmd_agent_ctl for the protocol). Backups run one at a time, each in a new
+thread, so that the idle priority of a profile only applies to its own
+backup. The profiles file is read again for every backup.
+
+A scheduled backup skips the destinations whose last backup is more recent
+than the schedule, like --if-older-than, so restarting the agent does not
+cause extra backups.
+"""
+import argparse
+import json
+import logging
+import os
+import queue
+import signal
+import socketserver
+import sys
+import threading
+import time
+
+from hashedbackup.backends import get_backend
+from hashedbackup.cmd_agent_ctl import socket_path, send_request
+from hashedbackup.cmd_backup import WarmDestination, backup
+from hashedbackup.cmd_backup_profile import read_profiles, apply_profile, \
+    missing_keys
+from hashedbackup.utils import MB, parse_age
+
+log = logging.getLogger(__name__)
+
+# Seconds between checks for scheduled profiles that are due
+SCHEDULE_CHECK_INTERVAL = 60
+# Seconds after which a failed scheduled backup is tried again, if its
+# schedule is longer
+RETRY_AFTER = 15 * 60
+# Options that backends only read when they connect. Destinations that
+# profiles use with different values get their own backends.
+CONNECTION_KEYS = ('ssh_config', 'remote_command', 'compress', 'fsync_batch',
+                   'ssh_large_file_size', 'ssh_large_file_streams')
+
+
+class Job:
+    """A requested or scheduled backup of a profile"""
+
+    started = None
+    finished = None
+    ok = None
+    message = None
+
+    def __init__(self, profile_name, schedule=None):
+        """
+        :param datetime.timedelta schedule: interval of a scheduled backup
+        """
+        self.profile_name = profile_name
+        self.schedule = schedule
+        self.done = threading.Event()
+        # Callables that get every log line of the backup
+        self.listeners = []
+
+    @property
+    def state(self):
+        if self.finished is not None:
+            return 'done'
+        return 'running' if self.started is not None else 'queued'
+
+    def result(self):
+        return dict(profile=self.profile_name, state=self.state,
+                    scheduled=self.schedule is not None,
+                    started=self.started, finished=self.finished,
+                    ok=self.ok, message=self.message)
+
+
+class JobLogHandler(logging.Handler):
+    """Passes the log lines of the running backup to the clients that
+    wait for it"""
+
+    def __init__(self, job):
+        super().__init__()
+        self.job = job
+        self.setFormatter(logging.Formatter('%(levelname)-8s %(message)s'))
+
+    def emit(self, record):
+        line = self.format(record)
+        for listener in list(self.job.listeners):
+            listener(line)
+
+
+def summarize(command):
+    """
+    :type command: hashedbackup.cmd_backup.BackupCommand
+    :return: one line about what a backup did
+    """
+    if not command.destinations:
+        return 'skipped, the last backup is recent enough'
+    uploaded = sum(dest.uploaded for dest in command.destinations)
+    return '{:,} files, {:,.1f} MB uploaded to {} destination(s)'.format(
+        command.n_files + command.n_unchanged, uploaded / MB,
+        len(command.destinations))
+
+
+class Agent:
+
+    def __init__(self, options):
+        """
+        :param options: global options, the profiles add the backup options
+        """
+        self.options = options
+        self.started = time.time()
+        # (destination, values of CONNECTION_KEYS) to WarmDestination
+        self.warm = {}
+        self.queue = queue.Queue()
+        # Profile name to its queued or running Job
+        self.pending = {}
+        # Profile name to its last finished Job
+        self.last = {}
+        self.stopping = False
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        # Profiles with an invalid schedule that were logged already
+        self._invalid = set()
+
+    def submit(self, profile_name, schedule=None):
+        """Queue a backup of a profile, unless one is queued or running
+
+        :rtype: Job
+        """
+        with self._lock:
+            job = self.pending.get(profile_name)
+            if job is None:
+                job = Job(profile_name, schedule)
+                self.pending[profile_name] = job
+                self.queue.put(job)
+        return job
+
+    def schedules(self):
+        """
+        :return: dict of profile name to its schedule interval
+        """
+        profiles = read_profiles()
+        result = {}
+        for name in profiles.sections():
+            schedule = profiles[name].get('schedule')
+            if not schedule:
+                continue
+            try:
+                result[name] = parse_age(schedule)
+            except ValueError as e:
+                if name not in self._invalid:
+                    log.error('Invalid schedule in profile %s: %s', name, e)
+                    self._invalid.add(name)
+        return result
+
+    def next_due(self, profile_name, schedule):
+        """
+        :return: time at which a scheduled profile is due
+        :rtype: float
+        """
+        last = self.last.get(profile_name)
+        if last is None:
+            return self.started
+        interval = schedule.total_seconds()
+        if not last.ok:
+            interval = min(interval, RETRY_AFTER)
+        return last.finished + interval
+
+    def schedule_due(self):
+        now = time.time()
+        for name, schedule in sorted(self.schedules().items()):
+            if name not in self.pending and \
+                    self.next_due(name, schedule) <= now:
+                log.verbose('Scheduled backup of profile %s is due', name)
+                self.submit(name, schedule)
+
+    def scheduler(self):
+        while not self.stopping:
+            try:
+                self.schedule_due()
+            except Exception:
+                log.exception('Checking the schedules failed')
+            self._wakeup.wait(SCHEDULE_CHECK_INTERVAL)
+
+    def warm_destination(self, dst, options):
+        """
+        :return: tuple of (key, WarmDestination) with the kept state of a
+            destination, connected if needed
+        """
+        key = (dst,) + tuple(getattr(options, name, None)
+                             for name in CONNECTION_KEYS)
+        warm = self.warm.get(key)
+        if warm is not None and not warm.backend.connected:
+            log.info('Connection to %s was lost, connecting again', dst)
+            self.drop(key)
+            warm = None
+        if warm is None:
+            warm = WarmDestination(get_backend(dst, options, nocache=True))
+            self.warm[key] = warm
+        return key, warm
+
+    def drop(self, key):
+        warm = self.warm.pop(key)
+        try:
+            warm.close()
+        except Exception as e:
+            log.debug('Closing %s failed: %s', key[0], e)
+
+    def profile_options(self, job):
+        profiles = read_profiles()
+        if job.profile_name not in profiles:
+            raise ValueError('Profile {} not found'.format(job.profile_name))
+        profile = profiles[job.profile_name]
+        for key in missing_keys(profile):
+            raise ValueError('Profile missing key {}'.format(key))
+        options = argparse.Namespace(**vars(self.options))
+        apply_profile(profile, options)
+        options.progress = False
+        options.if_older_than = job.schedule
+        return options
+
+    def run_backup(self, job, options):
+        keys = []
+        warm = {}
+        try:
+            for dst in options.dst:
+                key, warm[dst] = self.warm_destination(dst, options)
+                keys.append(key)
+            return summarize(backup(options, warm=warm))
+        except BaseException:
+            # Connect again next time, in case the connection was the problem
+            for key in keys:
+                self.drop(key)
+            warm = {}
+            raise
+        finally:
+            for state in warm.values():
+                state.backend.release_threads()
+
+    def run_job(self, job):
+        handler = JobLogHandler(job)
+        logging.getLogger().addHandler(handler)
+        log.info('Starting %s backup of profile %s',
+                 'scheduled' if job.schedule else 'requested',
+                 job.profile_name)
+        try:
+            options = self.profile_options(job)
+        except ValueError as e:
+            job.ok = False
+            job.message = str(e)
+            options = None
+        try:
+            if options is not None:
+                job.message = self.run_backup(job, options)
+                job.ok = True
+        except SystemExit:
+            # The backup logged why
+            job.ok = False
+            job.message = 'see the log of the agent'
+        except Exception as e:
+            log.exception('Backup of profile %s failed', job.profile_name)
+            job.ok = False
+            job.message = str(e) or e.__class__.__name__
+        finally:
+            job.finished = time.time()
+            log.info('Backup of profile %s %s: %s', job.profile_name,
+                     'done' if job.ok else 'failed', job.message)
+            logging.getLogger().removeHandler(handler)
+
+    def runner(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            last = self.last.get(job.profile_name)
+            if last is not None:
+                # Manifest names have a resolution of one second
+                time.sleep(max(0, last.finished + 1 - time.time()))
+            job.started = time.time()
+            # A new thread for every backup, see module docstring
+            thread = threading.Thread(
+                target=self.run_job, args=(job,),
+                name='backup-{}'.format(job.profile_name))
+            thread.start()
+            thread.join()
+            with self._lock:
+                del self.pending[job.profile_name]
+                self.last[job.profile_name] = job
+            job.done.set()
+
+    def status(self):
+        schedules = self.schedules()
+        profiles = []
+        sections = read_profiles()
+        for name in sections.sections():
+            section = sections[name]
+            schedule = schedules.get(name)
+            job = self.pending.get(name) or self.last.get(name)
+            profiles.append(dict(
+                name=name,
+                schedule=section.get('schedule') if schedule else None,
+                last=job.result() if job else None,
+                next_due=self.next_due(name, schedule)
+                if schedule and name not in self.pending else None,
+            ))
+        destinations = [dict(dst=key[0], hashes=len(warm.hashes),
+                             have_all_hashes=warm.have_all_hashes,
+                             connected=warm.backend.connected)
+                        for key, warm in sorted(list(self.warm.items()),
+                                                key=lambda item: item[0][0])]
+        return dict(started=self.started, pid=os.getpid(),
+                    profiles=profiles, destinations=destinations)
+
+    def stop(self):
+        """Stop after the running backup, queued ones are not run"""
+        self.stopping = True
+        self._wakeup.set()
+        with self._lock:
+            while True:
+                try:
+                    job = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                job.finished = time.time()
+                job.ok = False
+                job.message = 'agent stopped'
+                job.done.set()
+            self.queue.put(None)
+
+    def close(self):
+        for key in list(self.warm):
+            self.drop(key)
+
+
+class AgentRequestHandler(socketserver.StreamRequestHandler):
+    """Handles one request from `hashedbackup agent-ctl`"""
+
+    def reply(self, **message):
+        self.wfile.write(json.dumps(message).encode('utf-8') + b'\n')
+        self.wfile.flush()
+
+    def send_log(self, line):
+        try:
+            self.reply(log=line)
+        except OSError:
+            # The client went away, the backup continues
+            pass
+
+    def handle(self):
+        try:
+            self.handle_request()
+        except (BrokenPipeError, ConnectionResetError):
+            log.debug('Client went away before the reply')
+
+    def handle_request(self):
+        agent = self.server.agent
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+            command = request['command']
+        except (ValueError, KeyError, TypeError):
+            self.reply(error='Invalid request')
+            return
+
+        if command == 'status':
+            self.reply(status=agent.status())
+        elif command == 'run':
+            if agent.stopping:
+                self.reply(error='The agent is stopping')
+                return
+            if not request.get('profile'):
+                self.reply(error='No profile given')
+                return
+            job = agent.submit(request['profile'])
+            if request.get('follow'):
+                job.listeners.append(self.send_log)
+                job.done.wait()
+                job.listeners.remove(self.send_log)
+            self.reply(result=job.result())
+        elif command == 'stop':
+            agent.stop()
+            self.reply(stopping=True)
+            # shutdown() waits for serve_forever(), which runs in another
+            # thread
+            threading.Thread(target=self.server.shutdown).start()
+        else:
+            self.reply(error='Unknown command: {}'.format(command))
+
+
+class AgentServer(socketserver.ThreadingMixIn,
+                  socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, agent):
+        self.agent = agent
+        super().__init__(path, AgentRequestHandler)
+
+
+def bind_socket(path, agent):
+    """Listen on path, which only the user can connect to
+
+    :rtype: AgentServer
+    """
+    if os.path.exists(path):
+        try:
+            list(send_request(path, dict(command='status')))
+        except OSError:
+            log.debug('Removing stale socket %s', path)
+            os.unlink(path)
+        else:
+            raise ValueError('An agent is already running on {}'.format(path))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    umask = os.umask(0o077)
+    try:
+        return AgentServer(path, agent)
+    finally:
+        os.umask(umask)
+
+
+def agent(options):
+    path = socket_path(options)
+    backup_agent = Agent(options)
+    try:
+        server = bind_socket(path, backup_agent)
+    except (OSError, ValueError) as e:
+        log.error('Cannot listen on %s: %s', path, e)
+        sys.exit(1)
+
+    def terminate(signum, frame):
+        log.info('Stopping after the running backup')
+        backup_agent.stop()
+        threading.Thread(target=server.shutdown).start()
+    signal.signal(signal.SIGTERM, terminate)
+
+    runner = threading.Thread(target=backup_agent.runner, name='runner')
+    runner.start()
+    scheduler = threading.Thread(target=backup_agent.scheduler,
+                                 name='scheduler', daemon=True)
+    scheduler.start()
+    log.info('Agent listening on %s', path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        log.info('Stopping after the running backup')
+        backup_agent.stop()
+    finally:
+        server.server_close()
+        os.unlink(path)
+        runner.join()
+        backup_agent.close()
+    log.info('Agent stopped')
@@ -0,0 +1,121 @@
+"""Client for a running backup agent, see cmd_agent
+
+Requests and replies are JSON objects, one per line, on the Unix socket of
+the agent:
+
+    {"command": "status"}           -> {"status": {...}}
+    {"command": "run", "profile": "pictures", "follow": true}
+                                    -> {"log": "INFO ..."} for every log
+                                       line of the run, then
+                                       {"result": {...}}
+    {"command": "stop"}             -> {"stopping": true}
+
+Errors are replied as {"error": "message"}.
+"""
+import json
+import logging
+import os
+import socket
+import sys
+import time
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SOCKET = '~/.hashedbackup/agent.sock'
+
+
+def socket_path(options):
+    return os.path.expanduser(
+        getattr(options, 'socket', None) or DEFAULT_SOCKET)
+
+
+def send_request(path, request):
+    """Send a request to the agent
+
+    :param str path: socket of the agent
+    :param dict request: see module docstring
+    :return: iterator over the reply messages
+    :raises OSError: if no agent is listening
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        with sock.makefile('rb') as f:
+            for line in f:
+                yield json.loads(line.decode('utf-8'))
+    finally:
+        sock.close()
+
+
+def format_time(timestamp):
+    if timestamp is None:
+        return ''
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+
+
+def format_result(result):
+    if result is None:
+        return ''
+    if result['state'] != 'done':
+        return result['state']
+    return '{} {}: {}'.format(format_time(result['finished']),
+                              'ok' if result['ok'] else 'FAILED',
+                              result['message'])
+
+
+def print_status(status):
+    from tabulate import tabulate
+    print('Agent running since {} (pid {})'.format(
+        format_time(status['started']), status['pid']))
+    rows = [[profile['name'], profile['schedule'] or '',
+             format_result(profile['last']),
+             format_time(profile['next_due'])]
+            for profile in status['profiles']]
+    if rows:
+        print()
+        print(tabulate(rows, headers=['profile', 'schedule', 'last run',
+                                      'next run']))
+    rows = [[dest['dst'], dest['hashes'],
+             'yes' if dest['have_all_hashes'] else 'no',
+             'yes' if dest['connected'] else 'no']
+            for dest in status['destinations']]
+    if rows:
+        print()
+        print(tabulate(rows, headers=['destination', 'known hashes',
+                                      'all', 'connected']))
+
+
+def agent_ctl(options):
+    path = socket_path(options)
+    if options.action == 'run':
+        if not options.profile_name:
+            log.error('Specify the profile to run')
+            sys.exit(1)
+        request = dict(command='run', profile=options.profile_name,
+                       follow=not options.no_wait)
+    else:
+        request = dict(command=options.action)
+
+    try:
+        for reply in send_request(path, request):
+            if 'log' in reply:
+                print(reply['log'], file=sys.stderr)
+            elif 'error' in reply:
+                log.error('%s', reply['error'])
+                sys.exit(1)
+            elif 'status' in reply:
+                print_status(reply['status'])
+            elif 'result' in reply:
+                result = reply['result']
+                if result['state'] != 'done':
+                    log.info('Backup of profile %s is %s',
+                             result['profile'], result['state'])
+                elif not result['ok']:
+                    # The log of the backup already says why
+                    sys.exit(1)
+            elif 'stopping' in reply:
+                log.info('Agent is stopping after the running backup')
+    except (FileNotFoundError, ConnectionRefusedError):
+        log.error('No agent is running on %s', path)
+        sys.exit(1)
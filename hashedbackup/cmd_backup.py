@@ -3,50 +3,397 @@ import sys
 import os
 import socket
 import logging
+import threading
 import time
 
-import progressbar
 from xattr import xattr
 
-from hashedbackup.cmd_list_manifests import get_remote_manifests
+from hashedbackup.catalog import update_catalog
+from hashedbackup.cmd_list_manifests import get_remote_manifests, \
+    get_latest_manifests
+from hashedbackup.excludes import IGNORE_FILE, build_matcher, \
+    read_rules_file
 from hashedbackup.fileinfo import FileInfo
-from hashedbackup.manifests import ManifestWriter
+from hashedbackup.hashindex import add_delta, DEFAULT_HASH_FETCH
+from hashedbackup.journal import DirtyJournal, reduce_dirty_paths
+from hashedbackup import sourceio
+from hashedbackup.manifests import ManifestWriter, ManifestReader, \
+    manifest_dir, DEFAULT_MANIFEST_VERSION
 from hashedbackup.backends import get_backend
+from hashedbackup.throttle import LimitsControl, set_idle_priority
+from hashedbackup.tracing import Tracer, NULL_TRACER
 from hashedbackup.utils import Timer
 
 MB = 1024 * 1024
 
-# These are system files/dirs that are unsafe or useless to backup
-IGNORED_ENTRIES = {'.DS_Store', '.Trashes' '.fseventsd', '.Spotlight-V100'}
 EXCLUDE_XATTR = [
     'com.apple.metadata:com_apple_backup_excludeItem',
     'nl.wojas.hashedbackup.exclude',
 ]
 
+# Number of existence checks after which --hash-fetch auto fetches all hashes
+AUTO_FULL_FETCH_CHECKS = 4096
+# Max number of hashes per existence check. The batch keeps the data of
+# small files in memory.
+CHECK_BATCH_SIZE = 128
+# Files up to this size that go to more than one destination are read into
+# memory once, instead of once per destination
+TEE_MAX_SIZE = 16 * MB
+# Age after which the hashes that a WarmDestination kept are fetched again,
+# to not keep checking objects that other clients added one by one
+WARM_HASHES_MAX_AGE = 24 * 3600
+
 log = logging.getLogger(__name__)
 
 
+class InodeEntry:
+    """Hash of an inode with multiple links, as seen in this run"""
+
+    __slots__ = ('path', 'fhash', 'size', 'mtime_ns')
+
+    def __init__(self, path):
+        self.path = path
+        self.fhash = None
+        self.size = None
+        self.mtime_ns = None
+
+    def matches(self, info):
+        """True if the hash is known and the inode did not change since"""
+        return (self.fhash is not None and self.size == info.size
+                and self.mtime_ns == info.st.st_mtime_ns)
+
+    def update(self, info):
+        self.fhash = info.filehash()
+        self.size = info.size
+        self.mtime_ns = info.st.st_mtime_ns
+
+
+class WarmDestination:
+    """Backend and known objects of a destination, kept between backups by
+    a long-running process like the agent
+
+    Objects are never removed from a repository, so the hashes stay valid.
+    """
+
+    # Time of the backup that started with a cold set of hashes
+    since = None
+
+    def __init__(self, backend):
+        """
+        :type backend: hashedbackup.backends.base.BackendBase
+        """
+        self.backend = backend
+        self.hashes = set()
+        self.have_all_hashes = False
+        # Namespaces whose previous manifest is included in the hashes
+        self.namespaces = set()
+
+    @property
+    def fresh(self):
+        return bool(self.hashes) and \
+            time.time() - self.since < WARM_HASHES_MAX_AGE
+
+    def remember(self, dest):
+        """Keep the hashes of a destination after its manifest was committed,
+        which made its objects durable
+
+        :type dest: Destination
+        """
+        if not dest.started_warm:
+            self.since = dest.command.start_time
+            self.namespaces = set()
+        self.hashes = dest.hashes
+        self.have_all_hashes = dest.have_all_hashes
+        self.namespaces.add(dest.options.namespace)
+
+    def close(self):
+        self.backend.close()
+
+
+class Destination:
+    """A repository that the backup is written to
+
+    Every destination has its own backend, set of known objects and
+    manifest. The walk and the hashing are shared by all of them.
+    """
+
+    n_objects_added = 0
+    n_objects_exist = 0
+    n_checked = 0
+    uploaded = 0
+
+    manifest = None
+
+    # True once self.hashes contains all objects in the repository
+    have_all_hashes = False
+    # True if the hashes came from an earlier backup of this process
+    started_warm = False
+
+    def __init__(self, command, dst, warm=None):
+        """
+        :type command: BackupCommand
+        :param str dst: repository path or url
+        :param WarmDestination warm: state kept from earlier backups
+        """
+        self.command = command
+        self.options = command.options
+        self.tracer = command.tracer
+        self.dst = dst
+        self.warm = warm
+        self.hashes = set()
+        # Objects in the repository that are not in its index yet
+        self.new_hashes = set()
+        if warm is not None:
+            self.backend = warm.backend
+            # It was connected for an earlier backup with other options
+            self.backend.options = self.options
+        else:
+            self.backend = get_backend(dst, self.options)
+        log.debug('Storage backend for %s is %s', dst,
+                  self.backend.__class__.__name__)
+
+    def open_manifest(self):
+        self.manifest = ManifestWriter(
+            self.backend, self.options.namespace,
+            version=getattr(self.options, 'manifest_version',
+                            DEFAULT_MANIFEST_VERSION),
+            tracer=self.tracer)
+        # TODO: move to ManifestWriter?
+        header = dict(
+            version=self.manifest.version,
+            created=self.manifest.dt.replace(
+                tzinfo=datetime.timezone.utc).timestamp(),
+            created_human=str(self.manifest.dt),
+            hostname=socket.gethostname(),
+            root=self.command.root
+        )
+        if self.command.journal_position is not None:
+            # Where the next backup with --journal reads the changes from
+            header['journal'] = self.command.journal_position
+        self.manifest.add(**header)
+
+    def close_manifest(self):
+        # TODO: move to ManifestWriter?
+        self.manifest.add(
+            eof=True
+        )
+        with self.tracer.span('manifest commit'):
+            self.manifest.commit(summary=dict(
+                uploaded=self.uploaded,
+                new_objects=self.n_objects_added,
+            ))
+        log.verbose('Manifest saved to %s', self.manifest.manifest_path)
+        # The commit made the objects durable
+        with self.tracer.span('index update'):
+            add_delta(self.backend, self.new_hashes)
+        with self.tracer.span('catalog update'):
+            self.update_catalog()
+        if self.warm is not None:
+            self.warm.remember(self)
+
+    def update_catalog(self):
+        manifest_id = os.path.basename(
+            self.manifest.manifest_path).split('.', 1)[0]
+        entry = dict(
+            latest=manifest_id,
+            created=self.manifest.dt.replace(
+                tzinfo=datetime.timezone.utc).timestamp(),
+            hostname=socket.gethostname(),
+            root=self.command.root,
+            files=self.command.n_files + self.command.n_unchanged,
+            size=self.command.totalsize,
+        )
+        try:
+            update_catalog(self.backend, self.options.namespace, entry)
+        except (OSError, ValueError) as e:
+            # The manifest is what matters, the catalog is only a cache
+            log.warn('Updating the repository catalog failed: %s', e)
+
+    def is_recent(self):
+        """True if the last backup is more recent than --if-older-than"""
+        manifests = get_latest_manifests(self.options, self.backend)
+        for name, items in manifests.items():
+            assert name == self.options.namespace
+            if items:
+                last_backup_age = items[-1]['age']
+                if last_backup_age < self.options.if_older_than:
+                    log.info('Backup to %s skipped, because the last backup '
+                             'is recent enough (%s < %s)', self.dst,
+                             str(last_backup_age).split('.')[0],
+                             self.options.if_older_than)
+                    return True
+        return False
+
+    @property
+    def hash_fetch(self):
+        return getattr(self.options, 'hash_fetch', DEFAULT_HASH_FETCH)
+
+    def fetch_hashes(self):
+        """Fetch the hashes of all objects in the repository"""
+        with Timer("fetch repository hashes") as timer, \
+                self.tracer.span('fetch repository hashes'):
+            hashes = self.backend.get_object_hashes()
+            log.info('Fetching repository hashes of %s took %s for %i '
+                     'hashes', self.dst, timer.secs_str, len(hashes))
+        self.hashes.update(hashes)
+        self.have_all_hashes = True
+
+    def load_previous_hashes(self):
+        """
+        :return: the hashes in the previous manifest of the namespace, which
+            are all in the repository, or None if there is none
+        :rtype: set[str]
+        """
+        manifests = get_latest_manifests(self.options, self.backend)
+        items = manifests.get(self.options.namespace)
+        if not items:
+            return None
+        path = os.path.join(
+            manifest_dir(self.backend, self.options.namespace),
+            items[-1]['filename'])
+        hashes = set()
+        with ManifestReader(self.backend, path) as reader:
+            for record in reader:
+                if record.get('type') == 'f':
+                    hashes.add(record['hash'])
+        return hashes
+
+    def init_warm_hashes(self):
+        """Start from the hashes that earlier backups in this process kept
+
+        :return: False if there are none that fit --hash-fetch
+        """
+        warm = self.warm
+        if warm is None or not warm.fresh:
+            return False
+        if self.hash_fetch == 'full' and not warm.have_all_hashes:
+            return False
+        self.hashes = set(warm.hashes)
+        self.have_all_hashes = warm.have_all_hashes
+        if not self.have_all_hashes and \
+                self.options.namespace not in warm.namespaces:
+            self.hashes.update(self.load_previous_hashes() or ())
+        self.started_warm = True
+        log.info('Starting with %i hashes of %s from earlier backups',
+                 len(self.hashes), self.dst)
+        return True
+
+    def init_hashes(self):
+        """Find the known object hashes according to --hash-fetch"""
+        if self.init_warm_hashes():
+            return
+        if self.hash_fetch != 'full':
+            with Timer("load previous manifest") as timer, \
+                    self.tracer.span('load previous manifest'):
+                hashes = self.load_previous_hashes()
+            if hashes is not None or self.hash_fetch == 'batched':
+                self.hashes = hashes or set()
+                log.info('Checking objects in %s in batches, %i hashes '
+                         'from the previous manifest (took %s)', self.dst,
+                         len(self.hashes), timer.secs_str)
+                return
+            log.verbose('No previous manifest in %s, fetching all hashes',
+                        self.dst)
+        self.fetch_hashes()
+
+    def unknown_hashes(self, infos):
+        """
+        :param list[FileInfo] infos: prepared files
+        :return: hashes that need an existence check
+        :rtype: set[str]
+        """
+        if self.have_all_hashes:
+            return set()
+        return {info.filehash() for info in infos} - self.hashes
+
+    @property
+    def check_in_bulk(self):
+        """True if checking objects before adding them saves round trips.
+        Otherwise, add_object() checks them one by one."""
+        return self.backend.bulk_have_objects
+
+    def record_checked(self, checked, present):
+        """Record the result of an existence check
+
+        In auto mode, this fetches all hashes once too many objects needed a
+        check, because that is cheaper from then on.
+
+        :param set[str] checked: hashes that needed a check
+        :param set[str] present: those that are in the repository
+        """
+        self.hashes.update(present)
+        self.n_checked += len(checked)
+        if (self.hash_fetch == 'auto' and not self.have_all_hashes
+                and self.n_checked >= AUTO_FULL_FETCH_CHECKS):
+            log.info('%i objects needed an existence check, fetching all '
+                     'hashes instead', self.n_checked)
+            self.fetch_hashes()
+
+    def check_objects(self, infos):
+        """Check which objects of prepared files are in the repository"""
+        unknown = self.unknown_hashes(infos)
+        if not unknown:
+            return
+        present = set()
+        if self.check_in_bulk:
+            with self.tracer.span('have_objects', count=len(unknown)):
+                present = self.backend.have_objects(unknown)
+        self.record_checked(unknown, present)
+
+    def store_object(self, info, data):
+        """Add the object of a prepared file
+
+        :param bytes data: contents of the file if they are in memory
+        :return: True if added, False if it already existed
+        """
+        fhash = info.filehash()
+        if data is not None:
+            with self.tracer.span('add_object_data', size=info.size):
+                return self.backend.add_object_data(fhash, data)
+        with self.tracer.span('add_object', size=info.size):
+            return self.backend.add_object(fhash, info.fpath)
+
+    def record_object(self, info, added):
+        """Record that the object of a file is in the repository
+
+        :param bool added: True if the object was uploaded
+        """
+        fhash = info.filehash()
+        if fhash not in self.hashes:
+            self.hashes.add(fhash)
+            self.new_hashes.add(fhash)
+        if added:
+            self.n_objects_added += 1
+            self.uploaded += info.size
+        else:
+            self.n_objects_exist += 1
+
+
 class BackupCommand:
 
     options = None
     root = None
-    dst = None
     sftp = False
 
     totalsize = 0
     n_cached = 0
     n_updated = 0
-    n_objects_added = 0
-    n_objects_exist = 0
-    uploaded = 0
+    # Files recorded, and those of them added to any destination
+    n_files = 0
+    n_new_files = 0
+    n_unchanged = 0
+    n_linked = 0
     estimate = None
     progressbar = None
 
-    manifest_path = None
-    manifest_tmp = None
-    manifest = None
+    journal_position = None
+    dirty = None
 
-    def __init__(self, options):
+    def __init__(self, options, *, warm=None):
+        """
+        :param dict warm: destination to WarmDestination, for the
+            destinations that have state kept from earlier backups
+        """
         self.options = options
         self.start_time = time.time()
 
@@ -54,83 +401,159 @@ class BackupCommand:
             raise ValueError('Cannot combine --symlink and --hardlink')
 
         self.root = os.path.abspath(options.src)
-        self.dst = options.dst
-        self.hashes = set()
+        dsts = options.dst if isinstance(options.dst, list) \
+            else [options.dst]
+        if len(set(dsts)) < len(dsts):
+            raise ValueError('Destinations must be different')
+        self.tracer = Tracer() if getattr(options, 'trace', None) \
+            else NULL_TRACER
+        sourceio.configure(getattr(options, 'source_cache',
+                                   sourceio.DEFAULT_SOURCE_CACHE))
+        try:
+            self.excludes = build_matcher(
+                getattr(options, 'exclude', None) or [],
+                getattr(options, 'exclude_from', None) or [])
+        except OSError as e:
+            log.error('Could not read exclude rules: %s', e)
+            sys.exit(1)
+        self.xattr_exclude = getattr(options, 'xattr_exclude', True)
+        # (st_dev, st_ino) to InodeEntry of the files with hardlinks that
+        # were seen in this run
+        self.inodes = {}
+        self._inode_lock = threading.Lock()
 
         if options.progress:
+            import progressbar
             self.progressbar = progressbar.ProgressBar(
                 redirect_stderr=True,
                 redirect_stdout=True,
                 widgets=[
                     progressbar.widgets.Percentage(),
                     ' | ', progressbar.widgets.SimpleProgress(),
-                    ' | ', lambda *args: str(self.n_objects_added), ' new',
+                    ' | ', lambda *args: str(self.n_new_files), ' new',
                     ' ', progressbar.widgets.Bar(),
                     ' ', progressbar.widgets.Timer(format='Time: %(elapsed)s'),
                     ' ', progressbar.widgets.AdaptiveETA(samples=10),
                 ]
             )
 
-        self.backend = get_backend(self.dst, options)
-        log.debug('Storage backend is %s', self.backend.__class__.__name__)
+        warm = warm or {}
+        self.destinations = [Destination(self, dst, warm.get(dst))
+                             for dst in dsts]
 
-    def open_manifest(self):
-        self.manifest = ManifestWriter(self.backend, self.options.namespace)
-        # TODO: move to ManifestWriter?
-        self.manifest.add(
-            version=0,
-            created=self.manifest.dt.replace(
-                tzinfo=datetime.timezone.utc).timestamp(),
-            created_human=str(self.manifest.dt),
-            hostname=socket.gethostname(),
-            root=self.root
-        )
-
-    def close_manifest(self):
-        # TODO: move to ManifestWriter?
-        self.manifest.add(
-            eof=True
-        )
-        self.manifest.commit()
-        log.verbose('Manifest saved to %s', self.manifest.manifest_path)
+    def add_record(self, **record):
+        """Add a record to the manifests of all destinations"""
+        with self.tracer.span('manifest add'):
+            for dest in self.destinations:
+                dest.manifest.add(**record)
 
     def process_dir(self, relpath):
         dpath = os.path.join(self.root, relpath)
 
         try:
-            info = FileInfo(dpath)
+            with self.tracer.span('stat', path=relpath):
+                info = FileInfo(dpath)
         except FileNotFoundError:
             log.warn('Skipping dir (cannot stat): %s', relpath)
             return
 
-        self.manifest.add(
+        self.add_record(
             path=relpath,
             type='d',
             stat=info.stat_dict()
         )
 
-    def process_file(self, relpath):
+    def object_data(self, info, copies):
+        """Contents of a file to add it from memory instead of by path
+
+        Reads the data if it was not read while hashing. Files that are not
+        small are only read into memory if they are added to more than one
+        destination, so that they are read once for all of them.
+
+        :param int copies: number of destinations that need the object
+        :return: the data, or None to add the file by path
+        :rtype: bytearray
+        """
+        if self.options.symlink or self.options.hardlink:
+            return None
+        if info.is_small or (copies > 1 and info.size <= TEE_MAX_SIZE
+                             and not info.has_holes):
+            return info.read_data()
+        return None
+
+    def link_inode(self, relpath, info):
+        """Look up a file with hardlinks in the inode cache
+
+        All links to an inode get the path of the first one that was seen
+        as 'hardlink' key in the manifest, so that they can be restored as
+        links again. The inode is only hashed once, unless it changed
+        between the links.
+
+        :return: the entry of the inode, with the hash if already known
+        :rtype: InodeEntry
+        """
+        with self._inode_lock:
+            entry = self.inodes.get(info.inode_key)
+            if entry is None:
+                entry = self.inodes[info.inode_key] = InodeEntry(relpath)
+        info.hardlink = entry.path
+        if entry.matches(info):
+            info.use_hash(entry.fhash)
+        return entry
+
+    def prepare_file(self, relpath):
+        """Stat and hash a file
+
+        Apart from the inode cache of hardlinked files, which is locked, this
+        does not touch any state of the command, so it can be called from
+        worker threads.
+
+        :return: info with the hash calculated, or None if the file is skipped
+        :rtype: FileInfo
+        """
         fpath = os.path.join(self.root, relpath)
 
         try:
-            info = FileInfo(fpath)
+            with self.tracer.span('stat', path=relpath):
+                info = FileInfo(fpath)
         except FileNotFoundError:
             log.warn('Skipping broken symlink: %s', relpath)
-            return
+            return None
 
         if not info.is_regular:
             log.warn('Skipping non-regular file: %s', relpath)
-            return
-
-        self.totalsize += info.size
+            return None
 
         # We need the hash before we do any copying, because the decision to
         # copy depends on it. Otherwise, we could have used the hash from
         # copy_and_hash.
         # If network transfer is slower than local reads and/or the OS will
         # cache the whole file, this is not an issue.
+        # Small files are read only once, their data is kept for the upload.
+        entry = None
+        if info.is_hardlinked:
+            entry = self.link_inode(relpath, info)
+
+        with self.tracer.span('filehash', path=relpath, size=info.size):
+            if self.options.symlink or self.options.hardlink:
+                info.filehash()
+            else:
+                info.filehash(keep_data=True)
+        if entry is not None:
+            entry.update(info)
+        return info
+
+    def log_file(self, relpath, info):
+        """Count a prepared file and log it
+
+        :return: log arguments to repeat the message if it gets uploaded
+        :rtype: tuple
+        """
+        self.totalsize += info.size
         fhash = info.filehash()
-        if info.hash_from_cache:
+        if info.hash_from_link:
+            self.n_linked += 1
+        elif info.hash_from_cache:
             self.n_cached += 1
         else:
             self.n_updated += 1
@@ -141,104 +564,210 @@ class BackupCommand:
 
         log_fileinfo = (
             "[%6i%s] %s%s %s  %s",
-            self.n_objects_added + self.n_objects_exist + 1,
+            self.n_files + 1,
             total,
             fhash,
-            '+' if not info.hash_from_cache else ' ',
+            '+' if not (info.hash_from_cache or info.hash_from_link)
+            else ' ',
             '{:12,}'.format(info.size),
             relpath
         )
         log.verbose(*log_fileinfo)
+        return log_fileinfo
 
-        t0 = time.time()
-        if fhash in self.hashes:
-            added = False
-        else:
-            added = self.backend.add_object(fhash, fpath)
-        t1 = time.time()
-        if added:
+    def record_file(self, relpath, info, added, elapsed, log_fileinfo):
+        """Record the upload results of a file and add it to the manifests
+
+        :param dict[Destination,bool] added: True for the destinations that
+            the object was uploaded to, destinations that are not in it
+            already had the object
+        :param float elapsed: seconds spent on adding the object
+        """
+        fhash = info.filehash()
+        for dest in self.destinations:
+            dest.record_object(info, added.get(dest, False))
+        self.n_files += 1
+        if any(added.values()):
             if self.options.uploaded:
                 log.info(*log_fileinfo)
-            speed = '{:10,.1f} kB/s'.format(info.size / (t1 - t0) / 1024)
+            speed = '{:10,.1f} kB/s'.format(
+                info.size * sum(added.values()) / max(elapsed, 1e-6) / 1024)
             log.verbose('Upload speed: %s', speed)
-            self.n_objects_added += 1
-            self.uploaded += info.size
-        else:
-            self.n_objects_exist += 1
+            self.n_new_files += 1
 
         if self.progressbar:
-            self.progressbar.update(self.n_objects_exist + self.n_objects_added)
+            self.progressbar.update(self.n_files)
 
-        self.manifest.add(
+        record = dict(
             path=relpath,
             type='f',
             size=info.size,
             hash=fhash,
             stat=info.stat_dict()
         )
+        if info.hardlink is not None:
+            record['hardlink'] = info.hardlink
+        self.add_record(**record)
+        # Do not keep the data of small files around
+        info.data = None
+
+    def process_files(self, relpaths):
+        """Back up files, with one existence check for the whole batch"""
+        for i in range(0, len(relpaths), CHECK_BATCH_SIZE):
+            prepared = []
+            for relpath in relpaths[i:i + CHECK_BATCH_SIZE]:
+                info = self.prepare_file(relpath)
+                if info is not None:
+                    prepared.append((relpath, info))
+            for dest in self.destinations:
+                dest.check_objects([info for _, info in prepared])
+            for relpath, info in prepared:
+                self.store_file(relpath, info)
+
+    def process_file(self, relpath):
+        self.process_files([relpath])
+
+    def store_file(self, relpath, info):
+        """Add the object of a prepared file and record the file"""
+        with self.tracer.span('store_file', path=relpath):
+            log_fileinfo = self.log_file(relpath, info)
+
+            fhash = info.filehash()
+            t0 = time.time()
+            missing = [dest for dest in self.destinations
+                       if fhash not in dest.hashes]
+            added = {}
+            if missing:
+                # Larger files are added by path to one destination after
+                # the other, so that they are still in the page cache
+                data = self.object_data(info, len(missing))
+                for dest in missing:
+                    added[dest] = dest.store_object(info, data)
+            t1 = time.time()
+            self.record_file(relpath, info, added, t1 - t0, log_fileinfo)
 
     def on_walk_error(self, exc):
         assert isinstance(exc, OSError)
         log.warn('Could not list directory, skipping: %s', exc.filename)
 
-    def exclude_file(self, reldir, name, *, xa=None, quiet=False):
-        """Check if a file or dir needs to be excluded"""
-        path = os.path.join(self.root, reldir, name)
-        if name in IGNORED_ENTRIES:
-            if not quiet:
-                log.debug('Skipped (in IGNORED_ENTRIES): %s', path)
-            return True
+    def load_ignore_file(self, matcher, reldir):
+        """Add the rules of the ignore file in a directory
+
+        :type matcher: hashedbackup.excludes.ExcludeMatcher
+        :param str reldir: directory with an ignore file
+        :rtype: hashedbackup.excludes.ExcludeMatcher
+        """
+        path = os.path.join(self.root, reldir, IGNORE_FILE)
+        try:
+            return matcher.extend(read_rules_file(path, reldir))
+        except OSError as e:
+            log.warn('Could not read %s: %s', path, e)
+            return matcher
+
+    def excludes_for(self, reldir):
+        """Matcher for the entries of a directory, with the ignore files of
+        the directory and its parents
 
-        if name.startswith('._'):
+        :rtype: hashedbackup.excludes.ExcludeMatcher
+        """
+        matcher = self.excludes
+        parts = reldir.split('/') if reldir else []
+        for i in range(len(parts) + 1):
+            parent = '/'.join(parts[:i])
+            if os.path.isfile(os.path.join(self.root, parent, IGNORE_FILE)):
+                matcher = self.load_ignore_file(matcher, parent)
+        return matcher
+
+    def exclude_file(self, reldir, name, is_dir, matcher, *, quiet=False):
+        """Check if a file or dir needs to be excluded
+
+        :type matcher: hashedbackup.excludes.ExcludeMatcher
+        """
+        relpath = os.path.join(reldir, name)
+        if matcher.match(relpath, is_dir, name):
             if not quiet:
-                log.debug('Skipped (xattr storage): %s', path)
+                log.debug('Skipped (exclude rule): %s', relpath)
             return True
 
-        if not xa:
+        if not self.xattr_exclude:
+            return False
+
+        path = os.path.join(self.root, relpath)
+        with self.tracer.span('exclude_file', path=path):
             xa = xattr(path)
-        for attr in EXCLUDE_XATTR:
-            try:
-                xa.get(attr)
-            except IOError:
-                pass
-            else:
-                if not quiet:
-                    log.verbose('Skipped (%s): %s', attr, path)
-                return True
+            for attr in EXCLUDE_XATTR:
+                try:
+                    xa.get(attr)
+                except IOError:
+                    pass
+                else:
+                    if not quiet:
+                        log.verbose('Skipped (%s): %s', attr, path)
+                    return True
 
         return False
 
-    def walk_root(self, quiet=False):
+    def is_excluded(self, relpath):
+        """Check if a path or any of its parents needs to be excluded"""
+        parts = relpath.split('/')
+        reldir = ''
+        matcher = self.excludes
+        for i, name in enumerate(parts):
+            if os.path.isfile(os.path.join(self.root, reldir, IGNORE_FILE)):
+                matcher = self.load_ignore_file(matcher, reldir)
+            is_dir = i < len(parts) - 1 or \
+                os.path.isdir(os.path.join(self.root, relpath))
+            if self.exclude_file(reldir, name, is_dir, matcher, quiet=True):
+                return True
+            reldir = os.path.join(reldir, name)
+        return False
+
+    def walk_root(self, quiet=False, top=''):
         """
+        Exclude rules are applied to the names that os.walk() lists, before
+        anything else looks at the entries.
+
         :param bool quiet: disable logging (used by prescan)
+        :param str top: only walk this subdirectory (relative to the root)
         :return: Iterable of (dirs, files) with both as path relative to
                  the root
         :rtype: iterable[tuple[str,str]]
         """
         onerror = None if quiet else self.on_walk_error
+        # Matchers of the directories that the walk has yet to visit
+        pending = {}
         for dirname, dirs, files in os.walk(
-                self.root, onerror=onerror, followlinks=True):
+                os.path.join(self.root, top), onerror=onerror,
+                followlinks=True):
             assert isinstance(dirname, str)
             assert dirname.startswith(self.root)
             reldir = dirname[len(self.root):].lstrip('/')
 
+            matcher = pending.pop(reldir, None)
+            if matcher is None:
+                matcher = self.excludes_for(reldir)
+            elif IGNORE_FILE in files:
+                matcher = self.load_ignore_file(matcher, reldir)
+
             reldirs = []
             relfiles = []
 
-            for dname in dirs[:]:
-                if self.exclude_file(reldir, dname, quiet=quiet):
-                    # The dirs list is editable. Removing entries will prevent
-                    # recursing into them. This is officially supported by
-                    # os.walk().
-                    # FIXME: this does not seem to work correctly
-                    dirs.remove(dname)
+            kept = []
+            for dname in dirs:
+                if self.exclude_file(reldir, dname, True, matcher,
+                                     quiet=quiet):
                     continue
-
+                kept.append(dname)
                 relpath = os.path.join(reldir, dname)
                 reldirs.append(relpath)
+                pending[relpath] = matcher
+            # Editing the list in place keeps os.walk() from recursing into
+            # the excluded directories
+            dirs[:] = kept
 
             for fname in files:
-                if self.exclude_file(reldir, fname, quiet=quiet):
+                if self.exclude_file(reldir, fname, False, matcher,
+                                     quiet=quiet):
                     continue
 
                 relpath = os.path.join(reldir, fname)
@@ -246,25 +775,195 @@ class BackupCommand:
 
             yield reldirs, relfiles
 
-    @Timer("process_root")
-    def process_root(self):
-        for dirs, files in self.walk_root():
+    def process_tree(self, walker=None):
+        """
+        :param walker: iterable of (dirs, files) like walk_root(), the whole
+            root by default
+        """
+        if walker is None:
+            walker = self.walk_root()
+        for dirs, files in walker:
             for relpath in dirs:
                 self.process_dir(relpath)
 
-            for relpath in files:
-                self.process_file(relpath)
+            self.process_files(files)
+
+    def process_tree_concurrently(self, jobs, walker=None):
+        # Only needed with --jobs, asyncio is slow to import
+        import asyncio
+        from hashedbackup.backends.aio import get_async_backend
+        from hashedbackup.pipeline import BackupPipeline, default_hash_jobs
+
+        abackends = [get_async_backend(dest.backend, max_workers=jobs)
+                     for dest in self.destinations]
+        pipeline = BackupPipeline(
+            self, abackends,
+            hash_jobs=default_hash_jobs(jobs),
+            upload_jobs=jobs,
+            walker=walker)
+        try:
+            asyncio.run(pipeline.run())
+            # Releasing the threads closes their remote helper sessions,
+            # after which the manifest commit cannot flush them anymore
+            for dest in self.destinations:
+                dest.backend.flush()
+        finally:
+            pipeline.close()
+            for abackend in abackends:
+                abackend.close()
+            # The threads are gone, do not keep their SFTP channels open
+            for dest in self.destinations:
+                dest.backend.release_threads()
+
+    @Timer("process_root")
+    def process_root(self):
+        if self.dirty is not None:
+            self.process_dirty()
+        elif self.options.jobs > 1:
+            self.process_tree_concurrently(self.options.jobs)
+        else:
+            self.process_tree()
+
+    def process_dirty(self):
+        """Only process the dirty subtrees and copy all other entries from
+        the previous manifest
+        """
+        backend = self.destinations[0].backend
+        prev_path, subtrees = self.dirty
+        # The entries of these directories changed, so refresh their stat
+        parents = set()
+        for relpath in subtrees:
+            parent = os.path.dirname(relpath)
+            while parent:
+                parents.add(parent)
+                parent = os.path.dirname(parent)
+
+        def is_dirty(path):
+            while path:
+                if path in dirty_set:
+                    return True
+                path = os.path.dirname(path)
+            return False
+
+        dirty_set = set(subtrees)
+        with ManifestReader(backend, prev_path) as reader:
+            for record in reader:
+                path = record.get('path')
+                if path is None or is_dirty(path):
+                    continue
+                if path in parents and record['type'] == 'd':
+                    self.process_dir(path)
+                    continue
+                if record['type'] == 'f':
+                    self.totalsize += record['size']
+                    self.n_unchanged += 1
+                self.add_record(**record)
+
+        if self.options.jobs > 1:
+            self.process_tree_concurrently(self.options.jobs,
+                                           self.walk_dirty(subtrees))
+        else:
+            self.process_tree(self.walk_dirty(subtrees))
+
+    def walk_dirty(self, subtrees):
+        """Walk the dirty subtrees, see walk_root()
+
+        :param list[str] subtrees: dirty paths relative to the root
+        """
+        for relpath in subtrees:
+            if self.is_excluded(relpath):
+                continue
+            fpath = os.path.join(self.root, relpath)
+            if os.path.isdir(fpath):
+                yield [relpath], []
+                yield from self.walk_root(top=relpath)
+            elif os.path.lexists(fpath):
+                yield [], [relpath]
+
+    def load_dirty(self):
+        """Load the dirty journal maintained by `hashedbackup watch`
+
+        Also sets journal_position, the position in the journal that this
+        backup starts at, for the manifest headers.
+
+        :return: tuple of (previous manifest path, dirty subtrees), or None if
+                 a full walk is needed
+        """
+        journal = DirtyJournal(self.root)
+        if not journal.watcher_running():
+            log.warn('No watcher running for %s, doing a full walk',
+                     self.root)
+            return None
+
+        prev_path, header = self.previous_manifest()
+        # Every destination and namespace reads the changes since its own
+        # previous manifest, no matter what other backups did in between
+        self.journal_position, paths, overflow = journal.read(
+            header.get('journal'))
+        if prev_path is None:
+            return None
+        if header.get('root') != self.root:
+            log.info('Previous manifest has a different root, '
+                     'doing a full walk')
+            return None
+        if paths is None:
+            log.info('Previous manifest was not made with the current '
+                     'journal, doing a full walk')
+            return None
+        if overflow:
+            log.warn('Dirty journal overflowed (%s), doing a full walk',
+                     overflow)
+            return None
+
+        subtrees = reduce_dirty_paths(paths)
+        log.info('Dirty journal: %i changed paths in %i subtrees',
+                 len(paths), len(subtrees))
+        return prev_path, subtrees
+
+    def previous_manifest(self):
+        """
+        :return: tuple of (path of the manifest to copy unchanged entries
+                 from, its header), or (None, {}) if there is none
+        """
+        if len(self.destinations) > 1:
+            # The previous manifests of the destinations can be from
+            # different times, only one of them matches the journal
+            log.info('Dirty journal is only used with one destination, '
+                     'doing a full walk')
+            return None, {}
+        backend = self.destinations[0].backend
+
+        manifests = get_remote_manifests(self.options, backend)
+        items = manifests.get(self.options.namespace)
+        if not items:
+            log.info('No previous manifest, doing a full walk')
+            return None, {}
+        prev_path = os.path.join(
+            manifest_dir(backend, self.options.namespace),
+            items[-1]['filename'])
+
+        with ManifestReader(backend, prev_path) as reader:
+            header = reader.header or {}
+        return prev_path, header
 
     @Timer("estimate_work")
     def estimate_work(self):
         total_files = 0
-        for dirs, files in self.walk_root(quiet=True):
-            total_files += len(files)
+        if self.dirty is None:
+            tops = ['']
+        else:
+            tops = self.dirty[1]
+        for top in tops:
+            if top and os.path.isfile(os.path.join(self.root, top)):
+                total_files += 1
+            for dirs, files in self.walk_root(quiet=True, top=top):
+                total_files += len(files)
         return dict(total_files=total_files)
 
     @Timer("run")
     def run(self):
-        self.backend.check_destination_valid()
+        for dest in self.destinations:
+            dest.backend.check_destination_valid()
 
         if not os.path.exists(self.root):
             log.error('Location to backup does not exist: %s', self.root)
@@ -276,28 +975,24 @@ class BackupCommand:
             log.error('Location to backup is empty: %s', self.root)
             sys.exit(1)
 
-        # Skip backup if recent enough
+        # Skip destinations with a recent enough backup
         if self.options.if_older_than:
-            manifests = get_remote_manifests(self.options)
-            for name, items in manifests.items():
-                assert name == self.options.namespace
-                if items:
-                    last_backup_age = items[-1]['age']
-                    if last_backup_age < self.options.if_older_than:
-                        log.info('Backup skipped, because the last backup is '
-                                 'recent enough (%s < %s)',
-                                 str(last_backup_age).split('.')[0],
-                                 self.options.if_older_than)
-                        return
-
-        # To faster skip already uploaded objects, fetch hashes from server
-        with Timer("fetch repository hashes") as timer:
-            self.hashes = self.backend.get_object_hashes()
-            log.info('Fetching repository hashes took %s for %i hashes',
-                    timer.secs_str, len(self.hashes))
+            self.destinations = [dest for dest in self.destinations
+                                 if not dest.is_recent()]
+            if not self.destinations:
+                return
+
+        # To faster skip already uploaded objects, get the hashes that are
+        # in the repositories
+        for dest in self.destinations:
+            dest.init_hashes()
+
+        if self.options.journal:
+            self.dirty = self.load_dirty()
 
         try:
-            self.open_manifest()
+            for dest in self.destinations:
+                dest.open_manifest()
 
             if self.options.progress:
                 log.info('Estimating total number of files for progress bar...')
@@ -308,9 +1003,11 @@ class BackupCommand:
                 self.progressbar.start(self.estimate['total_files'])
 
             log.info('Backing up files...')
-            self.process_root()
+            with self.tracer.span('process_root'):
+                self.process_root()
 
-            self.close_manifest()
+            for dest in self.destinations:
+                dest.close_manifest()
             if self.progressbar:
                 self.progressbar.finish()
 
@@ -327,13 +1024,57 @@ class BackupCommand:
             display(self.totalsize / MB, float=True))
         log.info('File hashes: %s cached, %s hashed',
             display(self.n_cached), display(self.n_updated))
-        log.info('File data: %s added, %s already in repository',
-                 display(self.n_objects_added), display(self.n_objects_exist))
-        log.info('%s MB uploaded', display(self.uploaded / MB, float=True))
+        if self.n_linked:
+            log.info('Hardlinks: %s files not hashed again',
+                     display(self.n_linked))
+        if self.dirty is not None:
+            log.info('Files not in dirty journal: %s',
+                     display(self.n_unchanged))
+        for dest in self.destinations:
+            prefix = '{}: '.format(dest.dst) \
+                if len(self.destinations) > 1 else ''
+            log.info('%sFile data: %s added, %s already in repository',
+                     prefix, display(dest.n_objects_added),
+                     display(dest.n_objects_exist))
+            log.info('%s%s MB uploaded', prefix,
+                     display(dest.uploaded / MB, float=True))
         log.info('Execution time: %ss',
             display(time.time() - self.start_time, float=True))
 
 
-def backup(options):
-    BackupCommand(options).run()
+def run_profiled(func, path):
+    """Run func under cProfile and save the stats for pstats to path"""
+    import cProfile
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func)
+    finally:
+        profiler.dump_stats(path)
+        log.info('Profile saved to %s', path)
+
+
+def backup(options, *, warm=None):
+    """
+    :param dict warm: see BackupCommand
+    :rtype: BackupCommand
+    """
+    if getattr(options, 'idle', False):
+        # Before any threads start, they inherit it
+        set_idle_priority()
+    command = BackupCommand(options, warm=warm)
+    trace_path = getattr(options, 'trace', None)
+    profile_path = getattr(options, 'cprofile', None)
+    limits = LimitsControl(options)
+    limits.start()
+    try:
+        if profile_path:
+            run_profiled(command.run, profile_path)
+        else:
+            command.run()
+    finally:
+        limits.stop()
+        if trace_path:
+            command.tracer.save(trace_path)
+            log.info('Trace saved to %s', trace_path)
+    return command
 
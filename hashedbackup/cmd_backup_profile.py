@@ -1,11 +1,16 @@
+import argparse
 import os
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
 import logging
 import sys
 
-from tabulate import tabulate
-
-from hashedbackup.cmd_list_manifests import get_remote_manifests
+from hashedbackup.cmd_list_manifests import get_latest_manifests
+from hashedbackup.defaults import MANIFEST_VERSIONS, \
+    DEFAULT_MANIFEST_VERSION, DURABILITY_MODES, DEFAULT_DURABILITY, \
+    DEFAULT_FSYNC_BATCH, HASH_FETCH_MODES, DEFAULT_HASH_FETCH, \
+    SOURCE_CACHE_MODES, DEFAULT_SOURCE_CACHE
+from hashedbackup.utils import parse_rate, parse_size
 from .cmd_backup import backup
 
 log = logging.getLogger(__name__)
@@ -29,6 +34,9 @@ hashedbackup backup-profile pictures
 
 REQUIRED_KEYS = ['src', 'dst', 'namespace']
 
+# Max number of remotes queried at the same time for --age
+MAX_PARALLEL_REMOTES = 8
+
 def read_profiles():
     config = ConfigParser()
     path = os.path.expanduser('~/.hashedbackup/profiles')
@@ -37,28 +45,48 @@ def read_profiles():
     return config
 
 
+def profile_destinations(section):
+    """
+    :return: the destinations of a profile, one per line of its dst key
+    :rtype: list[str]
+    """
+    return [os.path.expanduser(dst) if dst.startswith('~') else dst
+            for dst in section.get('dst', fallback='').splitlines() if dst]
+
+
+def latest_backup_ages(remote, options):
+    """
+    :param str remote: repository destination
+    :return: dict of namespace to age string of the latest backup
+    """
+    log.verbose('Fetching latest manifests from remote %s', remote)
+    remote_options = argparse.Namespace(**vars(options))
+    remote_options.dst = remote
+    remote_options.namespace = None
+    manifests = get_latest_manifests(remote_options)
+    return {name: items[-1]['age_str']
+            for name, items in manifests.items() if items}
+
+
 def age_for_profiles(profiles, options):
     remotes = set()
     for name in profiles.sections():
-        section = profiles[name]
-        dst = section.get('dst', fallback=None)
-        if dst:
-            remotes.add(dst)
+        remotes.update(profile_destinations(profiles[name]))
+    if not remotes:
+        return {}
 
+    # Most time is spent waiting for the remotes, so query them in parallel
     ages = {}
-    for remote in remotes:
-        log.verbose('Fetching list of manifests from remote %s', remote)
-        ages[remote] = {}
-
-        # TODO: this is hacky - refactor get_remote_manifests
-        options.dst = remote
-        options.namespace = None
-        manifests = get_remote_manifests(options)
-
-        for name, items in manifests.items():
-            if not items:
-                continue
-            ages[remote][name] = items[-1]['age_str']
+    with ThreadPoolExecutor(max_workers=min(len(remotes),
+                                            MAX_PARALLEL_REMOTES)) as pool:
+        futures = {remote: pool.submit(latest_backup_ages, remote, options)
+                   for remote in remotes}
+        for remote, future in futures.items():
+            try:
+                ages[remote] = future.result()
+            except Exception as e:
+                log.error('Cannot get manifests from %s: %s', remote, e)
+                ages[remote] = {}
 
     return ages
 
@@ -74,25 +102,108 @@ def show_profiles(profiles, options):
     rows = []
     for name in profiles.sections():
         section = profiles[name]
-        dst = section.get('dst')
+        dsts = profile_destinations(section)
         namespace = section.get('namespace')
         row = [
             name,
             section.get('src'),
-            dst,
+            '\n'.join(dsts),
             namespace,
         ]
         if options.age:
-            row.append(ages.get(dst, {}).get(namespace, None))
+            row.append('\n'.join(
+                ages.get(dst, {}).get(namespace) or '' for dst in dsts))
 
         rows.append(row)
 
     if rows:
+        from tabulate import tabulate
         print(tabulate(rows, headers=headers))
     else:
         print(HELP)
 
 
+def apply_profile(profile, options):
+    """Set the backup options from a profile
+
+    :type profile: configparser.SectionProxy
+    :raises ValueError: if a setting is invalid
+    """
+    options.src = os.path.expanduser(profile['src'])
+    # One destination per line
+    options.dst = profile_destinations(profile)
+    options.namespace = os.path.expanduser(profile['namespace'])
+    options.symlink = profile.getboolean('symlink', fallback=False)
+    options.hardlink = profile.getboolean('hardlink', fallback=False)
+    options.journal = profile.getboolean('journal', fallback=False)
+    options.compress = profile.getboolean('compress', fallback=False)
+    # One pattern or file per line
+    options.exclude = profile.get('exclude', fallback='').splitlines()
+    options.exclude_from = [
+        os.path.expanduser(path) for path in
+        profile.get('exclude_from', fallback='').splitlines() if path]
+    options.xattr_exclude = profile.getboolean(
+        'xattr_exclude', fallback=True)
+    options.jobs = profile.getint('jobs', fallback=1)
+    options.manifest_version = profile.getint(
+        'manifest_version', fallback=DEFAULT_MANIFEST_VERSION)
+    if options.manifest_version not in MANIFEST_VERSIONS:
+        raise ValueError('Invalid manifest_version in profile: {}'.format(
+            options.manifest_version))
+    options.durability = profile.get(
+        'durability', fallback=DEFAULT_DURABILITY)
+    options.fsync_batch = profile.getint(
+        'fsync_batch', fallback=DEFAULT_FSYNC_BATCH)
+    options.hash_fetch = profile.get(
+        'hash_fetch', fallback=DEFAULT_HASH_FETCH)
+    if options.hash_fetch not in HASH_FETCH_MODES:
+        raise ValueError('Invalid hash_fetch in profile: {}'.format(
+            options.hash_fetch))
+    try:
+        options.max_read_rate = parse_rate(
+            profile.get('max_read_rate', fallback=''))
+        options.max_upload_rate = parse_rate(
+            profile.get('max_upload_rate', fallback=''))
+    except ValueError as e:
+        raise ValueError('Invalid rate in profile: {}'.format(e))
+    limits_file = profile.get('limits_file', fallback=None)
+    options.limits_file = os.path.expanduser(limits_file) \
+        if limits_file else None
+    options.idle = profile.getboolean('idle', fallback=False)
+    options.source_cache = profile.get(
+        'source_cache', fallback=DEFAULT_SOURCE_CACHE)
+    if options.source_cache not in SOURCE_CACHE_MODES:
+        raise ValueError('Invalid source_cache in profile: {}'.format(
+            options.source_cache))
+    # The command to run `hashedbackup serve` depends on the server
+    options.remote_command = profile.get(
+        'remote_command', fallback=options.remote_command)
+    options.ssh_config = profile.get(
+        'ssh_config', fallback=options.ssh_config)
+    try:
+        large_file_size = profile.get('ssh_large_file_size', fallback='')
+        if large_file_size:
+            options.ssh_large_file_size = parse_size(large_file_size)
+        options.ssh_large_file_streams = profile.getint(
+            'ssh_large_file_streams',
+            fallback=options.ssh_large_file_streams)
+    except ValueError as e:
+        raise ValueError('Invalid large file setting in profile: {}'.format(
+            e))
+    if options.durability not in DURABILITY_MODES:
+        raise ValueError('Invalid durability in profile: {}'.format(
+            options.durability))
+
+
+def missing_keys(profile):
+    """
+    :return: the required keys that a profile does not set
+    :rtype: list[str]
+    """
+    return [key for key in REQUIRED_KEYS
+            if key not in profile or not profile[key]]
+
+
 def backup_profile(options):
     profiles = read_profiles()
     name = options.profile_name
@@ -104,20 +215,16 @@ def backup_profile(options):
         show_profiles(profiles, options)
     else:
         profile = profiles[name]
-        for key in REQUIRED_KEYS:
-            if not key in profile or not profile[key]:
-                log.error('Profile missing key %s', key)
-                print('Example section:')
-                print(EXAMPLE)
-                sys.exit(1)
-
-        options.src = os.path.expanduser(profile['src'])
-        if profile['dst'].startswith('~'):
-            options.dst = os.path.expanduser(profile['dst'])
-        else:
-            options.dst = profile['dst']
-        options.namespace = os.path.expanduser(profile['namespace'])
-        options.symlink = profile.getboolean('symlink', fallback=False)
-        options.hardlink = profile.getboolean('hardlink', fallback=False)
+        for key in missing_keys(profile):
+            log.error('Profile missing key %s', key)
+            print('Example section:')
+            print(EXAMPLE)
+            sys.exit(1)
+
+        try:
+            apply_profile(profile, options)
+        except ValueError as e:
+            log.error('%s', e)
+            sys.exit(1)
 
         backup(options)
@@ -0,0 +1,66 @@
+import logging
+import os
+
+from hashedbackup.backends import get_backend
+from hashedbackup.cmd_list_manifests import get_remote_manifests
+from hashedbackup.manifests import ManifestReader, ManifestWriter, \
+    manifest_dir
+from hashedbackup.utils import Timer
+
+log = logging.getLogger(__name__)
+
+
+def convert_manifest(backend, namespace, path, version):
+    """Rewrite a manifest in place with the given manifest version
+
+    :type backend: hashedbackup.backends.base.BackendBase
+    :param str namespace: manifest namespace
+    :param str path: full path of the manifest
+    :param int version: manifest version to convert to
+    :return: True if converted, False if it already had this version
+    """
+    with ManifestReader(backend, path) as reader:
+        header = reader.header
+        if header is None:
+            log.warn('Skipping empty manifest %s', path)
+            return False
+        if header.get('version') == version:
+            return False
+
+        writer = ManifestWriter(backend, namespace, version=version,
+                                path=path)
+        try:
+            header['version'] = version
+            writer.add(**header)
+            for record in reader:
+                writer.add(**record)
+        except BaseException:
+            writer.cancel()
+            raise
+    # Keep what only the backup knew, like the uploaded bytes
+    writer.commit(replace=True, summary=reader.summary)
+    return True
+
+
+def convert_manifests(options):
+    backend = get_backend(options.dst, options)
+    backend.check_destination_valid()
+    manifests = get_remote_manifests(options, backend)
+
+    n_converted = 0
+    n_skipped = 0
+    for name, items in sorted(manifests.items()):
+        dirname = manifest_dir(backend, name)
+        for item in items:
+            path = os.path.join(dirname, item['filename'])
+            timer = Timer()
+            if convert_manifest(backend, name, path, options.to_version):
+                n_converted += 1
+                log.info('Converted %s %s (%s)', name, item['id'],
+                         timer.msecs_str)
+            else:
+                n_skipped += 1
+                log.verbose('Skipped %s %s', name, item['id'])
+
+    log.info('Converted %s manifests to version %s, skipped %s',
+             n_converted, options.to_version, n_skipped)
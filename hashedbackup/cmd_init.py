@@ -21,7 +21,7 @@ def init_repo(backend):
     if not backend.exists(dst):
         if not backend.try_mkdir(dst):
             raise OSError("Could not create {}".format(dst))
-    for dirname in ('objects', 'tmp'):
+    for dirname in ('objects', 'tmp', 'index'):
         path = os.path.join(dst, dirname)
         if not backend.try_mkdir(path):
             raise OSError("Could not create {}".format(path))
@@ -2,31 +2,76 @@ import os
 import datetime
 import logging
 
-from tabulate import tabulate
-
 from hashedbackup.backends import get_backend
+from hashedbackup.catalog import read_catalog, write_catalog, \
+    catalog_from_listing
 from hashedbackup.utils import decode_namespace
 
 
 log = logging.getLogger(__name__)
 
 
-def get_remote_manifests(options):
-    backend = get_backend(options.dst, options)
-    backend.check_destination_valid()
+def manifest_info(dt_str, now):
+    """
+    :param str dt_str: manifest id, like 20170102-030405
+    :param datetime.datetime now: current time in UTC
+    :raises ValueError: if the id is invalid
+    """
+    dt = datetime.datetime.strptime(dt_str, '%Y%m%d-%H%M%S')
+    dt = dt.replace(tzinfo=datetime.timezone.utc)
+    dt_local = dt.astimezone(None)
+
+    age = now - dt
+    mm, ss = divmod(age.seconds, 60)
+    hh, mm = divmod(mm, 60)
+
+    return dict(
+        filename=dt_str + '.manifest.bz2',
+        id=dt_str,
+        utc=dt,
+        utc_str=str(dt).split('+')[0],
+        local=dt_local,
+        local_str=str(dt_local).split('+')[0],
+        age=age,
+        age_str='{:3}d {:2}h {:2}m'.format(age.days, hh, mm)
+    )
+
+
+def get_remote_manifests(options, backend=None):
+    if backend is None:
+        backend = get_backend(options.dst, options)
+        backend.check_destination_valid()
+    return list_remote_manifests(backend, options.namespace)
+
+
+def list_namespaces(backend):
+    """
+    :type backend: hashedbackup.backends.base.BackendBase
+    :return: dict of namespace to the name of its manifest directory
+    """
+    namespaces = {}
+    for ns in sorted(backend.listdir(os.path.join(backend.path,
+                                                  'manifests'))):
+        try:
+            namespaces[decode_namespace(ns)] = ns
+        except ValueError:
+            log.warn('Cannot parse namespace directory name: %s', ns)
+    return namespaces
+
+
+def list_remote_manifests(backend, namespace=None):
+    """List all manifests in the repository
 
+    :type backend: hashedbackup.backends.base.BackendBase
+    :param str namespace: only list this namespace
+    :return: dict of namespace to list of manifest info dicts, oldest first
+    """
     manifest_dict = {}
     manifests = os.path.join(backend.path, 'manifests')
     now = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc)
 
-    for ns in sorted(backend.listdir(manifests)):
-        try:
-            name = decode_namespace(ns)
-        except ValueError:
-            log.warn('Cannot parse namespace directory name: %s', ns)
-            continue
-
-        if options.namespace and name != options.namespace:
+    for name, ns in list_namespaces(backend).items():
+        if namespace and name != namespace:
             continue
 
         try:
@@ -42,34 +87,85 @@ def get_remote_manifests(options):
                 continue
 
             try:
-                dt_str = fname.split('.', 1)[0]
-                dt = datetime.datetime.strptime(dt_str, '%Y%m%d-%H%M%S')
+                info = manifest_info(fname.split('.', 1)[0], now)
             except ValueError:
                 log.warn('Cannot parse filename: %s', fname)
                 continue
-            dt = dt.replace(tzinfo=datetime.timezone.utc)
-            dt_local = dt.astimezone(None)
-
-            age = now - dt
-            mm, ss = divmod(age.seconds, 60)
-            hh, mm = divmod(mm, 60)
-
-            manifest_dict[name].append(dict(
-                filename=fname,
-                id=dt_str,
-                utc=dt,
-                utc_str=str(dt).split('+')[0],
-                local=dt_local,
-                local_str=str(dt_local).split('+')[0],
-                age=age,
-                age_str='{:3}d {:2}h {:2}m'.format(age.days, hh, mm)
-            ))
+            info['filename'] = fname
+            manifest_dict[name].append(info)
 
     return manifest_dict
 
 
+def get_latest_manifests(options, backend=None):
+    """Find the latest manifest of every namespace
+
+    This reads the repository catalog and only lists the manifest
+    directories if there is none. Namespaces that the catalog misses, which
+    a concurrent update can cause, are listed as well.
+
+    :return: dict of namespace to a list with the info dict of the latest
+        manifest, which includes the catalog entry as 'catalog' if available
+    """
+    if backend is None:
+        backend = get_backend(options.dst, options)
+        backend.check_destination_valid()
+
+    namespaces = read_catalog(backend)
+    if namespaces is None:
+        log.verbose('No catalog in %s, listing manifests', backend.path)
+        manifests = list_remote_manifests(backend, options.namespace)
+        return {name: items[-1:] for name, items in manifests.items()}
+
+    now = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc)
+    manifest_dict = {}
+    for name, entry in namespaces.items():
+        if options.namespace and name != options.namespace:
+            continue
+        try:
+            info = manifest_info(entry['latest'], now)
+        except (KeyError, ValueError):
+            log.warn('Invalid catalog entry for namespace %s', name)
+            continue
+        info['catalog'] = entry
+        manifest_dict[name] = [info]
+
+    if options.namespace:
+        missing = {options.namespace} - set(manifest_dict)
+    else:
+        missing = set(list_namespaces(backend)) - set(manifest_dict)
+    for name in sorted(missing):
+        items = list_remote_manifests(backend, name).get(name)
+        if items:
+            log.verbose('Namespace %s is missing from the catalog', name)
+            manifest_dict[name] = items[-1:]
+    return manifest_dict
+
+
+def refresh_catalog(backend, manifests):
+    """Correct the catalog with the result of a full listing"""
+    old = read_catalog(backend) or {}
+    listing = catalog_from_listing(manifests)
+    namespaces = dict(old)
+    for name, entry in listing.items():
+        if old.get(name, {}).get('latest') != entry['latest']:
+            namespaces[name] = entry
+    for name in set(old) - set(listing):
+        del namespaces[name]
+    if namespaces != old:
+        log.verbose('Updating outdated catalog')
+        write_catalog(backend, namespaces)
+
+
 def list_manifests(options):
-    manifests = get_remote_manifests(options)
+    backend = get_backend(options.dst, options)
+    backend.check_destination_valid()
+    manifests = list_remote_manifests(backend, options.namespace)
+    if getattr(options, 'refresh_catalog', False):
+        if options.namespace:
+            refresh_catalog(backend, list_remote_manifests(backend))
+        else:
+            refresh_catalog(backend, manifests)
 
     headers = ['Namespace', 'ID', 'Timestamp (UTC)', 'Timestamp (local)',
                'Age']
@@ -90,5 +186,6 @@ def list_manifests(options):
         return
 
     print()
+    from tabulate import tabulate
     print(tabulate(rows, headers=headers))
 
@@ -0,0 +1,20 @@
+import logging
+import os
+
+from hashedbackup.backends.local import LocalBackend
+from hashedbackup.remote import serve_stdio
+
+log = logging.getLogger(__name__)
+
+
+def serve(options):
+    # symlink and hardlink only make sense for local backups
+    options.symlink = False
+    options.hardlink = False
+    # Clients decide about compression and send the data in its stored form
+    options.compress = False
+
+    backend = LocalBackend(os.path.expanduser(options.path), options)
+    backend.check_destination_valid()
+    log.debug('Serving repository %s', backend.path)
+    serve_stdio(backend)
@@ -0,0 +1,176 @@
+"""Repository statistics from the manifest summaries
+
+Every manifest ends with a summary record (see ManifestWriter), which is
+read from the end of the file without decompressing the rest. Only
+manifests written by older versions, which have none, are read completely,
+several at a time.
+
+Sizes are those of the original file data. The stored size of a namespace
+is what its backups uploaded, objects that several namespaces share count
+for the one that added them first. Older manifests do not know what their
+backup uploaded, the stored size and deduplication then only cover the
+newer ones.
+"""
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from hashedbackup.backends import get_backend
+from hashedbackup.cmd_list_manifests import get_remote_manifests
+from hashedbackup.manifests import ManifestReader, SummaryCounter, \
+    manifest_dir, read_summary
+from hashedbackup.utils import MB, Timer
+
+log = logging.getLogger(__name__)
+
+DEFAULT_STATS_JOBS = 4
+
+
+def summarize_manifest(backend, path):
+    """Compute the summary of a manifest that has none by reading all of it
+
+    :rtype: dict
+    """
+    counter = SummaryCounter()
+    with ManifestReader(backend, path) as reader:
+        for record in reader:
+            counter.add(record)
+    return counter.summary()
+
+
+def manifest_summary(backend, path):
+    """
+    :return: the summary of a manifest, read from its end if it has one
+    :rtype: dict
+    """
+    summary = read_summary(backend, path)
+    if summary is None:
+        log.verbose('No summary in %s, reading the whole manifest', path)
+        summary = summarize_manifest(backend, path)
+    return summary
+
+
+def get_summaries(backend, manifests, jobs):
+    """
+    :param dict manifests: result of get_remote_manifests()
+    :param int jobs: number of manifests read concurrently
+    :return: dict of namespace to list of (manifest info, summary)
+    """
+    paths = [(name, item, os.path.join(manifest_dir(backend, name),
+                                       item['filename']))
+             for name, items in sorted(manifests.items()) for item in items]
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        summaries = pool.map(
+            lambda entry: manifest_summary(backend, entry[2]), paths)
+        result = {name: [] for name in manifests}
+        for (name, item, _), summary in zip(paths, summaries):
+            result[name].append((item, summary))
+    return result
+
+
+def mb(num):
+    return num / MB
+
+
+def dedup_ratio(logical, stored):
+    return logical / stored if stored else None
+
+
+def namespace_row(name, entries):
+    """
+    :param list entries: (manifest info, summary) of a namespace, oldest
+        first
+    :return: the table row and the totals of the namespace, which are the
+        number of backups, size of the latest, size of the backups that know
+        what they uploaded and that upload size
+    """
+    latest = entries[-1][1]
+    known = [summary for _, summary in entries
+             if summary.get('uploaded') is not None]
+    logical = sum(summary['size'] for summary in known)
+    stored = sum(summary['uploaded'] for summary in known)
+    row = [
+        name if len(known) == len(entries) else name + '*',
+        len(entries),
+        latest['files'],
+        mb(latest['size']),
+        mb(latest['unique_size']),
+        mb(stored),
+        dedup_ratio(logical, stored),
+    ]
+    return row, (len(entries), latest['size'], logical, stored)
+
+
+def print_summary(summaries):
+    from tabulate import tabulate
+    headers = ['Namespace', 'Backups', 'Files', 'Size (MB)', 'Unique (MB)',
+               'Stored (MB)', 'Dedup ratio']
+    rows = []
+    totals = [0, 0, 0, 0]
+    incomplete = False
+    for name, entries in sorted(summaries.items()):
+        if not entries:
+            continue
+        row, counts = namespace_row(name, entries)
+        rows.append(row)
+        incomplete = incomplete or row[0] != name
+        totals = [a + b for a, b in zip(totals, counts)]
+    if not rows:
+        print('No manifests found.')
+        return
+
+    n_backups, size, logical, stored = totals
+    rows.append(['Total', n_backups, None, mb(size), None, mb(stored),
+                 dedup_ratio(logical, stored)])
+    print()
+    print(tabulate(rows, headers=headers, floatfmt=',.1f'))
+    print()
+    print('Size and Unique are of the latest backup, Stored is what all '
+          'backups uploaded.')
+    print('The dedup ratio is the size of all backups divided by Stored.')
+    if incomplete:
+        print('* Only counts the backups that recorded their upload size.')
+
+
+def print_history(summaries):
+    from tabulate import tabulate
+    headers = ['Namespace', 'ID', 'Files', 'Size (MB)', 'Change (MB)',
+               'Uploaded (MB)']
+    rows = []
+    for name, entries in sorted(summaries.items()):
+        prev = None
+        for item, summary in entries:
+            uploaded = summary.get('uploaded')
+            rows.append([
+                name,
+                item['id'],
+                summary['files'],
+                mb(summary['size']),
+                mb(summary['size'] - prev['size']) if prev else None,
+                mb(uploaded) if uploaded is not None else None,
+            ])
+            prev = summary
+    if not rows:
+        print('No manifests found.')
+        return
+    print()
+    print(tabulate(rows, headers=headers, floatfmt=',.1f'))
+
+
+def stats(options):
+    backend = get_backend(options.dst, options)
+    backend.check_destination_valid()
+    manifests = get_remote_manifests(options, backend)
+
+    with Timer('read summaries') as timer:
+        summaries = get_summaries(
+            backend, manifests,
+            getattr(options, 'jobs', DEFAULT_STATS_JOBS))
+    log.verbose('Reading %i manifest summaries took %s',
+                sum(len(items) for items in summaries.values()),
+                timer.secs_str)
+
+    if options.history:
+        print_history(summaries)
+    else:
+        print_summary(summaries)
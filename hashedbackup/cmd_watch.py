@@ -0,0 +1,141 @@
+import errno
+import os
+import sys
+import logging
+import time
+
+from hashedbackup.inotify import Inotify, IN_Q_OVERFLOW, IN_IGNORED, \
+    IN_CREATE, IN_MOVED_TO, IN_DELETE_SELF, IN_MOVE_SELF
+from hashedbackup.journal import DirtyJournal
+from hashedbackup.utils import MB, Timer
+
+log = logging.getLogger(__name__)
+
+
+class Watcher:
+    """Records changed paths below a root directory into a dirty journal"""
+
+    def __init__(self, root, journal, *, max_journal_size=64 * MB):
+        """
+        :param str root: absolute path to watch
+        :type journal: DirtyJournal
+        :param int max_journal_size: start a new journal above this size,
+            a full walk is cheaper by then
+        """
+        self.root = root
+        self.journal = journal
+        self.max_journal_size = max_journal_size
+        self.inotify = Inotify()
+        self.watches = {}
+        self.root_wd = None
+
+    def add_tree(self, reldir):
+        """Watch a directory and all its subdirectories
+
+        :return: False if we ran out of inotify watches
+        """
+        seen = set()
+        top = os.path.join(self.root, reldir)
+        for dirname, dirs, files in os.walk(top, followlinks=True):
+            try:
+                st = os.stat(dirname)
+            except OSError:
+                continue
+            # Symlink loops
+            if (st.st_dev, st.st_ino) in seen:
+                dirs[:] = []
+                continue
+            seen.add((st.st_dev, st.st_ino))
+
+            rel = dirname[len(self.root):].lstrip('/')
+            try:
+                wd = self.inotify.add_watch(dirname)
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    self.journal.mark_overflow(
+                        'inotify watch limit reached, increase '
+                        'fs.inotify.max_user_watches')
+                    return False
+                # Removed while walking, the parent event covers it
+                log.debug('Cannot watch %s: %s', dirname, e)
+                continue
+            self.watches[wd] = rel
+        return True
+
+    def handle_events(self, events):
+        """
+        :rtype: set[str]
+        :return: changed paths relative to the root
+        """
+        changed = set()
+        for event in events:
+            if event.mask & IN_Q_OVERFLOW:
+                self.journal.mark_overflow('inotify event queue overflow')
+                continue
+            reldir = self.watches.get(event.wd)
+            if reldir is None:
+                continue
+            if event.mask & IN_IGNORED:
+                del self.watches[event.wd]
+                continue
+            if event.wd == self.root_wd and event.mask & (
+                    IN_DELETE_SELF | IN_MOVE_SELF):
+                self.journal.mark_overflow('backup root was removed')
+                continue
+
+            path = os.path.join(reldir, event.name) if event.name else reldir
+            changed.add(path)
+            if event.is_dir and event.mask & (IN_CREATE | IN_MOVED_TO):
+                self.add_tree(path)
+        return changed
+
+    def record(self, changed):
+        try:
+            size = os.path.getsize(self.journal.journal_path)
+        except FileNotFoundError:
+            size = 0
+        if size > self.max_journal_size:
+            log.info('Journal larger than %i MB, starting a new one',
+                     self.max_journal_size // MB)
+            self.journal.reset(started=time.time())
+        self.journal.append(sorted(changed))
+
+    def run(self):
+        with Timer('add watches') as timer:
+            self.root_wd = self.inotify.add_watch(self.root)
+            self.watches[self.root_wd] = ''
+            self.add_tree('')
+            log.info('Watching %i directories (took %s)',
+                     len(self.watches), timer.secs_str)
+        # Only backups that start after this moment can use the journal
+        self.journal.reset(started=time.time())
+
+        while True:
+            changed = self.handle_events(self.inotify.read_events())
+            if changed:
+                log.verbose('%i paths changed', len(changed))
+                self.record(changed)
+
+
+def watch(options):
+    root = os.path.abspath(options.src)
+    if not os.path.isdir(root):
+        log.error('Location to watch is not a directory: %s', root)
+        sys.exit(1)
+
+    journal = DirtyJournal(root)
+    try:
+        journal.acquire_watcher_lock()
+    except BlockingIOError as e:
+        log.error('%s', e)
+        sys.exit(1)
+
+    try:
+        watcher = Watcher(root, journal,
+                          max_journal_size=options.max_journal_size * MB)
+        log.info('Recording changes in %s', journal.journal_path)
+        watcher.run()
+    except KeyboardInterrupt:
+        log.info('Stopped watching %s', root)
+    finally:
+        journal.release_watcher_lock()
@@ -0,0 +1,138 @@
+"""Per-object compression
+
+Objects are stored compressed only if a cheap probe on a sample of their data
+shows that this is worth it. Compressed objects get a suffix after their hash
+in the objects/ directory, so that their stored form is known without reading
+them.
+"""
+import hashlib
+import zlib
+
+from hashedbackup.utils import MB
+
+COMPRESSED_SUFFIX = '.zlib'
+
+# Amount of data used to decide if we compress
+PROBE_SIZE = 64 * 1024
+# Only compress if the sample shrinks to below this fraction
+PROBE_MIN_RATIO = 0.9
+# Do not bother for tiny files, the zlib overhead is larger than the gain
+MIN_SIZE = 512
+LEVEL = 6
+
+
+def is_compressible(sample):
+    """Probe if data is worth compressing
+
+    Uses the fastest zlib level, so that this costs a fraction of what the
+    actual compression would cost.
+
+    :param bytes sample: start of the data
+    :rtype: bool
+    """
+    sample = sample[:PROBE_SIZE]
+    if len(sample) < MIN_SIZE:
+        return False
+    return len(zlib.compress(sample, 1)) < len(sample) * PROBE_MIN_RATIO
+
+
+def probe_file(f):
+    """Probe a seekable file object, leaves the position at the start
+
+    :rtype: bool
+    """
+    sample = f.read(PROBE_SIZE)
+    f.seek(0)
+    return is_compressible(sample)
+
+
+def compress_data(data):
+    return zlib.compress(data, LEVEL)
+
+
+class CompressingWriter:
+    """File wrapper that compresses everything written to it"""
+
+    def __init__(self, f, level=LEVEL):
+        self.file = f
+        self.compressor = zlib.compressobj(level)
+        self.bytes_written = 0
+
+    def write(self, buf):
+        data = self.compressor.compress(buf)
+        if data:
+            self.file.write(data)
+            self.bytes_written += len(data)
+        return len(buf)
+
+    def finish(self):
+        """Write out the remaining compressed data, does not close the file"""
+        data = self.compressor.flush()
+        if data:
+            self.file.write(data)
+            self.bytes_written += len(data)
+
+
+class DecompressingReader:
+    """Readable file wrapper that transparently decompresses"""
+
+    def __init__(self, f, *, bufsize=1*MB):
+        self.file = f
+        self.bufsize = bufsize
+        self.decompressor = zlib.decompressobj()
+        self.pending = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.pending) < size:
+            if self.decompressor.eof:
+                break
+            # Limit the output per step, the input could be a zip bomb
+            buf = self.decompressor.unconsumed_tail
+            if not buf:
+                buf = self.file.read(self.bufsize)
+                if not buf:
+                    self.pending += self.decompressor.flush()
+                    break
+            self.pending += self.decompressor.decompress(buf, self.bufsize)
+        if size < 0:
+            size = len(self.pending)
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class DecompressingHasher:
+    """md5 of the original data, fed with the compressed data"""
+
+    def __init__(self, *, bufsize=1*MB):
+        self.bufsize = bufsize
+        self.decompressor = zlib.decompressobj()
+        self.hash = hashlib.md5()
+
+    def update(self, buf):
+        """
+        :raises ValueError: if the data is not a valid zlib stream
+        """
+        # Limit the output per step, like DecompressingReader
+        try:
+            while buf:
+                self.hash.update(
+                    self.decompressor.decompress(buf, self.bufsize))
+                buf = self.decompressor.unconsumed_tail
+        except zlib.error as e:
+            raise ValueError('Invalid compressed data: {}'.format(e))
+
+    def hexdigest(self):
+        try:
+            self.hash.update(self.decompressor.flush())
+        except zlib.error as e:
+            raise ValueError('Invalid compressed data: {}'.format(e))
+        return self.hash.hexdigest()
@@ -0,0 +1,31 @@
+"""Choices and defaults of command line options
+
+These live in a module without dependencies, so that parsing the command
+line does not import the modules that use them.
+"""
+
+# Version 0 is JSON lines, version 1 the compact encoding from manifest_v1.
+# Older versions of hashedbackup cannot read version 1, so it is opt-in.
+MANIFEST_VERSIONS = (0, 1)
+DEFAULT_MANIFEST_VERSION = 0
+
+# How backends that control durability sync new data to disk:
+#   none   leave it to the OS
+#   batch  fsync objects in groups before they get their final name
+#   file   fsync every object before it gets its final name
+DURABILITY_MODES = ('none', 'batch', 'file')
+DEFAULT_DURABILITY = 'batch'
+DEFAULT_FSYNC_BATCH = 256
+
+# How a backup finds out which objects are in the repository:
+#   full     fetch the hashes of all objects before the backup
+#   batched  start from the hashes in the previous manifest and check the
+#            other ones in batches while backing up
+#   auto     batched, until many hashes needed a check, then full. Full if
+#            there is no previous manifest.
+HASH_FETCH_MODES = ('auto', 'full', 'batched')
+DEFAULT_HASH_FETCH = 'auto'
+
+# How source files are read, see sourceio
+SOURCE_CACHE_MODES = ('normal', 'drop', 'direct')
+DEFAULT_SOURCE_CACHE = 'normal'
@@ -0,0 +1,245 @@
+"""Exclude rules with gitignore syntax
+
+Rules come from `backup --exclude` and `--exclude-from`, the `exclude` and
+`exclude_from` profile keys, and `.hashedbackupignore` files in the backed
+up tree, which apply to the directory they are in:
+
+    # comment
+    node_modules/       only directories
+    *.tmp               in any directory
+    /build              only at the top of the directory of the rules
+    logs/**/*.gz        anchored, ** matches any number of directories
+    !keep.tmp           include again what an earlier rule excluded
+
+The last matching rule wins, and rules of deeper ignore files come after
+those of their parents. Like with git, nothing inside an excluded directory
+can be included again, because it is never walked.
+
+All rules are compiled into a few regular expressions, so an entry is
+matched with one or two regex calls, whatever the number of rules, and
+without any syscalls.
+"""
+import logging
+import re
+
+log = logging.getLogger(__name__)
+
+IGNORE_FILE = '.hashedbackupignore'
+
+# System files that are unsafe or useless to back up, and AppleDouble files
+# with the xattrs of other files
+DEFAULT_RULES = ['.DS_Store', '.Trashes', '.fseventsd', '.Spotlight-V100',
+                 '._*']
+
+
+class Rule:
+    """One parsed exclude rule"""
+
+    __slots__ = ('pattern', 'negated', 'dir_only', 'anchored', 'regex')
+
+    def __init__(self, pattern, negated, dir_only, anchored, regex):
+        self.pattern = pattern
+        self.negated = negated
+        self.dir_only = dir_only
+        # Anchored rules match the path, the others only the name
+        self.anchored = anchored
+        self.regex = regex
+
+    def __repr__(self):
+        return 'Rule({!r})'.format(self.pattern)
+
+
+def _translate(glob):
+    """Regex source for a glob without leading or trailing slash"""
+    parts = []
+    i = 0
+    n = len(glob)
+    while i < n:
+        c = glob[i]
+        if glob.startswith('**/', i) and (i == 0 or glob[i - 1] == '/'):
+            parts.append('(?:.*/)?')
+            i += 3
+            continue
+        if glob.startswith('**', i) and i + 2 == n and \
+                (i == 0 or glob[i - 1] == '/'):
+            parts.append('.*')
+            i += 2
+            continue
+        if c == '*':
+            parts.append('[^/]*')
+        elif c == '?':
+            parts.append('[^/]')
+        elif c == '\\' and i + 1 < n:
+            i += 1
+            parts.append(re.escape(glob[i]))
+        elif c == '[':
+            # A ] right after the [ or the negation is part of the set
+            first = i + 2 if glob[i + 1:i + 2] in ('!', '^') else i + 1
+            end = glob.find(']', first + 1)
+            if end < 0:
+                parts.append(re.escape(c))
+            else:
+                body = glob[i + 1:end].replace('\\', '\\\\').replace(
+                    '[', '\\[')
+                if body[:1] in ('!', '^'):
+                    body = '^' + body[1:]
+                parts.append('(?!/)[' + body + ']')
+                i = end
+        else:
+            parts.append(re.escape(c))
+        i += 1
+    return ''.join(parts)
+
+
+def parse_rule(line, base=''):
+    """
+    :param str line: one line of rules
+    :param str base: directory the rule applies to, relative to the root
+    :return: the rule, or None for blank lines and comments
+    :rtype: Rule
+    """
+    line = line.rstrip('\n')
+    # Trailing spaces are ignored unless escaped
+    stripped = line.rstrip(' ')
+    if stripped.endswith('\\') and len(stripped) < len(line):
+        stripped += ' '
+    line = stripped
+    if not line or line.startswith('#'):
+        return None
+    pattern = line
+    negated = line.startswith('!')
+    if negated:
+        line = line[1:]
+    elif line.startswith('\\#') or line.startswith('\\!'):
+        line = line[1:]
+    dir_only = line.endswith('/')
+    line = line.rstrip('/')
+    if not line:
+        return None
+    anchored = '/' in line
+    line = line.lstrip('/')
+    regex = _translate(line)
+    if anchored and base:
+        regex = re.escape(base + '/') + regex
+    return Rule(pattern, negated, dir_only, anchored, regex)
+
+
+def parse_rules(lines, base=''):
+    """
+    :param iterable[str] lines: rules, one per line
+    :param str base: directory the rules apply to, relative to the root
+    :rtype: list[Rule]
+    """
+    rules = []
+    for line in lines:
+        rule = parse_rule(line, base)
+        if rule is not None:
+            rules.append(rule)
+    return rules
+
+
+def read_rules_file(path, base=''):
+    """
+    :param str path: file with one rule per line
+    :rtype: list[Rule]
+    :raises OSError: if the file cannot be read
+    """
+    with open(path, encoding='utf-8', errors='surrogateescape') as f:
+        return parse_rules(f, base)
+
+
+def _combine(regexes):
+    if not regexes:
+        return None
+    return re.compile('(?:{})\\Z'.format('|'.join(regexes)), re.DOTALL)
+
+
+class _Group:
+    """Consecutive rules with the same polarity, compiled together"""
+
+    __slots__ = ('negated', 'name', 'path', 'dir_name', 'dir_path')
+
+    def __init__(self, negated, rules):
+        self.negated = negated
+
+        def select(anchored, dir_only):
+            return _combine([rule.regex for rule in rules
+                             if rule.anchored == anchored and
+                             rule.dir_only == dir_only])
+        self.name = select(False, False)
+        self.path = select(True, False)
+        self.dir_name = select(False, True)
+        self.dir_path = select(True, True)
+
+    def matches(self, relpath, name, is_dir):
+        if self.name is not None and self.name.match(name):
+            return True
+        if self.path is not None and self.path.match(relpath):
+            return True
+        if is_dir:
+            if self.dir_name is not None and self.dir_name.match(name):
+                return True
+            if self.dir_path is not None and self.dir_path.match(relpath):
+                return True
+        return False
+
+
+class ExcludeMatcher:
+    """Decides which paths are excluded, see the module docstring
+
+    Matchers are immutable, extend() gives a new one for a subtree.
+    """
+
+    def __init__(self, rules=()):
+        """
+        :param list[Rule] rules: in order of increasing precedence
+        """
+        self.rules = list(rules)
+        self._groups = []
+        start = 0
+        for i in range(1, len(self.rules) + 1):
+            if i == len(self.rules) or \
+                    self.rules[i].negated != self.rules[start].negated:
+                self._groups.append(_Group(self.rules[start].negated,
+                                           self.rules[start:i]))
+                start = i
+        # Last rules first
+        self._groups.reverse()
+
+    def extend(self, rules):
+        """
+        :param list[Rule] rules: rules that take precedence
+        :rtype: ExcludeMatcher
+        """
+        if not rules:
+            return self
+        return ExcludeMatcher(self.rules + rules)
+
+    def match(self, relpath, is_dir, name=None):
+        """
+        :param str relpath: path relative to the root
+        :param bool is_dir: the path is a directory
+        :param str name: last component of relpath, if known
+        :return: True if the path is excluded
+        """
+        if name is None:
+            name = relpath.rpartition('/')[2]
+        for group in self._groups:
+            if group.matches(relpath, name, is_dir):
+                return not group.negated
+        return False
+
+
+def build_matcher(patterns=(), files=()):
+    """Matcher with the default rules and those of the options
+
+    :param list[str] patterns: rules, like from --exclude
+    :param list[str] files: paths of files with rules
+    :rtype: ExcludeMatcher
+    :raises OSError: if a file cannot be read
+    """
+    rules = parse_rules(DEFAULT_RULES)
+    for path in files:
+        rules.extend(read_rules_file(path))
+    rules.extend(parse_rules(patterns))
+    return ExcludeMatcher(rules)
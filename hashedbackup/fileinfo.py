@@ -6,6 +6,8 @@ import logging
 
 from xattr import xattr
 
+from hashedbackup.sourceio import open_source
+from hashedbackup.sparse import find_extents, hash_extents
 from hashedbackup.utils import lookup_user, lookup_group
 
 log = logging.getLogger(__name__)
@@ -13,6 +15,8 @@ log = logging.getLogger(__name__)
 MB = 1024 * 1024
 TO_NANO = 1000000000
 ATTR = 'nl.wojas.hashedbackup'
+# Files below this size are read only once and kept in memory for the upload
+SMALL_FILE_SIZE = 256 * 1024
 
 
 class FileInfo:
@@ -24,6 +28,12 @@ class FileInfo:
         self.xattr = xattr(fpath)
         self._hash = None
         self.hash_from_cache = None
+        # True if the hash was taken from another link to the same inode
+        self.hash_from_link = False
+        # File contents, only for small files
+        self.data = None
+        # Path of the first file in the backup with the same inode
+        self.hardlink = None
 
     @property
     def is_regular(self):
@@ -37,9 +47,32 @@ class FileInfo:
     def mode(self):
         return int(oct(stat.S_IMODE(self.st.st_mode))[2:]) # strip '0o'
 
-    def _load_xattr(self):
+    @property
+    def is_small(self):
+        return self.size < SMALL_FILE_SIZE
+
+    @property
+    def has_holes(self):
+        """True if less than the size is allocated, like for sparse files"""
+        return self.st.st_blocks * 512 < self.size
+
+    @property
+    def is_hardlinked(self):
+        return self.st.st_nlink > 1
+
+    @property
+    def inode_key(self):
+        return self.st.st_dev, self.st.st_ino
+
+    def use_hash(self, fhash):
+        """Set the hash of another link to the same inode"""
+        self._hash = fhash
+        self.hash_from_link = True
+
+    def _load_xattr(self, xa=None):
         try:
-            cached = json.loads(self.xattr.get(ATTR).decode('ascii'))
+            xa = xa or self.xattr
+            cached = json.loads(xa.get(ATTR).decode('ascii'))
         except IOError:
             return None
         else:
@@ -49,7 +82,7 @@ class FileInfo:
                 return cached['md5']
         return None
 
-    def _save_xattr(self, fhash):
+    def _save_xattr(self, fhash, xa=None):
         new_cached = dict(
             mt=self.st.st_mtime_ns // TO_NANO,
             mtns=self.st.st_mtime_ns % TO_NANO,
@@ -57,23 +90,93 @@ class FileInfo:
             size=self.size
         )
         try:
-            self.xattr.set(ATTR, json.dumps(new_cached).encode('ascii'))
+            xa = xa or self.xattr
+            xa.set(ATTR, json.dumps(new_cached).encode('ascii'))
         except IOError:
             log.verbose('Could not write xattr to %s', self.fpath)
 
     def _calc_filehash(self, bufsize=1*MB):
+        with open_source(self.fpath) as f:
+            extents = find_extents(f, self.size)
+            if extents is not None:
+                # Do not read the holes
+                return hash_extents(f, self.size, extents)
+            return self._hash_fo(f, bufsize)
+
+    @staticmethod
+    def _hash_fo(f, bufsize=1*MB):
         h = hashlib.md5()
-        with open(self.fpath, 'rb') as f:
+        buf = f.read(bufsize)
+        while buf:
+            h.update(buf)
             buf = f.read(bufsize)
-            while buf:
-                h.update(buf)
-                buf = f.read(bufsize)
         return str(h.hexdigest())
 
-    def filehash(self):
+    def _read_all(self, f):
+        """Read the file into a buffer of the size of the stat
+
+        The buffer is kept as the data, so it is never copied.
+
+        :return: the data, or None if the file grew since the stat
+        :rtype: bytearray
+        """
+        # One extra byte to detect files that grew
+        buf = bytearray(self.size + 1)
+        n = 0
+        with memoryview(buf) as view:
+            while n < len(buf):
+                count = f.readinto(view[n:])
+                if not count:
+                    break
+                n += count
+        if n == len(buf):
+            return None
+        # Shrinks in place, unlike slicing
+        del buf[n:]
+        return buf
+
+    def _small_filehash(self):
+        # Only open the file once: the xattr cache is accessed through the
+        # file descriptor and the data is kept for the upload.
+        with open_source(self.fpath, unbuffered=True) as f:
+            xa = xattr(f.fileno())
+            self._hash = self._load_xattr(xa)
+            if self._hash:
+                self.hash_from_cache = True
+                return self._hash
+
+            self.data = self._read_all(f)
+            if self.data is None:
+                f.seek(0)
+                self._hash = self._hash_fo(f)
+            else:
+                self._hash = str(hashlib.md5(self.data).hexdigest())
+            self._save_xattr(self._hash, xa)
+            self.hash_from_cache = False
+            return self._hash
+
+    def read_data(self):
+        """Read the contents of the file into self.data
+
+        :return: the data, or None if the file grew since the stat
+        :rtype: bytearray
+        """
+        if self.data is None:
+            with open_source(self.fpath, unbuffered=True) as f:
+                self.data = self._read_all(f)
+        return self.data
+
+    def filehash(self, keep_data=False):
+        """
+        :param bool keep_data: read a small file only once and keep its data
+            in self.data, unless the hash is cached
+        """
         if self._hash:
             return self._hash
 
+        if keep_data and self.is_small:
+            return self._small_filehash()
+
         # Try from xattr
         self._hash = self._load_xattr()
         if self._hash:
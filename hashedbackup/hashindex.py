@@ -0,0 +1,219 @@
+"""Packed index of the objects in a repository
+
+Listing `objects/` takes a `find` over all buckets on SFTP, or 256 listdir
+calls locally, which gets slow with millions of objects. Instead, clients
+read the `index/` directory of the repository:
+
+    index/packed            all object hashes at the time it was written
+    index/delta-<id>        hashes that one backup added to the repository,
+                            or found there that were not in the index yet
+
+Both kinds of files have the same format: MAGIC, a header with a timestamp
+and the number of hashes, the sorted 16 byte hashes, and the md5 of all
+that. The timestamp of the packed file is the time of the last full scan of
+`objects/`, that of a delta is when it was written.
+
+Once there are COMPACT_DELTAS deltas, a client merges them into a new
+packed file and removes them.
+
+Objects are never removed, and a delta is only written once the objects it
+lists are durable, so the index never lists objects that do not exist. It
+can miss objects, for example after a backup by an older version or an
+interrupted backup, which only costs an existence check when such an object
+is added again. To not let that accumulate, the objects are scanned again
+when the last full scan is older than RESCAN_AFTER, when the index is not
+readable, or with `backup --rescan-objects`.
+"""
+import binascii
+import hashlib
+import logging
+import os
+import struct
+import time
+
+from hashedbackup.defaults import HASH_FETCH_MODES, DEFAULT_HASH_FETCH
+from hashedbackup.utils import temp_filename
+
+log = logging.getLogger(__name__)
+
+INDEX_DIR = 'index'
+PACKED_NAME = 'packed'
+DELTA_PREFIX = 'delta-'
+MAGIC = b'HBX\x01'
+
+# Number of deltas after which they get merged into the packed file
+COMPACT_DELTAS = 16
+# Age of the last full scan after which objects are scanned again
+RESCAN_AFTER = 30 * 24 * 3600
+
+# Timestamp and number of hashes
+_header = struct.Struct('>dQ')
+
+
+def index_dir(backend):
+    return os.path.join(backend.path, INDEX_DIR)
+
+
+def encode_index(hashes, timestamp):
+    """
+    :param iterable[str] hashes: hex hashes
+    :param float timestamp: see module docstring
+    :rtype: bytes
+    """
+    packed = sorted(binascii.unhexlify(fhash) for fhash in hashes)
+    data = MAGIC + _header.pack(timestamp, len(packed)) + b''.join(packed)
+    return data + hashlib.md5(data).digest()
+
+
+def decode_index(data):
+    """
+    :param bytes data: contents of an index file
+    :return: tuple of (timestamp, list of hex hashes)
+    :raises ValueError: if the data is not a valid index file
+    """
+    start = len(MAGIC) + _header.size
+    if not data.startswith(MAGIC) or len(data) < start + 16:
+        raise ValueError('Not an index file')
+    body, checksum = data[:-16], data[-16:]
+    if hashlib.md5(body).digest() != checksum:
+        raise ValueError('Index file checksum mismatch')
+    timestamp, count = _header.unpack_from(body, len(MAGIC))
+    if len(body) - start != count * 16:
+        raise ValueError('Index file has wrong number of hashes')
+    hexed = binascii.hexlify(body[start:]).decode('ascii')
+    return timestamp, [hexed[i:i + 32] for i in range(0, len(hexed), 32)]
+
+
+def _read_file(backend, name):
+    with backend.open(os.path.join(index_dir(backend), name), 'rb') as f:
+        return decode_index(f.read())
+
+
+def _write_file(backend, name, hashes, timestamp):
+    path = index_dir(backend)
+    # Repositories created by older versions have no index dir
+    backend.try_mkdir(path)
+    data = encode_index(hashes, timestamp)
+    tmp_path = backend.temppath()
+    f = backend.open(tmp_path, 'wb')
+    try:
+        f.write(data)
+        # Garbage after a crash would add hashes that do not exist
+        backend.sync_file(f)
+    finally:
+        f.close()
+    backend.replace(tmp_path, os.path.join(path, name))
+    backend.sync_dir(path)
+
+
+def _list_deltas(backend):
+    try:
+        names = backend.listdir(index_dir(backend))
+    except FileNotFoundError:
+        return []
+    return sorted(name for name in names if name.startswith(DELTA_PREFIX))
+
+
+def read_index(backend):
+    """Read the packed file and all deltas
+
+    :type backend: hashedbackup.backends.base.BackendBase
+    :return: tuple of (set of hashes, time of the last full scan, names of
+        the deltas), or None if there is no usable index
+    """
+    # A concurrent compaction can remove deltas that we just listed, then
+    # the new packed file contains them
+    for _ in range(3):
+        try:
+            names = backend.listdir(index_dir(backend))
+        except FileNotFoundError:
+            return None
+        if PACKED_NAME not in names:
+            return None
+        deltas = sorted(name for name in names
+                        if name.startswith(DELTA_PREFIX))
+        try:
+            scanned, hashes = _read_file(backend, PACKED_NAME)
+            hashes = set(hashes)
+            for name in deltas:
+                hashes.update(_read_file(backend, name)[1])
+        except FileNotFoundError:
+            continue
+        except (OSError, ValueError) as e:
+            log.warn('Ignoring unreadable repository index: %s', e)
+            return None
+        return hashes, scanned, deltas
+    return None
+
+
+def write_packed(backend, hashes, scanned, deltas):
+    """Replace the packed file and remove the deltas it contains
+
+    :param set[str] hashes: all hashes in the repository
+    :param float scanned: time of the full scan the hashes descend from
+    :param list[str] deltas: names of the deltas merged into hashes
+    """
+    _write_file(backend, PACKED_NAME, hashes, scanned)
+    for name in deltas:
+        try:
+            backend.delete(os.path.join(index_dir(backend), name))
+        except FileNotFoundError:
+            # Removed by a concurrent compaction
+            pass
+
+
+def add_delta(backend, hashes):
+    """Record objects that are not in the index yet
+
+    Must only be called once the objects are durable.
+
+    :param set[str] hashes: hashes to add
+    """
+    if not hashes:
+        return
+    name = '{}{}-{}'.format(DELTA_PREFIX, time.strftime('%Y%m%d-%H%M%S'),
+                            temp_filename())
+    try:
+        _write_file(backend, name, hashes, time.time())
+    except OSError as e:
+        # The next backup finds these objects again
+        log.warn('Updating the repository index failed: %s', e)
+
+
+def load_object_hashes(backend, *, rescan=False):
+    """Get all object hashes, from the index if possible
+
+    Scans the objects and rewrites the index if it is missing, unreadable
+    or too old, and compacts it if it has too many deltas.
+
+    :type backend: hashedbackup.backends.base.BackendBase
+    :param bool rescan: always scan the objects
+    :rtype: set[str]
+    """
+    index = None if rescan else read_index(backend)
+    if index is not None:
+        hashes, scanned, deltas = index
+        age = time.time() - scanned
+        if age < RESCAN_AFTER:
+            log.verbose('Read %i hashes from the repository index '
+                        '(%i deltas)', len(hashes), len(deltas))
+            if len(deltas) >= COMPACT_DELTAS:
+                log.verbose('Compacting the repository index')
+                _update_packed(backend, hashes, scanned, deltas)
+            return hashes
+        log.verbose('Last full scan of the repository is %i days old',
+                    age // (24 * 3600))
+
+    # Deltas that exist before the scan only list objects that it finds
+    scanned = time.time()
+    deltas = _list_deltas(backend)
+    hashes = backend.scan_object_hashes()
+    _update_packed(backend, hashes, scanned, deltas)
+    return hashes
+
+
+def _update_packed(backend, hashes, scanned, deltas):
+    try:
+        write_packed(backend, hashes, scanned, deltas)
+    except OSError as e:
+        log.warn('Writing the repository index failed: %s', e)
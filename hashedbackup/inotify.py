@@ -0,0 +1,137 @@
+"""Minimal ctypes wrapper around the Linux inotify API"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+import logging
+
+log = logging.getLogger(__name__)
+
+IN_ACCESS = 0x00000001
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_CLOSE_NOWRITE = 0x00000010
+IN_OPEN = 0x00000020
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 0o2000000
+
+# Everything that can change the contents of a backup
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+              IN_MOVE_SELF | IN_ONLYDIR)
+
+_EVENT = struct.Struct('iIII')
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                            use_errno=True)
+        _libc.inotify_init1.argtypes = [ctypes.c_int]
+        _libc.inotify_add_watch.argtypes = [
+            ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        _libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    return _libc
+
+
+class InotifyEvent:
+    __slots__ = ('wd', 'mask', 'cookie', 'name')
+
+    def __init__(self, wd, mask, cookie, name):
+        self.wd = wd
+        self.mask = mask
+        self.cookie = cookie
+        self.name = name
+
+    @property
+    def is_dir(self):
+        return bool(self.mask & IN_ISDIR)
+
+    def __repr__(self):
+        return 'InotifyEvent(wd={}, mask={:#x}, name={!r})'.format(
+            self.wd, self.mask, self.name)
+
+
+class Inotify:
+    """An inotify instance
+
+    Usage:
+
+        ino = Inotify()
+        wd = ino.add_watch('/some/dir')
+        for event in ino.read_events():
+            ...
+    """
+
+    def __init__(self):
+        try:
+            self.libc = _get_libc()
+            fd = self.libc.inotify_init1(IN_CLOEXEC)
+        except (OSError, AttributeError) as e:
+            raise OSError(errno.ENOSYS, 'inotify is not available: {}'.format(e))
+        if fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.fd = fd
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        """
+        :param str path: directory to watch
+        :return: watch descriptor
+        :rtype: int
+        :raises OSError: ENOSPC if the max_user_watches limit was reached
+        """
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self, bufsize=256 * 1024):
+        """Block until events are available and return them
+
+        :rtype: list[InotifyEvent]
+        """
+        buf = os.read(self.fd, bufsize)
+        events = []
+        offset = 0
+        while offset < len(buf):
+            wd, mask, cookie, length = _EVENT.unpack_from(buf, offset)
+            offset += _EVENT.size
+            name = buf[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append(InotifyEvent(wd, mask, cookie, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,194 @@
+import fcntl
+import json
+import os
+import logging
+import uuid
+
+from hashedbackup.utils import encode_namespace, temp_filename
+
+log = logging.getLogger(__name__)
+
+JOURNAL_DIR = '~/.hashedbackup/journals'
+
+
+class DirtyJournal:
+    """Persistent log of paths that changed below a backup root
+
+    The journal is written by `hashedbackup watch` and read by
+    `hashedbackup backup --journal`. It consists of these files:
+
+    - <name>.lock: locked by the watcher as long as it is running
+    - <name>.journal: changed paths, appended to by the watcher
+
+    Every journal line is a JSON value. The first line is an object with
+    the random id of the journal and the time the watcher started to see
+    all changes. Every other line is either a path relative to the root,
+    or an object {"overflow": reason} if changes were lost.
+
+    Backups do not consume the journal. Every manifest header records the
+    position in the journal at which its backup started, so that the next
+    backup to the same destination and namespace reads the changes after
+    that position, no matter what other backups did in between.
+    """
+
+    def __init__(self, root, directory=None):
+        """
+        :param str root: absolute path of the watched directory
+        :param str directory: where to store the journal files
+        """
+        self.root = root
+        self.directory = os.path.expanduser(directory or JOURNAL_DIR)
+        name = encode_namespace(root).replace('/', '=2F')
+        base = os.path.join(self.directory, name)
+        self.lock_path = base + '.lock'
+        self.journal_path = base + '.journal'
+        self._lock_file = None
+
+    # Watcher side
+
+    def acquire_watcher_lock(self):
+        """Mark the journal as maintained by the calling process
+
+        :raises BlockingIOError: if another watcher is already running
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        f = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            raise BlockingIOError(
+                'Another watcher is running for {}'.format(self.root))
+        self._lock_file = f
+
+    def release_watcher_lock(self):
+        if self._lock_file:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def reset(self, started):
+        """Start a new journal, all changes since `started` will be recorded
+
+        Positions in the old journal become invalid, so the next backup of
+        every destination does a full walk.
+
+        :param float started: timestamp
+        """
+        tmp = '{}.{}'.format(self.journal_path, temp_filename())
+        with open(tmp, 'w', encoding='ascii') as f:
+            f.write(json.dumps(dict(id=uuid.uuid4().hex, root=self.root,
+                                    started=started)) + '\n')
+        os.rename(tmp, self.journal_path)
+
+    def _open_live_journal(self):
+        # The watcher atomically replaces the journal on a reset, so make
+        # sure we did not lock a file that was just replaced.
+        while True:
+            f = open(self.journal_path, 'a', encoding='ascii')
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                live = os.stat(self.journal_path).st_ino
+            except FileNotFoundError:
+                live = None
+            if live == os.fstat(f.fileno()).st_ino:
+                return f
+            f.close()
+
+    def append(self, paths):
+        """
+        :param iterable[str] paths: relative paths that changed
+        :return: size of the journal in bytes after appending
+        :rtype: int
+        """
+        with self._open_live_journal() as f:
+            for path in paths:
+                f.write(json.dumps(path) + '\n')
+            f.flush()
+            return f.tell()
+
+    def mark_overflow(self, reason):
+        log.warn('Dirty journal overflow, next backup will be a full '
+                 'walk: %s', reason)
+        with self._open_live_journal() as f:
+            f.write(json.dumps(dict(overflow=reason)) + '\n')
+
+    # Backup side
+
+    def watcher_running(self):
+        try:
+            f = open(self.lock_path, 'r')
+        except FileNotFoundError:
+            return False
+        with f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except OSError:
+                return True
+            return False
+
+    def read(self, since=None):
+        """Read the changes recorded after a position
+
+        Changes that arrive after this call are after the returned position,
+        so the backup that stores it in its manifest header sees them in the
+        next run.
+
+        :param dict since: position from an earlier read, as stored in a
+            manifest header
+        :return: tuple of (current position or None if there is no journal,
+                 set of relative paths or None if `since` is not a position
+                 in this journal, overflow reason or None)
+        :rtype: tuple[dict, set[str], str]
+        """
+        try:
+            f = open(self.journal_path, 'r', encoding='ascii')
+        except FileNotFoundError:
+            return None, None, None
+        with f:
+            # Wait for a watcher that is appending
+            fcntl.flock(f, fcntl.LOCK_SH)
+            try:
+                header = json.loads(f.readline())
+            except ValueError:
+                return None, None, None
+            position = dict(id=header.get('id'),
+                            offset=os.fstat(f.fileno()).st_size)
+            if not since or since.get('id') != position['id'] \
+                    or since.get('offset', 0) > position['offset']:
+                return position, None, None
+            f.seek(max(since['offset'], f.tell()))
+            data = f.read(position['offset'] - f.tell())
+
+        paths = set()
+        overflow = None
+        for line in data.splitlines():
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Partial line after a crash of the watcher
+                overflow = 'corrupt journal line'
+                continue
+            if isinstance(entry, str):
+                paths.add(entry)
+            else:
+                overflow = entry.get('overflow', 'unknown entry')
+        return position, paths, overflow
+
+
+def reduce_dirty_paths(paths):
+    """Reduce a set of dirty paths to the minimal set of subtree roots
+
+    :param iterable[str] paths: relative paths
+    :rtype: list[str]
+    """
+    roots = []
+    # Sort on components, so that children directly follow their parent
+    for path in sorted((p.strip('/') for p in paths),
+                       key=lambda p: p.split('/')):
+        if not path:
+            # The root directory itself is not part of the manifest
+            continue
+        if roots and (path == roots[-1] or path.startswith(roots[-1] + '/')):
+            continue
+        roots.append(path)
+    return roots
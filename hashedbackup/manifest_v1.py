@@ -0,0 +1,269 @@
+"""Compact record encoding for manifest version 1
+
+Version 0 manifests are bz2 compressed JSON lines. Version 1 manifests use
+the same bz2 container, but the decompressed stream starts with MAGIC and
+contains binary records. Every record starts with a tag byte:
+
+    J  varint length, JSON object: any record without a compact form, like
+       the header, the eof record and the summary
+    O  owner table entry: varint uid, varint gid, string user, string group
+    D  directory: path, varint owner, varint mode, svarint mtime,
+       varint mtime_ns, extra
+    F  file: like D, followed by varint size and the hash as 16 bytes
+
+Paths are front coded: varint length of the prefix shared with the previous
+path, followed by a string with the rest. Owners refer to O entries by their
+index. Strings are a varint length followed by UTF-8, with length 0 meaning
+None and every other length one more than the number of bytes. Extra is a
+string with JSON of any record keys without a compact encoding.
+
+Decoding gives the same dicts as version 0 records.
+"""
+import binascii
+import json
+
+MAGIC = b'HBM\x01'
+
+TAG_JSON = b'J'[0]
+TAG_OWNER = b'O'[0]
+TAG_DIR = b'D'[0]
+TAG_FILE = b'F'[0]
+
+STAT_KEYS = ('mode', 'uid', 'gid', 'user', 'group', 'mtime', 'mtime_ns')
+DIR_KEYS = {'path', 'type', 'stat'}
+FILE_KEYS = {'path', 'type', 'size', 'hash', 'stat'}
+
+
+def encode_varint(n, out):
+    """
+    :param int n: non-negative integer
+    :param bytearray out: buffer to append to
+    """
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def encode_string(s, out):
+    if s is None:
+        out.append(0)
+        return
+    data = s.encode('utf-8', 'surrogateescape')
+    encode_varint(len(data) + 1, out)
+    out += data
+
+
+def _common_prefix_len(a, b):
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+
+class CompactEncoder:
+
+    def __init__(self):
+        self.prev_path = b''
+        self.owners = {}
+
+    def start(self):
+        return MAGIC
+
+    def _compact_form(self, record):
+        """Check if a record can use the D or F encoding"""
+        rtype = record.get('type')
+        if rtype == 'd':
+            required = DIR_KEYS
+        elif rtype == 'f':
+            required = FILE_KEYS
+            fhash = record.get('hash')
+            if not isinstance(fhash, str) or len(fhash) != 32:
+                return None
+        else:
+            return None
+        if not required.issubset(record):
+            return None
+        st = record['stat']
+        if not isinstance(st, dict) or tuple(sorted(st)) != tuple(
+                sorted(STAT_KEYS)):
+            return None
+        if st['mtime'] is None or st['mtime_ns'] is None:
+            return None
+        return rtype
+
+    def encode(self, record):
+        """
+        :param dict record: manifest record
+        :rtype: bytes
+        """
+        out = bytearray()
+        rtype = self._compact_form(record)
+        if rtype is None:
+            data = json.dumps(record, ensure_ascii=True).encode('ascii')
+            out.append(TAG_JSON)
+            encode_varint(len(data), out)
+            out += data
+            return bytes(out)
+
+        st = record['stat']
+        owner = (st['uid'], st['gid'], st['user'], st['group'])
+        index = self.owners.get(owner)
+        if index is None:
+            index = self.owners[owner] = len(self.owners)
+            out.append(TAG_OWNER)
+            encode_varint(st['uid'], out)
+            encode_varint(st['gid'], out)
+            encode_string(st['user'], out)
+            encode_string(st['group'], out)
+
+        path = record['path'].encode('utf-8', 'surrogateescape')
+        prefix = _common_prefix_len(self.prev_path, path)
+        self.prev_path = path
+
+        out.append(TAG_FILE if rtype == 'f' else TAG_DIR)
+        encode_varint(prefix, out)
+        encode_varint(len(path) - prefix, out)
+        out += path[prefix:]
+        encode_varint(index, out)
+        encode_varint(st['mode'], out)
+        mtime = st['mtime']
+        encode_varint(mtime << 1 if mtime >= 0 else (-mtime << 1) - 1, out)
+        encode_varint(st['mtime_ns'], out)
+
+        known = FILE_KEYS if rtype == 'f' else DIR_KEYS
+        extra = {k: v for k, v in record.items() if k not in known}
+        encode_string(json.dumps(extra, ensure_ascii=True)
+                      if extra else None, out)
+
+        if rtype == 'f':
+            encode_varint(record['size'], out)
+            out += binascii.unhexlify(record['hash'])
+        return bytes(out)
+
+
+def _varint(buf, pos):
+    """Decode a varint, raises IndexError if buf ends before it does"""
+    b = buf[pos]
+    if b < 0x80:
+        return b, pos + 1
+    n = b & 0x7f
+    shift = 7
+    while True:
+        pos += 1
+        b = buf[pos]
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos + 1
+        shift += 7
+
+
+def _bytes(buf, pos, n):
+    end = pos + n
+    if end > len(buf):
+        raise IndexError('need more data')
+    return buf[pos:end], end
+
+
+def _string(buf, pos):
+    n, pos = _varint(buf, pos)
+    if n == 0:
+        return None, pos
+    data, pos = _bytes(buf, pos, n - 1)
+    return data.decode('utf-8', 'surrogateescape'), pos
+
+
+class CompactDecoder:
+    """Decodes records from a stream of decompressed data chunks
+
+    Records are parsed directly from the buffer. When a record continues in
+    the next chunk, parsing raises IndexError and is retried from the start
+    of the record with more data.
+    """
+
+    def __init__(self, chunks):
+        """
+        :param iterable[bytes] chunks: decompressed data, after the MAGIC
+        """
+        self.chunks = iter(chunks)
+        self.prev_path = b''
+        self.owners = []
+
+    def __iter__(self):
+        buf = b''
+        pos = 0
+        for chunk in self.chunks:
+            buf = buf[pos:] + chunk
+            pos = 0
+            end = len(buf)
+            try:
+                while pos < end:
+                    record, pos = self._parse(buf, pos)
+                    if record is not None:
+                        yield record
+            except IndexError:
+                # Partial record, pos still points at its start
+                pass
+        if pos < len(buf):
+            raise ValueError('Truncated manifest')
+
+    def _parse(self, buf, pos):
+        """Parse the record at pos
+
+        :return: tuple of (record or None, position of the next record)
+        """
+        tag = buf[pos]
+        if tag == TAG_DIR or tag == TAG_FILE:
+            return self._entry(buf, pos + 1, tag)
+        elif tag == TAG_JSON:
+            n, p = _varint(buf, pos + 1)
+            data, p = _bytes(buf, p, n)
+            return json.loads(data.decode('ascii')), p
+        elif tag == TAG_OWNER:
+            uid, p = _varint(buf, pos + 1)
+            gid, p = _varint(buf, p)
+            user, p = _string(buf, p)
+            group, p = _string(buf, p)
+            self.owners.append((uid, gid, user, group))
+            return None, p
+        raise ValueError('Invalid manifest record tag {}'.format(tag))
+
+    def _entry(self, buf, p, tag):
+        prefix, p = _varint(buf, p)
+        n, p = _varint(buf, p)
+        suffix, p = _bytes(buf, p, n)
+        index, p = _varint(buf, p)
+        mode, p = _varint(buf, p)
+        mtime, p = _varint(buf, p)
+        mtime = mtime >> 1 if not mtime & 1 else -((mtime + 1) >> 1)
+        mtime_ns, p = _varint(buf, p)
+        extra, p = _string(buf, p)
+        if tag == TAG_FILE:
+            size, p = _varint(buf, p)
+            fhash, p = _bytes(buf, p, 16)
+
+        # Only update state once the whole record has been read
+        path = self.prev_path[:prefix] + suffix
+        self.prev_path = path
+        uid, gid, user, group = self.owners[index]
+
+        record = dict(path=path.decode('utf-8', 'surrogateescape'))
+        if tag == TAG_FILE:
+            record['type'] = 'f'
+            record['size'] = size
+            record['hash'] = binascii.hexlify(fhash).decode('ascii')
+        else:
+            record['type'] = 'd'
+        record['stat'] = dict(
+            mode=mode,
+            uid=uid,
+            gid=gid,
+            user=user,
+            group=group,
+            mtime=mtime,
+            mtime_ns=mtime_ns,
+        )
+        if extra:
+            record.update(json.loads(extra))
+        return record, p
@@ -1,54 +1,376 @@
 import datetime
+import itertools
+import json
 import logging
 import os
-from bz2 import BZ2Compressor
+import queue
+import threading
+from bz2 import BZ2Compressor, BZ2Decompressor
 
-from hashedbackup.utils import encode_namespace, json_line
+from hashedbackup.defaults import MANIFEST_VERSIONS, \
+    DEFAULT_MANIFEST_VERSION
+from hashedbackup.manifest_v1 import MAGIC, TAG_JSON, CompactEncoder, \
+    CompactDecoder
+from hashedbackup.tracing import NULL_TRACER
+from hashedbackup.utils import encode_namespace, json_line, MB
 
 log = logging.getLogger(__name__)
 
+# Max number of records waiting for the writer thread
+QUEUE_SIZE = 4096
+# Compressed output is written to the backend in blocks of this size
+FLUSH_SIZE = 4 * MB
+
+# The summary record is compressed on its own, as the last bz2 stream of the
+# manifest, so that it can be read from the end of the file without
+# decompressing the rest. Streams start with the header of the compression
+# level used by ManifestWriter and the magic of the first block.
+BZ2_STREAM_START = b'BZh91AY&SY'
+# Bytes read from the end of a manifest to find the summary stream
+SUMMARY_TAIL_SIZE = 4096
+
+_COMMIT = object()
+_CANCEL = object()
+
+
+class JsonLineEncoder:
+    """Record encoding for manifest version 0"""
+
+    def start(self):
+        return b''
+
+    def encode(self, record):
+        return json_line(record).encode('utf-8')
+
+
+def get_encoder(version):
+    if version == 0:
+        return JsonLineEncoder()
+    elif version == 1:
+        return CompactEncoder()
+    raise ValueError('Unsupported manifest version: {}'.format(version))
+
+
+class SummaryCounter:
+    """Totals of manifest records for the summary record"""
+
+    def __init__(self):
+        self.files = 0
+        self.dirs = 0
+        self.size = 0
+        # Hash to size of the unique objects
+        self.objects = {}
+
+    def add(self, record):
+        rtype = record.get('type')
+        if rtype == 'f':
+            self.files += 1
+            self.size += record['size']
+            self.objects[record['hash']] = record['size']
+        elif rtype == 'd':
+            self.dirs += 1
+
+    def summary(self):
+        """
+        :return: the number of files and directories, their total size, and
+            the number and size of the unique objects they refer to
+        :rtype: dict
+        """
+        return dict(
+            files=self.files,
+            dirs=self.dirs,
+            size=self.size,
+            hashes=len(self.objects),
+            unique_size=sum(self.objects.values()),
+        )
+
+
+def manifest_dir(backend, namespace):
+    """
+    :type backend: hashedbackup.backends.base.BackendBase
+    :param str namespace: manifest namespace
+    :return: path of the directory with the manifests of this namespace
+    """
+    return os.path.join(
+        backend.path, 'manifests', encode_namespace(namespace))
+
 
 class ManifestWriter:
     """File wrapper that writes to a temporary file and then atomically moves
     it in place once done.
+
+    Encoding, compression and writing happen in a background thread that is
+    fed through a bounded queue, so that they are not on the critical path
+    of the backup. The thread also opens and closes the temporary file,
+    because the clients of backends like SFTP cannot be shared between
+    threads. The manifest only appears under its final name after a
+    successful commit.
+
+    The commit adds a summary record with the totals of the records, see
+    summary_record().
     """
     file = None
     compressor = None
+    error = None
+    extra_summary = None
+    # Set by the writer thread once it took _COMMIT or _CANCEL
+    finished = False
 
-    def __init__(self, backend, namespace):
+    def __init__(self, backend, namespace, *,
+                 version=DEFAULT_MANIFEST_VERSION, path=None,
+                 tracer=NULL_TRACER):
         """
         :type backend: hashedbackup.backends.base.BackendBase
         :param str namespace: manifest namespace
+        :param int version: manifest version, determines the record encoding
+        :param str path: manifest path to write instead of a new one based on
+            the current time, used for converting manifests
+        :type tracer: hashedbackup.tracing.Tracer
         """
-        manifest_dir = os.path.join(
-            backend.path, 'manifests', encode_namespace(namespace))
-        backend.try_mkdir(manifest_dir)
+        self.version = version
+        self.tracer = tracer
+        self.encoder = get_encoder(version)
 
         self.dt = datetime.datetime.utcnow()
-        self.manifest_path = os.path.join(
-            manifest_dir, '{:%Y%m%d-%H%M%S}.manifest.bz2'.format(self.dt))
+        if path is None:
+            dirname = manifest_dir(backend, namespace)
+            backend.try_mkdir(dirname)
+            path = os.path.join(
+                dirname, '{:%Y%m%d-%H%M%S}.manifest.bz2'.format(self.dt))
+        self.manifest_path = path
 
         self.tmp_path = backend.temppath()
         log.debug('Manifest temp file: %s', self.tmp_path)
-        self.file = backend.open(self.tmp_path, 'wb')
         self.compressor = BZ2Compressor(9)
         self.backend = backend
 
-    def write(self, buf):
-        self.file.write(self.compressor.compress(buf))
+        # Only touched by the writer thread
+        self.counter = SummaryCounter()
+
+        self.queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self.thread = threading.Thread(
+            target=self._run, name='manifest-writer', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            self.file = self.backend.open(self.tmp_path, 'wb')
+            try:
+                self._write()
+            finally:
+                # For SFTP this waits for the replies to pipelined writes
+                self.file.close()
+        except BaseException as e:
+            self.error = e
+            # Keep consuming, so that add() never blocks on a full queue
+            if not self.finished:
+                while self.queue.get() not in (_COMMIT, _CANCEL):
+                    pass
+
+    def _write(self):
+        pending = [self.compressor.compress(self.encoder.start())]
+        pending_size = 0
+        while True:
+            item = self.queue.get()
+            if item is _CANCEL:
+                self.finished = True
+                return
+            if item is _COMMIT:
+                self.finished = True
+                with self.tracer.span('manifest compress'):
+                    pending.append(self.compressor.flush())
+                    # A stream of its own, see BZ2_STREAM_START
+                    summary = BZ2Compressor(9)
+                    pending.append(summary.compress(
+                        self.encoder.encode(self.summary_record())))
+                    pending.append(summary.flush())
+                with self.tracer.span('manifest write'):
+                    self.file.write(b''.join(pending))
+                self.backend.sync_file(self.file)
+                return
+
+            self.counter.add(item)
+            with self.tracer.span('manifest compress'):
+                data = self.compressor.compress(self.encoder.encode(item))
+            if data:
+                pending.append(data)
+                pending_size += len(data)
+                if pending_size >= FLUSH_SIZE:
+                    with self.tracer.span('manifest write'):
+                        self.file.write(b''.join(pending))
+                    pending = []
+                    pending_size = 0
+
+    def summary_record(self):
+        """
+        :return: record with SummaryCounter.summary() of the records and the
+            keys given to commit()
+        :rtype: dict
+        """
+        summary = self.counter.summary()
+        summary.update(self.extra_summary or {})
+        return dict(summary=summary)
+
+    def _check_error(self):
+        if self.error:
+            raise IOError('Writing manifest failed: {}'.format(
+                self.error)) from self.error
 
     def add(self, **data):
-        self.write(json_line(data).encode('utf-8'))
+        self._check_error()
+        self.queue.put(data)
 
-    def commit(self):
-        flush_data = self.compressor.flush()
-        if flush_data:
-            self.file.write(flush_data)
-        self.file.close()
-        self.backend.rename(self.tmp_path, self.manifest_path)
+    def commit(self, *, replace=False, summary=None):
+        """
+        :param bool replace: replace an existing manifest at the same path
+        :param dict summary: more keys for the summary record, like the
+            number of bytes that the backup uploaded
+        """
+        self.extra_summary = summary
+        self.queue.put(_COMMIT)
+        self.thread.join()
+        self._check_error()
+        # The manifest must not become visible before the objects it refers
+        # to and its own data (synced by the writer thread) are on disk
+        self.backend.flush()
+        if replace:
+            self.backend.replace(self.tmp_path, self.manifest_path)
+        else:
+            self.backend.rename(self.tmp_path, self.manifest_path)
+        self.backend.sync_dir(os.path.dirname(self.manifest_path))
 
     def cancel(self):
+        self.queue.put(_CANCEL)
+        self.thread.join()
+        if self.file is not None:
+            self.backend.delete(self.tmp_path)
+
+
+class ManifestReader:
+    """Iterates over the records of a manifest, as dicts
+
+    All manifest versions are supported and give the same records. The
+    summary record is not one of them, it is available as reader.summary
+    once all records were read, if the manifest has one.
+
+    Usage:
+
+        with ManifestReader(backend, path) as reader:
+            header = reader.header
+            for record in reader:
+                ...
+    """
+
+    def __init__(self, backend, path, *, bufsize=1024 * 1024):
+        """
+        :type backend: hashedbackup.backends.base.BackendBase
+        :param str path: full path of the manifest
+        """
+        self.path = path
+        self.bufsize = bufsize
+        self.summary = None
+        self.file = backend.open(path, 'rb')
+        self._records = self._iter_records()
+        self.header = next(self._records, None)
+
+    def _iter_chunks(self):
+        decompressor = BZ2Decompressor()
+        while True:
+            buf = self.file.read(self.bufsize)
+            if not buf:
+                break
+            while buf:
+                data = decompressor.decompress(buf)
+                buf = b''
+                if decompressor.eof:
+                    # Concatenated bz2 streams
+                    buf = decompressor.unused_data
+                    decompressor = BZ2Decompressor()
+                if data:
+                    yield data
+
+    def _iter_lines(self, chunks):
+        pending = b''
+        for data in chunks:
+            lines = (pending + data).split(b'\n')
+            pending = lines.pop()
+            yield from lines
+        if pending:
+            yield pending
+
+    def _iter_records(self):
+        chunks = self._iter_chunks()
+        start = b''
+        for data in chunks:
+            start += data
+            if len(start) >= len(MAGIC):
+                break
+        if start.startswith(MAGIC):
+            # Version 1, a version 0 manifest starts with '{'
+            rest = itertools.chain([start[len(MAGIC):]], chunks)
+            yield from CompactDecoder(rest)
+            return
+        for line in self._iter_lines(itertools.chain([start], chunks)):
+            if line:
+                yield json.loads(line.decode('utf-8'))
+
+    def _without_summary(self):
+        for record in self._records:
+            if 'summary' in record and len(record) == 1:
+                self.summary = record['summary']
+                continue
+            yield record
+
+    def __iter__(self):
+        """Iterate over all records after the header"""
+        return self._without_summary()
+
+    def close(self):
         self.file.close()
-        self.backend.delete(self.tmp_path)
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
+
+def _decode_summary(data):
+    """
+    :param bytes data: the decompressed summary stream of either manifest
+        version
+    :rtype: dict
+    :raises ValueError: if this is not a summary record
+    """
+    if data[:1] == bytes([TAG_JSON]):
+        records = list(CompactDecoder([data]))
+    else:
+        records = [json.loads(data.decode('utf-8'))]
+    if len(records) != 1 or not isinstance(records[0].get('summary'), dict):
+        raise ValueError('Not a summary record')
+    return records[0]['summary']
+
+
+def read_summary(backend, path):
+    """Read the summary of a manifest from the end of the file
+
+    :type backend: hashedbackup.backends.base.BackendBase
+    :param str path: full path of the manifest
+    :return: the summary, or None if the manifest has none, like those
+        written by older versions
+    :rtype: dict
+    """
+    tail = backend.read_tail(path, SUMMARY_TAIL_SIZE)
+    # The magic can also occur in compressed data by chance, the last
+    # candidate that decodes as a complete summary is the right one
+    pos = tail.rfind(BZ2_STREAM_START)
+    while pos >= 0:
+        decompressor = BZ2Decompressor()
+        try:
+            data = decompressor.decompress(tail[pos:])
+            if decompressor.eof and not decompressor.unused_data:
+                return _decode_summary(data)
+        except (OSError, ValueError, IndexError, EOFError):
+            pass
+        pos = tail.rfind(BZ2_STREAM_START, 0, pos)
+    return None
@@ -0,0 +1,231 @@
+"""Concurrent backup pipeline: walk -> hash -> check -> upload
+
+The walk runs in its own thread, files are hashed in a thread pool, objects
+that are not known to be in the repository are checked in batches and
+uploads run concurrently on an async backend per destination. A file that
+several destinations need is uploaded to all of them at the same time.
+Bounded queues between the stages provide backpressure: when uploads are
+slower than the disk, the hashers and the walk wait, so memory use stays
+bounded.
+
+All state of the BackupCommand and its destinations (counters, manifests,
+hash sets) is only touched from the event loop thread.
+"""
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from hashedbackup.cmd_backup import CHECK_BATCH_SIZE
+
+log = logging.getLogger(__name__)
+
+# Queue length per worker between the stages
+QUEUE_SIZE_PER_JOB = 8
+
+
+class BackupPipeline:
+
+    def __init__(self, command, abackends, *, hash_jobs, upload_jobs,
+                 walker=None):
+        """
+        :type command: hashedbackup.cmd_backup.BackupCommand
+        :param list[hashedbackup.backends.aio.AsyncBackend] abackends:
+            async backends of command.destinations, in the same order
+        :param int hash_jobs: number of files hashed concurrently
+        :param int upload_jobs: number of uploads in flight
+        :param walker: iterable of (dirs, files) like command.walk_root(),
+            the whole root by default. It runs in the walk thread.
+        """
+        self.command = command
+        self.walker = walker
+        self.abackends = dict(zip(command.destinations, abackends))
+        self.hash_jobs = hash_jobs
+        self.upload_jobs = upload_jobs
+        self.walk_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='walk')
+        self.hash_executor = ThreadPoolExecutor(
+            max_workers=hash_jobs, thread_name_prefix='hash')
+        self.hash_queue = None
+        self.check_queue = None
+        self.upload_queue = None
+        # (destination, hash) of the objects that are being uploaded, to not
+        # upload duplicates twice
+        self.in_flight = {}
+        self.running = set()
+
+    async def walk(self):
+        loop = asyncio.get_running_loop()
+        walker = self.walker
+        if walker is None:
+            walker = self.command.walk_root()
+        walker = iter(walker)
+        while True:
+            item = await loop.run_in_executor(
+                self.walk_executor, next, walker, None)
+            if item is None:
+                break
+            dirs, files = item
+            for relpath in dirs:
+                self.command.process_dir(relpath)
+            for relpath in files:
+                await self.hash_queue.put(relpath)
+
+    async def hasher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            relpath = await self.hash_queue.get()
+            if relpath is None:
+                return
+            info = await loop.run_in_executor(
+                self.hash_executor, self.command.prepare_file, relpath)
+            if info is not None:
+                await self.check_queue.put((relpath, info))
+
+    async def checker(self):
+        """Check the objects of the files that are ready in one batch"""
+        command = self.command
+        done = False
+        while not done:
+            items = [await self.check_queue.get()]
+            while len(items) < CHECK_BATCH_SIZE:
+                try:
+                    items.append(self.check_queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            if items[-1] is None:
+                items.pop()
+                done = True
+
+            infos = [info for _, info in items]
+            await asyncio.gather(*[self.check(dest, infos)
+                                   for dest in command.destinations])
+            for item in items:
+                await self.upload_queue.put(item)
+
+    async def check(self, dest, infos):
+        """Check the objects of a batch of files in one destination
+
+        :type dest: hashedbackup.cmd_backup.Destination
+        """
+        unknown = dest.unknown_hashes(infos)
+        if not unknown:
+            return
+        present = set()
+        if dest.check_in_bulk:
+            # All destinations check the same batch at the same time
+            span_id = '{}:{}'.format(dest.dst, id(infos))
+            with self.command.tracer.async_span(
+                    'have_objects', span_id, count=len(unknown)):
+                present = await self.abackends[dest].have_objects(unknown)
+        # Blocks the loop if this switches to fetching all hashes,
+        # running uploads continue meanwhile
+        dest.record_checked(unknown, present)
+
+    async def add_object(self, dest, relpath, info, data):
+        """Add an object to one destination
+
+        :type dest: hashedbackup.cmd_backup.Destination
+        :return: True if added, False if it already existed
+        """
+        fhash = info.filehash()
+        key = (dest, fhash)
+        if key in self.in_flight:
+            await asyncio.shield(self.in_flight[key])
+            return False
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight[key] = future
+        abackend = self.abackends[dest]
+        # in_flight allows one upload of an object per destination
+        span_id = '{}:{}'.format(dest.dst, fhash)
+        try:
+            if data is not None:
+                with self.command.tracer.async_span(
+                        'add_object_data', span_id, path=relpath):
+                    return await abackend.add_object_data(fhash, data)
+            with self.command.tracer.async_span(
+                    'add_object', span_id, path=relpath):
+                return await abackend.add_object(fhash, info.fpath)
+        finally:
+            del self.in_flight[key]
+            future.set_result(None)
+
+    async def uploader(self):
+        command = self.command
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self.upload_queue.get()
+            if item is None:
+                return
+            relpath, info = item
+            log_fileinfo = command.log_file(relpath, info)
+            fhash = info.filehash()
+
+            t0 = time.time()
+            missing = [dest for dest in command.destinations
+                       if fhash not in dest.hashes]
+            data = info.data
+            if missing and data is None:
+                # Small files whose hash was cached, and files that several
+                # destinations need, like store_file() does
+                data = await loop.run_in_executor(
+                    self.hash_executor, command.object_data, info,
+                    len(missing))
+            added = await asyncio.gather(*[
+                self.add_object(dest, relpath, info, data)
+                for dest in missing])
+            t1 = time.time()
+            command.record_file(relpath, info, dict(zip(missing, added)),
+                                t1 - t0, log_fileinfo)
+
+    async def _join(self, group):
+        """Wait for a group of tasks to finish
+
+        Raises the exception of any failed task, including the running
+        workers that are not in the group, so that a failing stage cannot
+        leave another stage waiting forever on a full queue.
+        """
+        group = set(group)
+        while group:
+            done, _ = await asyncio.wait(
+                group | self.running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+                group.discard(task)
+                self.running.discard(task)
+
+    async def _stop(self, queue, workers):
+        async def put_sentinels():
+            for _ in workers:
+                await queue.put(None)
+        await self._join([asyncio.ensure_future(put_sentinels())] + workers)
+
+    async def run(self):
+        self.hash_queue = asyncio.Queue(QUEUE_SIZE_PER_JOB * self.hash_jobs)
+        self.check_queue = asyncio.Queue(CHECK_BATCH_SIZE)
+        self.upload_queue = asyncio.Queue(
+            QUEUE_SIZE_PER_JOB * self.upload_jobs)
+
+        hashers = [asyncio.ensure_future(self.hasher())
+                   for _ in range(self.hash_jobs)]
+        uploaders = [asyncio.ensure_future(self.uploader())
+                     for _ in range(self.upload_jobs)]
+        checkers = [asyncio.ensure_future(self.checker())]
+        self.running = set(hashers + checkers + uploaders)
+        try:
+            await self._join([asyncio.ensure_future(self.walk())])
+            await self._stop(self.hash_queue, hashers)
+            await self._stop(self.check_queue, checkers)
+            await self._stop(self.upload_queue, uploaders)
+        finally:
+            for task in hashers + checkers + uploaders:
+                task.cancel()
+
+    def close(self):
+        self.walk_executor.shutdown(wait=True)
+        self.hash_executor.shutdown(wait=True)
+
+
+def default_hash_jobs(jobs):
+    return max(1, min(jobs, os.cpu_count() or 1))
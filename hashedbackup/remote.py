@@ -0,0 +1,285 @@
+"""Framed binary protocol between the SFTP backend and `hashedbackup serve`
+
+`hashedbackup serve PATH` runs on the repository host through SSH exec and
+talks to the client over stdin and stdout. It replaces several SFTP round
+trips per object by one, and verifies uploaded data on the server.
+
+Every frame is a one byte type, a 4 byte big endian payload length and the
+payload. The client sends a request and waits for its reply:
+
+    HELLO  JSON {"protocol": 1}       ->  HELLO  JSON {"protocol": 1}
+    HAVE   n * 16 byte hashes         ->  HAVE   n bytes, 1 if present
+    PUT    16 byte hash, codec byte   ->  PUT    1 byte, 1 if added
+           followed by DATA frames and an empty DATA frame
+    INDEX  empty                      ->  INDEX  frames of 16 byte hashes,
+                                             ended by an empty frame
+    FLUSH  empty                      ->  FLUSH  empty
+
+Any request can be answered with ERROR, with JSON {"error": message}. The
+server verifies the hash of uploaded data (of the original data for the
+zlib and sparse codecs) before the object becomes visible. The session ends
+when the client closes its side.
+"""
+import binascii
+import json
+import logging
+import struct
+import sys
+
+log = logging.getLogger(__name__)
+
+PROTOCOL_VERSION = 1
+
+# Command that the SFTP backend runs on the server, followed by the path
+DEFAULT_REMOTE_COMMAND = 'hashedbackup serve'
+
+MSG_HELLO = b'H'
+MSG_HAVE = b'?'
+MSG_PUT = b'P'
+MSG_DATA = b'D'
+MSG_INDEX = b'I'
+MSG_FLUSH = b'F'
+MSG_ERROR = b'E'
+
+CODEC_RAW = 0
+CODEC_ZLIB = 1
+CODEC_SPARSE = 2
+
+_header = struct.Struct('>cI')
+# Upper bound for the payload of a frame, to not allocate whatever a broken
+# peer claims
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+# Hashes per HAVE request and per INDEX frame
+HASHES_PER_FRAME = 16384
+
+
+class ProtocolError(IOError):
+    pass
+
+
+class RemoteError(IOError):
+    """The server could not handle a request"""
+
+
+class FrameIO:
+    """Reads and writes frames on a pair of binary streams"""
+
+    def __init__(self, rfile, wfile):
+        """
+        :param rfile: object with read(n) that blocks until n bytes or EOF
+        :param wfile: object with write(data) and flush()
+        """
+        self.rfile = rfile
+        self.wfile = wfile
+
+    def _read_exact(self, n):
+        data = self.rfile.read(n)
+        if len(data) != n:
+            raise EOFError('Connection closed')
+        return data
+
+    def read_frame(self):
+        """
+        :return: tuple of (type, payload)
+        """
+        msg_type, size = _header.unpack(self._read_exact(_header.size))
+        if size > MAX_FRAME_SIZE:
+            raise ProtocolError('Frame too large: {}'.format(size))
+        return msg_type, self._read_exact(size) if size else b''
+
+    def write_frame(self, msg_type, payload=b'', *, flush=True):
+        self.wfile.write(_header.pack(msg_type, len(payload)))
+        if payload:
+            self.wfile.write(payload)
+        if flush:
+            self.wfile.flush()
+
+    def write_json(self, msg_type, data):
+        self.write_frame(msg_type, json.dumps(data).encode('utf-8'))
+
+    def iter_data(self):
+        """Yield the payloads of DATA frames up to the empty one"""
+        while True:
+            msg_type, payload = self.read_frame()
+            if msg_type != MSG_DATA:
+                raise ProtocolError('Expected data frame, got {!r}'.format(
+                    msg_type))
+            if not payload:
+                return
+            yield payload
+
+
+def pack_hashes(hashes):
+    return b''.join(binascii.unhexlify(h) for h in hashes)
+
+
+def unpack_hashes(payload):
+    if len(payload) % 16:
+        raise ProtocolError('Invalid hash list')
+    return [binascii.hexlify(payload[i:i + 16]).decode('ascii')
+            for i in range(0, len(payload), 16)]
+
+
+class RepositoryServer:
+    """Serves one client session for a local repository"""
+
+    def __init__(self, backend, frames):
+        """
+        :type backend: hashedbackup.backends.local.LocalBackend
+        :type frames: FrameIO
+        """
+        self.backend = backend
+        self.frames = frames
+        self.handlers = {
+            MSG_HELLO: self.handle_hello,
+            MSG_HAVE: self.handle_have,
+            MSG_PUT: self.handle_put,
+            MSG_INDEX: self.handle_index,
+            MSG_FLUSH: self.handle_flush,
+        }
+
+    def run(self):
+        try:
+            while True:
+                try:
+                    msg_type, payload = self.frames.read_frame()
+                except EOFError:
+                    break
+                handler = self.handlers.get(msg_type)
+                if handler is None:
+                    raise ProtocolError('Unknown request {!r}'.format(
+                        msg_type))
+                try:
+                    handler(payload)
+                except ValueError as e:
+                    # Bad data, but the stream is still in sync
+                    self.frames.write_json(MSG_ERROR, dict(error=str(e)))
+        finally:
+            self.backend.flush()
+
+    def handle_hello(self, payload):
+        hello = json.loads(payload.decode('utf-8'))
+        if hello.get('protocol') != PROTOCOL_VERSION:
+            raise ValueError('Unsupported protocol version {}'.format(
+                hello.get('protocol')))
+        self.frames.write_json(MSG_HELLO, dict(protocol=PROTOCOL_VERSION))
+
+    def handle_have(self, payload):
+        result = bytes(self.backend.object_exists(fhash)
+                       for fhash in unpack_hashes(payload))
+        self.frames.write_frame(MSG_HAVE, result)
+
+    def handle_put(self, payload):
+        if len(payload) != 17:
+            raise ProtocolError('Invalid put request')
+        fhash = binascii.hexlify(payload[:16]).decode('ascii')
+        codec = payload[16]
+        chunks = self.frames.iter_data()
+        if codec not in (CODEC_RAW, CODEC_ZLIB, CODEC_SPARSE):
+            for _ in chunks:
+                pass
+            raise ValueError('Unknown codec {}'.format(codec))
+        added = self.backend.add_object_chunks(
+            fhash, chunks, compressed=codec == CODEC_ZLIB,
+            sparse=codec == CODEC_SPARSE)
+        self.frames.write_frame(MSG_PUT, bytes([added]))
+
+    def handle_index(self, payload):
+        # Objects in a pending fsync batch are not visible on disk yet
+        self.backend.flush()
+        hashes = sorted(self.backend.scan_object_hashes())
+        for i in range(0, len(hashes), HASHES_PER_FRAME):
+            self.frames.write_frame(
+                MSG_INDEX, pack_hashes(hashes[i:i + HASHES_PER_FRAME]),
+                flush=False)
+        self.frames.write_frame(MSG_INDEX)
+
+    def handle_flush(self, payload):
+        self.backend.flush()
+        self.frames.write_frame(MSG_FLUSH)
+
+
+def serve_stdio(backend):
+    """Serve a client on stdin and stdout"""
+    frames = FrameIO(sys.stdin.buffer, sys.stdout.buffer)
+    RepositoryServer(backend, frames).run()
+
+
+class RemoteSession:
+    """Client side of one session with `hashedbackup serve`
+
+    A session is used by one thread at a time.
+    """
+
+    def __init__(self, frames, *, close=None):
+        """
+        :type frames: FrameIO
+        :param callable close: closes the underlying connection
+        """
+        self.frames = frames
+        self._close = close
+        self.frames.write_json(MSG_HELLO, dict(protocol=PROTOCOL_VERSION))
+        hello = json.loads(self._reply(MSG_HELLO).decode('utf-8'))
+        log.debug('Remote helper speaks protocol %s', hello.get('protocol'))
+
+    def _reply(self, expected):
+        msg_type, payload = self.frames.read_frame()
+        if msg_type == MSG_ERROR:
+            raise RemoteError(json.loads(payload.decode('utf-8'))['error'])
+        if msg_type != expected:
+            raise ProtocolError('Expected {!r}, got {!r}'.format(
+                expected, msg_type))
+        return payload
+
+    def have(self, hashes):
+        """
+        :param list[str] hashes: hashes to check
+        :return: the hashes that exist in the repository
+        :rtype: set[str]
+        """
+        present = set()
+        for i in range(0, len(hashes), HASHES_PER_FRAME):
+            batch = hashes[i:i + HASHES_PER_FRAME]
+            self.frames.write_frame(MSG_HAVE, pack_hashes(batch))
+            result = self._reply(MSG_HAVE)
+            present.update(h for h, flag in zip(batch, result) if flag)
+        return present
+
+    def put(self, fhash, chunks, *, codec=CODEC_RAW):
+        """Upload an object
+
+        :param str fhash: hash of the original data
+        :param iterable[bytes] chunks: data in its stored form
+        :param int codec: stored form of the data, a CODEC_* constant
+        :return: True if added, False if it already existed
+        :raises RemoteError: if the server rejected the data
+        """
+        self.frames.write_frame(
+            MSG_PUT, binascii.unhexlify(fhash) + bytes([codec]), flush=False)
+        for chunk in chunks:
+            for i in range(0, len(chunk), MAX_FRAME_SIZE):
+                self.frames.write_frame(
+                    MSG_DATA, chunk[i:i + MAX_FRAME_SIZE], flush=False)
+        self.frames.write_frame(MSG_DATA)
+        return self._reply(MSG_PUT) == b'\x01'
+
+    def index(self):
+        """
+        :return: all object hashes in the repository
+        :rtype: set[str]
+        """
+        self.frames.write_frame(MSG_INDEX)
+        hashes = set()
+        while True:
+            payload = self._reply(MSG_INDEX)
+            if not payload:
+                return hashes
+            hashes.update(unpack_hashes(payload))
+
+    def flush(self):
+        self.frames.write_frame(MSG_FLUSH)
+        self._reply(MSG_FLUSH)
+
+    def close(self):
+        if self._close:
+            self._close()
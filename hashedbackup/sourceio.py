@@ -0,0 +1,235 @@
+"""Reading the files that are backed up
+
+By default, source files are read through the page cache like by any other
+program. On busy servers, reading the whole tree evicts the working set of
+the applications. `backup --source-cache` selects another mode:
+
+    normal  plain buffered reads
+    drop    posix_fadvise SEQUENTIAL and NOREUSE when opening, and DONTNEED
+            on what was read, every DROP_BEHIND bytes and when closing. This
+            also drops pages of the file that an application had cached.
+    direct  O_DIRECT reads into aligned buffers that are reused between
+            files, which bypass the page cache. Falls back to F_NOCACHE on
+            macOS and to drop on filesystems without O_DIRECT, like tmpfs.
+
+All modes give file objects with read, readinto, seek, tell and fileno,
+whose reads count against throttle.read_limit.
+"""
+import errno
+import io
+import logging
+import mmap
+import os
+import threading
+
+from hashedbackup.defaults import SOURCE_CACHE_MODES, DEFAULT_SOURCE_CACHE
+from hashedbackup.throttle import read_limit
+from hashedbackup.utils import MB
+
+log = logging.getLogger(__name__)
+
+# Amount read before the pages are dropped in drop mode
+DROP_BEHIND = 8 * MB
+# Size of the aligned buffers of direct mode, a multiple of ALIGNMENT
+DIRECT_BUFSIZE = 1 * MB
+# O_DIRECT needs file offsets and memory aligned to the logical block size
+# of the device, the page size covers all common devices
+ALIGNMENT = mmap.PAGESIZE
+
+_mode = DEFAULT_SOURCE_CACHE
+# Aligned buffers that are not in use
+_buffers = []
+_buffers_lock = threading.Lock()
+_warned = set()
+
+
+def configure(mode):
+    """Set the mode for all following open_source() calls
+
+    :param str mode: one of SOURCE_CACHE_MODES
+    """
+    global _mode
+    if mode not in SOURCE_CACHE_MODES:
+        raise ValueError('Invalid source cache mode: {}'.format(mode))
+    if mode == 'drop' and not hasattr(os, 'posix_fadvise'):
+        _warn_once('posix_fadvise is not available, reading normally')
+        mode = 'normal'
+    _mode = mode
+
+
+def _warn_once(message):
+    if message not in _warned:
+        _warned.add(message)
+        log.warn(message)
+
+
+def open_source(path, mode=None, *, unbuffered=False):
+    """Open a file to back up for reading
+
+    :param str path: file to read
+    :param str mode: override the configured mode
+    :param bool unbuffered: the caller only uses readinto() with its own
+        buffer. The drop and direct modes are always unbuffered.
+    """
+    mode = mode or _mode
+    if mode == 'direct':
+        return _open_direct(path, unbuffered)
+    if mode == 'drop':
+        return DropBehindFile(path)
+    f = SourceFile(path)
+    return f if unbuffered else io.BufferedReader(f)
+
+
+def _fadvise(fd, offset, length, advice):
+    try:
+        os.posix_fadvise(fd, offset, length, advice)
+    except OSError:
+        # Only advice, some filesystems do not support it
+        pass
+
+
+class SourceFile(io.FileIO):
+    """Unbuffered file with rate limited reads"""
+
+    def __init__(self, path):
+        super().__init__(path, 'rb')
+
+    def _consumed(self, n):
+        read_limit.consume(n)
+
+    def read(self, size=-1):
+        data = super().read(size)
+        if data:
+            self._consumed(len(data))
+        return data
+
+    def readinto(self, b):
+        n = super().readinto(b)
+        if n:
+            self._consumed(n)
+        return n
+
+
+class DropBehindFile(SourceFile):
+    """Unbuffered file that drops the pages it has read from the cache"""
+
+    def __init__(self, path):
+        super().__init__(path)
+        fd = self.fileno()
+        _fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        _fadvise(fd, 0, 0, os.POSIX_FADV_NOREUSE)
+        self._since_drop = 0
+
+    def _consumed(self, n):
+        super()._consumed(n)
+        self._since_drop += n
+        if self._since_drop >= DROP_BEHIND:
+            self._since_drop = 0
+            # Reads can be out of order (sparse files), drop up to here
+            _fadvise(self.fileno(), 0, self.tell(),
+                     os.POSIX_FADV_DONTNEED)
+
+    def close(self):
+        if not self.closed:
+            _fadvise(self.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        super().close()
+
+
+def _get_buffer():
+    with _buffers_lock:
+        if _buffers:
+            return _buffers.pop()
+    # Anonymous maps are page aligned
+    return mmap.mmap(-1, DIRECT_BUFSIZE)
+
+
+def _put_buffer(buf):
+    with _buffers_lock:
+        _buffers.append(buf)
+
+
+def _open_direct(path, unbuffered):
+    if hasattr(os, 'O_DIRECT'):
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_DIRECT)
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+            _warn_once('O_DIRECT is not supported by the filesystem, '
+                       'dropping pages after reading instead')
+            mode = 'drop' if hasattr(os, 'posix_fadvise') else 'normal'
+            return open_source(path, mode, unbuffered=unbuffered)
+        return DirectFile(fd, path)
+    try:
+        import fcntl
+        nocache = fcntl.F_NOCACHE
+    except (ImportError, AttributeError):
+        _warn_once('Direct I/O is not available, reading normally')
+        return open_source(path, 'normal', unbuffered=unbuffered)
+    f = open_source(path, 'normal', unbuffered=unbuffered)
+    fcntl.fcntl(f.fileno(), nocache, 1)
+    return f
+
+
+class DirectFile(io.RawIOBase):
+    """File opened with O_DIRECT
+
+    Reads go through an aligned buffer at aligned offsets, so any read size
+    and position works. Only whole buffers are read, which suits the large
+    sequential reads of hashing and uploading.
+    """
+
+    def __init__(self, fd, path):
+        self.fd = fd
+        self.name = path
+        self.pos = 0
+        self.buf = _get_buffer()
+        self.view = memoryview(self.buf)
+        # File offset and length of the data in buf
+        self.buf_start = 0
+        self.buf_len = 0
+
+    def fileno(self):
+        return self.fd
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.pos = offset
+        elif whence == io.SEEK_CUR:
+            self.pos += offset
+        else:
+            self.pos = os.fstat(self.fd).st_size + offset
+        return self.pos
+
+    def _fill(self):
+        start = self.pos - self.pos % ALIGNMENT
+        n = os.preadv(self.fd, [self.view], start)
+        self.buf_start = start
+        self.buf_len = n
+
+    def readinto(self, b):
+        if not (self.buf_start <= self.pos < self.buf_start + self.buf_len):
+            self._fill()
+        skip = self.pos - self.buf_start
+        n = max(0, min(len(b), self.buf_len - skip))
+        b[:n] = self.view[skip:skip + n]
+        self.pos += n
+        read_limit.consume(n)
+        return n
+
+    def close(self):
+        if not self.closed:
+            os.close(self.fd)
+            self.view.release()
+            _put_buffer(self.buf)
+            self.buf = self.view = None
+        super().close()
@@ -0,0 +1,321 @@
+"""Sparse file support
+
+Files with large holes, like VM disk images, are detected with SEEK_DATA
+and SEEK_HOLE. Their holes are hashed as zeros without reading them, and
+their objects are stored with SPARSE_SUFFIX in this form:
+
+    MAGIC
+    '>QI' logical size, number of data extents
+    '>QQ' offset and length of every data extent, in order
+    the data of all extents
+
+The object hash is the md5 of the logical contents, holes included, so
+sparse and regular copies of the same data are the same object. Restoring
+with restore_sparse() recreates the holes.
+"""
+import errno
+import hashlib
+import os
+import struct
+
+from hashedbackup.utils import MB
+
+SPARSE_SUFFIX = '.sparse'
+MAGIC = b'HBS\x01'
+
+# Smaller files are never treated as sparse
+MIN_SIZE = 1 * MB
+# Holes smaller than this are read like data, to keep the map short
+MIN_HOLE = 64 * 1024
+# Files with less than this in holes are stored as regular files
+MIN_HOLE_BYTES = 1 * MB
+
+_header = struct.Struct('>QI')
+_extent = struct.Struct('>QQ')
+_ZEROS = bytes(MB)
+
+
+def find_extents(f, size):
+    """Find the data extents of a sparse file
+
+    :param f: file object opened for reading, left at position 0
+    :param int size: size of the file
+    :return: list of (offset, length) of the data, or None if the file is
+        not sparse enough to be worth it, or holes are not supported
+    :rtype: list[tuple[int,int]]
+    """
+    if size < MIN_SIZE or not hasattr(os, 'SEEK_DATA'):
+        return None
+    fd = f.fileno()
+    # Fully allocated files have no holes, skip the lseek calls
+    if os.fstat(fd).st_blocks * 512 >= size:
+        return None
+
+    extents = []
+    pos = 0
+    try:
+        while pos < size:
+            try:
+                start = os.lseek(fd, pos, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    # Only a hole from here to the end
+                    break
+                raise
+            if start >= size:
+                break
+            end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+            if extents and start - sum(extents[-1]) < MIN_HOLE:
+                offset, _ = extents[-1]
+                extents[-1] = (offset, end - offset)
+            else:
+                extents.append((start, end - start))
+            pos = end
+    except OSError:
+        # Filesystem without SEEK_DATA support
+        return None
+    finally:
+        f.seek(0)
+
+    if size - sum(length for _, length in extents) < MIN_HOLE_BYTES:
+        return None
+    return extents
+
+
+def _zeros(n):
+    """Yield n zero bytes in blocks"""
+    while n > 0:
+        block = min(n, len(_ZEROS))
+        yield memoryview(_ZEROS)[:block]
+        n -= block
+
+
+def iter_logical(f, size, extents, *, bufsize=1*MB):
+    """Yield the contents of a sparse file, without reading the holes
+
+    :param f: seekable file object
+    :param int size: size of the file
+    :param list extents: result of find_extents()
+    """
+    pos = 0
+    for offset, length in extents:
+        yield from _zeros(offset - pos)
+        f.seek(offset)
+        yield from _read_extent(f, length, bufsize)
+        pos = offset + length
+    yield from _zeros(size - pos)
+
+
+def _read_extent(f, length, bufsize):
+    while length:
+        buf = f.read(min(length, bufsize))
+        if not buf:
+            raise IOError('File shrank while reading')
+        yield buf
+        length -= len(buf)
+
+
+def hash_extents(f, size, extents):
+    """md5 of the logical contents of a sparse file
+
+    :rtype: str
+    """
+    h = hashlib.md5()
+    for buf in iter_logical(f, size, extents):
+        h.update(buf)
+    return h.hexdigest()
+
+
+def encode_map(size, extents):
+    """
+    :return: the start of a sparse object, before the extent data
+    :rtype: bytes
+    """
+    return MAGIC + _header.pack(size, len(extents)) + b''.join(
+        _extent.pack(offset, length) for offset, length in extents)
+
+
+def iter_sparse_object(f, size, extents, h=None, *, bufsize=1*MB):
+    """Yield the stored form of a sparse file
+
+    :param h: md5 object that is updated with the logical contents
+    """
+    yield encode_map(size, extents)
+    pos = 0
+    for offset, length in extents:
+        if h is not None:
+            for zeros in _zeros(offset - pos):
+                h.update(zeros)
+        f.seek(offset)
+        for buf in _read_extent(f, length, bufsize):
+            if h is not None:
+                h.update(buf)
+            yield buf
+        pos = offset + length
+    if h is not None:
+        for zeros in _zeros(size - pos):
+            h.update(zeros)
+
+
+def stored_size(extents):
+    """Size of the stored form of a sparse file"""
+    return (len(MAGIC) + _header.size + len(extents) * _extent.size +
+            sum(length for _, length in extents))
+
+
+def copy_sparse_and_hash(src, dst, size, extents):
+    """Write the stored form of a sparse file, like copy_and_hash_fo()
+
+    :return: md5 of the logical contents
+    :rtype: str
+    """
+    h = hashlib.md5()
+    for buf in iter_sparse_object(src, size, extents, h):
+        dst.write(buf)
+    return h.hexdigest()
+
+
+def read_map(f):
+    """Read the start of a sparse object
+
+    :return: tuple of (size, extents), f is at the start of the data
+    :raises ValueError: if this is not a sparse object
+    """
+    head = f.read(len(MAGIC) + _header.size)
+    if len(head) != len(MAGIC) + _header.size or \
+            not head.startswith(MAGIC):
+        raise ValueError('Not a sparse object')
+    size, count = _header.unpack_from(head, len(MAGIC))
+    data = f.read(count * _extent.size)
+    if len(data) != count * _extent.size:
+        raise ValueError('Truncated sparse object')
+    return size, [_extent.unpack_from(data, i * _extent.size)
+                  for i in range(count)]
+
+
+class SparseReader:
+    """Readable file wrapper that gives the logical contents of a sparse
+    object"""
+
+    def __init__(self, f):
+        self.file = f
+        self.size, self.extents = read_map(f)
+        self._chunks = self._iter_chunks()
+        self.pending = b''
+
+    def _iter_chunks(self):
+        pos = 0
+        for offset, length in self.extents:
+            yield from _zeros(offset - pos)
+            # The data of the extents follows the map without gaps
+            yield from _read_extent(self.file, length, MB)
+            pos = offset + length
+        yield from _zeros(self.size - pos)
+
+    def read(self, size=-1):
+        parts = [self.pending]
+        n = len(self.pending)
+        while size < 0 or n < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            parts.append(bytes(chunk))
+            n += len(chunk)
+        data = b''.join(parts)
+        if size < 0:
+            size = len(data)
+        data, self.pending = data[:size], data[size:]
+        return data
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def restore_sparse(f, dst):
+    """Write a sparse object to a file, leaving the holes unallocated
+
+    :param f: sparse object opened for reading
+    :param dst: regular file opened for writing
+    """
+    size, extents = read_map(f)
+    for offset, length in extents:
+        dst.seek(offset)
+        for buf in _read_extent(f, length, MB):
+            dst.write(buf)
+    dst.truncate(size)
+
+
+class SparseHasher:
+    """md5 of the logical contents, fed with the stored form of a sparse
+    object"""
+
+    def __init__(self):
+        self.hash = hashlib.md5()
+        self.buf = b''
+        self.size = None
+        self.extents = None
+        # Index of the current extent, and bytes of it still to come
+        self.index = 0
+        self.remaining = 0
+        self.pos = 0
+
+    def _parse_map(self):
+        start = len(MAGIC) + _header.size
+        if len(self.buf) < start:
+            return False
+        if not self.buf.startswith(MAGIC):
+            raise ValueError('Not a sparse object')
+        size, count = _header.unpack_from(self.buf, len(MAGIC))
+        end = start + count * _extent.size
+        if len(self.buf) < end:
+            return False
+        self.size = size
+        self.extents = [
+            _extent.unpack_from(self.buf, start + i * _extent.size)
+            for i in range(count)]
+        data, self.buf = self.buf[end:], b''
+        self._data(data)
+        return True
+
+    def _data(self, data):
+        data = memoryview(data)
+        while data:
+            if not self.remaining:
+                if self.index >= len(self.extents):
+                    raise ValueError('Sparse object has extra data')
+                offset, self.remaining = self.extents[self.index]
+                self.index += 1
+                if offset < self.pos:
+                    raise ValueError('Sparse object has overlapping extents')
+                for zeros in _zeros(offset - self.pos):
+                    self.hash.update(zeros)
+                self.pos = offset
+            part = data[:self.remaining]
+            self.hash.update(part)
+            self.remaining -= len(part)
+            self.pos += len(part)
+            data = data[len(part):]
+
+    def update(self, data):
+        if self.extents is None:
+            self.buf += data
+            self._parse_map()
+        else:
+            self._data(data)
+
+    def hexdigest(self):
+        if self.extents is None or self.remaining or \
+                self.index < len(self.extents):
+            raise ValueError('Truncated sparse object')
+        if self.pos > self.size:
+            raise ValueError('Sparse object extents beyond its size')
+        for zeros in _zeros(self.size - self.pos):
+            self.hash.update(zeros)
+        self.pos = self.size
+        return self.hash.hexdigest()
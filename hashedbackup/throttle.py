@@ -0,0 +1,259 @@
+"""Limits on the resources a backup takes from the host
+
+`backup --max-read-rate` limits how fast source files are read, for hashing
+and for copying, and `--max-upload-rate` how fast object data is written to
+the repository. Both are token buckets shared by all threads:
+
+    read_limit.consume(len(buf))
+
+blocks until the data fits in the rate. Source files opened with
+sourceio.open_source() and writers wrapped with ThrottledWriter do this
+themselves.
+
+The limits can be changed while a backup runs with a control file
+(`--limits-file`) like this:
+
+    max_read_rate = 20M
+    max_upload_rate = off
+
+It is read again when it changes, checked every CONTROL_INTERVAL seconds,
+or right away on SIGHUP. Keys that are not in the file, or a missing file,
+give the limits from the command line.
+
+`--idle` makes the backup only use disk and CPU time that nothing else
+wants, see set_idle_priority().
+"""
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+from hashedbackup.utils import MB, parse_rate
+
+log = logging.getLogger(__name__)
+
+# Seconds between checks of the control file for changes
+CONTROL_INTERVAL = 5
+CONTROL_KEYS = ('max_read_rate', 'max_upload_rate')
+
+# ioprio_set() syscall numbers, Python has no wrapper
+_IOPRIO_SET = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30,
+               'armv7l': 314, 'ppc64le': 273, 's390x': 282}
+_IOPRIO_WHO_PROCESS = 1
+_IOPRIO_CLASS_IDLE = 3
+_IOPRIO_CLASS_SHIFT = 13
+
+
+class TokenBucket:
+    """Rate limit shared by threads
+
+    Consumers may take more than is available, they then sleep until the
+    debt is paid, so the average rate holds for any size of request.
+    """
+
+    def __init__(self, rate=None):
+        """
+        :param int rate: bytes per second, None for no limit
+        """
+        self._lock = threading.Lock()
+        self.rate = None
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        with self._lock:
+            if rate != self.rate:
+                self.rate = rate
+                self.burst = max(rate // 4, MB) if rate else 0
+                self.tokens = self.burst
+                self.last = time.monotonic()
+
+    def consume(self, n):
+        """Wait until n bytes fit in the rate"""
+        if not self.rate:
+            return
+        with self._lock:
+            if not self.rate:
+                return
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= n
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+read_limit = TokenBucket()
+upload_limit = TokenBucket()
+
+
+class ThrottledWriter:
+    """Wraps a writable file object to limit the rate of its writes"""
+
+    def __init__(self, f, bucket=upload_limit):
+        self.file = f
+        self.bucket = bucket
+
+    def write(self, data):
+        self.bucket.consume(len(data))
+        return self.file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+
+def throttled(chunks, bucket=upload_limit):
+    """Yield chunks of data at the rate of the bucket"""
+    for chunk in chunks:
+        bucket.consume(len(chunk))
+        yield chunk
+
+
+def parse_control_file(path):
+    """
+    :return: dict of the CONTROL_KEYS in the file, with bytes per second
+        or None as values
+    :raises ValueError: if the file has errors
+    """
+    limits = {}
+    with open(path) as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            key, sep, value = line.partition('=')
+            key = key.strip().replace('-', '_')
+            if not sep or key not in CONTROL_KEYS:
+                raise ValueError('{}:{}: expected one of {} = rate'.format(
+                    path, lineno, ', '.join(CONTROL_KEYS)))
+            try:
+                limits[key] = parse_rate(value)
+            except ValueError:
+                raise ValueError('{}:{}: invalid rate {!r}'.format(
+                    path, lineno, value.strip()))
+    return limits
+
+
+class LimitsControl:
+    """Applies the limits from the options and the control file"""
+
+    def __init__(self, options):
+        self.defaults = {key: getattr(options, key, None)
+                         for key in CONTROL_KEYS}
+        self.path = getattr(options, 'limits_file', None)
+        self.mtime = None
+        self.stopping = False
+        # Set to check the file right away
+        self._wakeup = threading.Event()
+        self._thread = None
+        self.apply(self.defaults)
+
+    def apply(self, limits):
+        read_limit.set_rate(limits['max_read_rate'])
+        upload_limit.set_rate(limits['max_upload_rate'])
+
+    def reload(self):
+        """Read the control file and apply its limits"""
+        limits = dict(self.defaults)
+        try:
+            self.mtime = os.stat(self.path).st_mtime_ns
+            limits.update(parse_control_file(self.path))
+        except FileNotFoundError:
+            self.mtime = None
+        except (OSError, ValueError) as e:
+            # Keep the current limits until the file is fixed
+            log.warn('Ignoring limits file: %s', e)
+            return
+        if limits != self._current():
+            log.info('Rate limits: read %s, upload %s',
+                     _format_rate(limits['max_read_rate']),
+                     _format_rate(limits['max_upload_rate']))
+        self.apply(limits)
+
+    def _current(self):
+        return dict(max_read_rate=read_limit.rate,
+                    max_upload_rate=upload_limit.rate)
+
+    def _watch(self):
+        while True:
+            forced = self._wakeup.wait(CONTROL_INTERVAL)
+            self._wakeup.clear()
+            if self.stopping:
+                return
+            if forced:
+                self.reload()
+                continue
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+            except OSError:
+                mtime = None
+            if mtime != self.mtime:
+                self.reload()
+
+    def start(self):
+        """Start following the control file, if there is one"""
+        if not self.path:
+            return
+        self.reload()
+        self._thread = threading.Thread(
+            target=self._watch, name='LimitsControl', daemon=True)
+        self._thread.start()
+        if threading.current_thread() is threading.main_thread() and \
+                hasattr(signal, 'SIGHUP'):
+            # Reloading in the handler could deadlock on a bucket lock that
+            # the main thread holds, leave it to the watcher thread
+            signal.signal(signal.SIGHUP,
+                          lambda signum, frame: self._wakeup.set())
+
+    def stop(self):
+        if self._thread is not None:
+            self.stopping = True
+            self._wakeup.set()
+            self._thread.join()
+            if threading.current_thread() is threading.main_thread() and \
+                    hasattr(signal, 'SIGHUP'):
+                signal.signal(signal.SIGHUP, signal.SIG_DFL)
+        self.apply(dict.fromkeys(CONTROL_KEYS))
+
+
+def _format_rate(rate):
+    if not rate:
+        return 'unlimited'
+    return '{:.1f} MB/s'.format(rate / MB)
+
+
+def _ioprio_set_idle():
+    import ctypes
+    import ctypes.util
+    nr = _IOPRIO_SET.get(os.uname().machine)
+    if nr is None:
+        return False
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    return libc.syscall(nr, _IOPRIO_WHO_PROCESS, 0,
+                        _IOPRIO_CLASS_IDLE << _IOPRIO_CLASS_SHIFT) == 0
+
+
+def set_idle_priority():
+    """Lowest CPU and I/O priority for the calling thread
+
+    On Linux these are per thread and inherited by threads started later,
+    so call this before the worker threads are started.
+    """
+    done = []
+    try:
+        os.nice(19 - os.nice(0))
+        done.append('nice')
+    except OSError:
+        pass
+    if hasattr(os, 'SCHED_IDLE'):
+        try:
+            os.sched_setscheduler(0, os.SCHED_IDLE, os.sched_param(0))
+            done.append('SCHED_IDLE')
+        except OSError:
+            pass
+    if sys.platform.startswith('linux') and _ioprio_set_idle():
+        done.append('idle I/O class')
+    log.verbose('Idle priority: %s', ', '.join(done) or 'not supported')
@@ -0,0 +1,150 @@
+"""Timing traces of backup runs in the Chrome trace event format
+
+`backup --trace FILE` records a span for every stage of every file, per
+thread. Open the file in chrome://tracing or https://ui.perfetto.dev to see
+where the time goes.
+
+Code that is traced does:
+
+    with self.tracer.span('filehash', path=relpath):
+        ...
+
+When tracing is disabled, the tracer is NULL_TRACER, whose spans do
+nothing, so the instrumentation can stay in the hot paths.
+"""
+import json
+import os
+import threading
+import time
+
+
+class Tracer:
+    """Collects trace events in memory until save()
+
+    Safe to use from multiple threads.
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self.events = []
+        self.pid = os.getpid()
+        self._t0 = time.perf_counter()
+        self._threads = set()
+
+    def _ts(self, t):
+        # Trace timestamps are in microseconds
+        return round((t - self._t0) * 1e6, 3)
+
+    def _tid(self):
+        tid = threading.get_ident()
+        if tid not in self._threads:
+            self._threads.add(tid)
+            self.events.append(dict(
+                ph='M', name='thread_name', pid=self.pid, tid=tid,
+                args=dict(name=threading.current_thread().name)))
+        return tid
+
+    def span(self, name, **args):
+        """Time a block of code that runs on the current thread
+
+        :param str name: name of the stage
+        :param args: shown with the span, like the path of the file
+        :return: context manager
+        """
+        return _Span(self, name, args)
+
+    def async_span(self, name, span_id, **args):
+        """Time an operation that other work on the same thread overlaps
+        with, like an upload awaited by an asyncio task
+
+        :param str name: name of the stage
+        :param span_id: unique among concurrent spans with the same name
+        :return: context manager
+        """
+        return _AsyncSpan(self, name, span_id, args)
+
+    def add_complete(self, name, start, end, args):
+        self.events.append(dict(
+            ph='X', name=name, pid=self.pid, tid=self._tid(),
+            ts=self._ts(start), dur=self._ts(end) - self._ts(start),
+            args=args))
+
+    def add_async(self, phase, name, span_id, t, args=None):
+        event = dict(ph=phase, cat='async', name=name, id=str(span_id),
+                     pid=self.pid, tid=self._tid(), ts=self._ts(t))
+        if args:
+            event['args'] = args
+        self.events.append(event)
+
+    def save(self, path):
+        """Write all events as a JSON trace file"""
+        with open(path, 'w') as f:
+            json.dump(dict(traceEvents=self.events, displayTimeUnit='ms'), f)
+
+
+class _Span:
+    __slots__ = ('tracer', 'name', 'args', 'start')
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.add_complete(self.name, self.start, time.perf_counter(),
+                                 self.args)
+        return False
+
+
+class _AsyncSpan:
+    __slots__ = ('tracer', 'name', 'span_id', 'args')
+
+    def __init__(self, tracer, name, span_id, args):
+        self.tracer = tracer
+        self.name = name
+        self.span_id = span_id
+        self.args = args
+
+    def __enter__(self):
+        self.tracer.add_async('b', self.name, self.span_id,
+                              time.perf_counter(), self.args)
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.add_async('e', self.name, self.span_id,
+                              time.perf_counter())
+        return False
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class NullTracer:
+    """Tracer that records nothing"""
+
+    enabled = False
+
+    def span(self, name, **args):
+        return _NULL_SPAN
+
+    def async_span(self, name, span_id, **args):
+        return _NULL_SPAN
+
+    def save(self, path):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+NULL_TRACER = NullTracer()
@@ -121,6 +121,41 @@ def parse_age(s):
         raise ValueError("Invalid age unit: {}".format(unit))
 
 
+RATE_UNITS = {'': 1, 'k': 1024, 'm': MB, 'g': 1024 * MB}
+
+
+def parse_rate(s):
+    """
+    :param str s: bytes per second, like "500k", "20M" or "1G". "0" or
+        "off" means no limit.
+    :return: bytes per second, or None for no limit
+    :rtype: int
+    :raises ValueError: if wrong format
+    """
+    s = s.strip().lower()
+    if s in ('', '0', 'off', 'none'):
+        return None
+    unit = s[-1] if s[-1] in RATE_UNITS else ''
+    num = float(s[:len(s) - len(unit)])
+    if num <= 0:
+        return None
+    return int(num * RATE_UNITS[unit])
+
+
+def parse_size(s):
+    """
+    :param str s: size in bytes, like "64M" or "1G"
+    :rtype: int
+    :raises ValueError: if wrong format
+    """
+    s = s.strip().lower()
+    unit = s[-1] if s and s[-1] in RATE_UNITS else ''
+    num = float(s[:len(s) - len(unit)])
+    if num <= 0:
+        raise ValueError('size must be positive: {}'.format(s))
+    return int(num * RATE_UNITS[unit])
+
+
 def object_bucket_dirs():
     """
     :return: iterable of '00'...'ff'
@@ -13,7 +13,7 @@ setup(
     license="MIT",
     keywords="backup hash photo",
     url="http://packages.python.org/hashedbackup",
-    packages=['hashedbackup'],
+    packages=['hashedbackup', 'hashedbackup.backends'],
     #long_description=read('README'),
     classifiers=[
         "Development Status :: 3 - Alpha",
@@ -28,5 +28,11 @@ setup(
     ],
     entry_points={
         'console_scripts': ['hashedbackup=hashedbackup.cli:main'],
+        'hashedbackup.backends': [
+            'file = hashedbackup.backends.local:LocalBackend',
+            'sftp = hashedbackup.backends.sftp:SFTPBackend',
+            'http = hashedbackup.backends.http:HTTPBackend',
+            'https = hashedbackup.backends.http:HTTPBackend',
+        ],
     }
 )
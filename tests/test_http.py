@@ -0,0 +1,267 @@
+"""Tests for the HTTP backend against backends/httpserver.py
+
+Every test starts the server on an ephemeral port with its own directory.
+"""
+import argparse
+import hashlib
+import importlib
+import os
+import threading
+import time
+
+import pytest
+
+from hashedbackup import backends, cli
+from hashedbackup.backends import httpserver
+from hashedbackup.backends.http import HTTPBackend, HTTPError
+from hashedbackup.cmd_list_manifests import list_remote_manifests
+from hashedbackup.compression import COMPRESSED_SUFFIX
+from hashedbackup.manifests import ManifestReader, manifest_dir
+
+
+class NoRangeHandler(httpserver.RequestHandler):
+    """Handler of a server that does not support Range requests"""
+
+    def _suffix_range(self):
+        return None
+
+
+class LostMoveResponseHandler(httpserver.RequestHandler):
+    """Handler that performs a MOVE but drops the connection instead of
+    replying
+    """
+
+    def _reply(self, status, body=b'', headers=None):
+        if self.command == 'MOVE':
+            self.close_connection = True
+            return
+        super()._reply(status, body, headers)
+
+
+def start_server(root, handler=None):
+    server = httpserver.Server(root, ('127.0.0.1', 0))
+    if handler is not None:
+        server.RequestHandlerClass = handler
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+@pytest.fixture
+def server(tmp_path):
+    root = tmp_path / 'srv'
+    root.mkdir()
+    server = start_server(str(root))
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def url(server):
+    return 'http://127.0.0.1:{}/repo'.format(server.server_address[1])
+
+
+@pytest.fixture
+def backend(url):
+    backend = HTTPBackend(url, argparse.Namespace(compress=False))
+    yield backend
+    backend.close()
+
+
+def run(*args):
+    """Run a command like the command line would, in a new process"""
+    backends._backend_cache.clear()
+    options = cli.parser.parse_args(list(args))
+    module_name, func_name = cli.COMMANDS[options.command].split(':')
+    getattr(importlib.import_module(module_name), func_name)(options)
+
+
+def md5(data):
+    return hashlib.md5(data).hexdigest()
+
+
+def make_files(src):
+    """Create a source tree with random and compressible files
+
+    :return: dict of relative path to contents
+    """
+    files = {
+        'random-{}'.format(i): os.urandom(20000) for i in range(8)
+    }
+    files['sub/text'] = b'hello world\n' * 10000
+    files['sub/empty'] = b''
+    for path, data in files.items():
+        fs_path = os.path.join(src, path)
+        os.makedirs(os.path.dirname(fs_path), exist_ok=True)
+        with open(fs_path, 'wb') as f:
+            f.write(data)
+    return files
+
+
+def read_latest_manifest(backend, namespace):
+    latest = list_remote_manifests(backend, namespace)[namespace][-1]
+    path = os.path.join(manifest_dir(backend, namespace),
+                        latest['filename'])
+    with ManifestReader(backend, path) as reader:
+        return {record['path']: record for record in reader
+                if record.get('type') == 'f'}
+
+
+def test_init(server, url):
+    run('init', url)
+    repo = os.path.join(server.root, 'repo')
+    for name in ('objects', 'tmp', 'index', 'manifests'):
+        assert os.path.isdir(os.path.join(repo, name))
+    assert os.path.isdir(os.path.join(repo, 'objects', 'ff'))
+    assert os.path.isfile(os.path.join(repo, 'hashedbackup.json'))
+
+
+@pytest.mark.parametrize('extra_args', [
+    [],
+    ['-j', '4'],
+    ['--compress'],
+    ['-j', '4', '--compress'],
+])
+def test_backup(tmp_path, url, backend, extra_args):
+    src = str(tmp_path / 'src')
+    files = make_files(src)
+    run('init', url)
+    run('backup', '-n', 'test', *extra_args, src, url)
+
+    records = read_latest_manifest(backend, 'test')
+    assert sorted(records) == sorted(files)
+    for path, data in files.items():
+        assert records[path]['hash'] == md5(data)
+        with backend.open_object(md5(data)) as f:
+            assert f.read() == data
+
+    text_path = backend.object_path(md5(files['sub/text']))
+    compressed = backend.exists(text_path + COMPRESSED_SUFFIX)
+    assert compressed == ('--compress' in extra_args)
+    assert backend.exists(text_path) != compressed
+    formats = backend.read_repo_config().get('object_formats', [])
+    assert formats == (['zlib'] if compressed else [])
+
+
+def test_backup_unchanged(tmp_path, url, backend):
+    src = str(tmp_path / 'src')
+    make_files(src)
+    run('init', url)
+    run('backup', '-n', 'first', '-j', '4', src, url)
+    objects = sorted(backend.scan_object_hashes())
+    # Another namespace, because manifest names only have seconds
+    run('backup', '-n', 'second', '-j', '4', '--rescan-objects', src, url)
+    assert sorted(backend.scan_object_hashes()) == objects
+    assert read_latest_manifest(backend, 'second') == \
+        read_latest_manifest(backend, 'first')
+
+
+def write_file(backend, path, data):
+    with backend.open(path, 'wb') as f:
+        f.write(data)
+
+
+def read_file(backend, path):
+    with backend.open(path, 'rb') as f:
+        return f.read()
+
+
+def test_read_tail(backend):
+    data = os.urandom(100000)
+    backend.try_mkdir(backend.path)
+    path = os.path.join(backend.path, 'file')
+    write_file(backend, path, data)
+    assert backend.read_tail(path, 4096) == data[-4096:]
+    assert backend.read_tail(path, 200000) == data
+    with pytest.raises(FileNotFoundError):
+        backend.read_tail(os.path.join(backend.path, 'missing'), 4096)
+
+
+def test_read_tail_without_range(tmp_path):
+    root = tmp_path / 'srv'
+    root.mkdir()
+    server = start_server(str(root), NoRangeHandler)
+    try:
+        url = 'http://127.0.0.1:{}/repo'.format(server.server_address[1])
+        backend = HTTPBackend(url, argparse.Namespace())
+        data = os.urandom(3 * 1024 * 1024 + 123)
+        backend.try_mkdir(backend.path)
+        path = os.path.join(backend.path, 'file')
+        write_file(backend, path, data)
+        assert backend.read_tail(path, 4096) == data[-4096:]
+        assert backend.read_tail(path, len(data) + 1) == data
+        # The connection is usable again after reading the whole body
+        assert backend.read_tail(path, 10) == data[-10:]
+        backend.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_move(backend):
+    backend.try_mkdir(backend.path)
+    src = os.path.join(backend.path, 'src')
+    dst = os.path.join(backend.path, 'dst')
+
+    write_file(backend, src, b'first')
+    backend.rename(src, dst)
+    assert not backend.exists(src)
+    assert read_file(backend, dst) == b'first'
+
+    # rename() does not overwrite
+    write_file(backend, src, b'second')
+    with pytest.raises(FileExistsError):
+        backend.rename(src, dst)
+    assert read_file(backend, src) == b'second'
+    assert read_file(backend, dst) == b'first'
+
+    # replace() does
+    backend.replace(src, dst)
+    assert not backend.exists(src)
+    assert read_file(backend, dst) == b'second'
+
+    with pytest.raises(FileNotFoundError):
+        backend.rename(src, dst)
+    with pytest.raises(HTTPError) as excinfo:
+        write_file(backend, src, b'third')
+        backend.rename(src, os.path.join(backend.path, 'missing', 'dst'))
+    assert excinfo.value.status == 409
+
+
+def test_move_response_lost(tmp_path):
+    root = tmp_path / 'srv'
+    root.mkdir()
+    server = start_server(str(root), LostMoveResponseHandler)
+    try:
+        url = 'http://127.0.0.1:{}/repo'.format(server.server_address[1])
+        backend = HTTPBackend(url, argparse.Namespace())
+        backend.try_mkdir(backend.path)
+        src = os.path.join(backend.path, 'src')
+        dst = os.path.join(backend.path, 'dst')
+        write_file(backend, src, b'data')
+        backend.rename(src, dst)
+        assert not backend.exists(src)
+        assert read_file(backend, dst) == b'data'
+        backend.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.mark.parametrize('mode', ['wb', 'w'])
+def test_failed_upload(server, backend, mode):
+    backend.try_mkdir(backend.path)
+    path = os.path.join(backend.path, 'file')
+    with pytest.raises(RuntimeError):
+        with backend.open(path, mode) as f:
+            f.write(b'partial' if 'b' in mode else 'partial')
+            raise RuntimeError('source read failed')
+    assert not backend.exists(path)
+    # The server removes its temp file once it sees the connection drop
+    repo = os.path.join(server.root, 'repo')
+    for _ in range(100):
+        if not os.listdir(repo):
+            break
+        time.sleep(0.01)
+    assert os.listdir(repo) == []
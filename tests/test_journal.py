@@ -0,0 +1,123 @@
+"""Tests for backups with the dirty journal of `hashedbackup watch`
+
+The tests hold the watcher lock and append to the journal themselves, like
+the watcher would for the changes they make.
+"""
+import argparse
+import hashlib
+import importlib
+import logging
+import os
+import time
+
+import pytest
+
+from hashedbackup import backends, cli, journal
+from hashedbackup.backends.local import LocalBackend
+from hashedbackup.cmd_list_manifests import list_remote_manifests
+from hashedbackup.manifests import ManifestReader, manifest_dir
+
+
+def run(*args):
+    """Run a command like the command line would, in a new process"""
+    backends._backend_cache.clear()
+    options = cli.parser.parse_args(list(args))
+    module_name, func_name = cli.COMMANDS[options.command].split(':')
+    getattr(importlib.import_module(module_name), func_name)(options)
+
+
+def write(src, name, data):
+    with open(os.path.join(src, name), 'wb') as f:
+        f.write(data)
+
+
+def latest_manifest(repo, namespace):
+    """
+    :return: tuple of (header, dict of path to hash)
+    """
+    backend = LocalBackend(repo, argparse.Namespace())
+    latest = list_remote_manifests(backend, namespace)[namespace][-1]
+    path = os.path.join(manifest_dir(backend, namespace),
+                        latest['filename'])
+    with ManifestReader(backend, path) as reader:
+        return reader.header, {record['path']: record['hash']
+                               for record in reader
+                               if record.get('type') == 'f'}
+
+
+@pytest.fixture
+def watched(tmp_path, monkeypatch):
+    monkeypatch.setattr(journal, 'JOURNAL_DIR', str(tmp_path / 'journals'))
+    src = str(tmp_path / 'src')
+    os.mkdir(src)
+    dirty = journal.DirtyJournal(src)
+    dirty.acquire_watcher_lock()
+    dirty.reset(started=time.time())
+    yield src, dirty
+    dirty.release_watcher_lock()
+
+
+def test_namespaces_read_their_own_changes(tmp_path, watched, caplog):
+    src, dirty = watched
+    caplog.set_level(logging.INFO, logger='hashedbackup.cmd_backup')
+    repo = str(tmp_path / 'repo')
+    run('init', repo)
+    write(src, 'a', b'a1')
+    write(src, 'b', b'b1')
+    dirty.append(['a', 'b'])
+
+    def backup(namespace):
+        caplog.clear()
+        run('backup', '--journal', '-n', namespace, src, repo)
+        return latest_manifest(repo, namespace)
+
+    def changed_paths():
+        for message in caplog.messages:
+            if message.startswith('Dirty journal:'):
+                return int(message.split()[2])
+
+    # Full walks, which record the journal position in the header
+    for namespace in ('daily', 'weekly'):
+        header, _ = backup(namespace)
+        assert header['journal']['id'] == dirty.read()[0]['id']
+
+    # Manifest names only have seconds
+    time.sleep(1)
+    write(src, 'a', b'a2 changed')
+    dirty.append(['a'])
+    _, hashes = backup('daily')
+    assert changed_paths() == 1
+    assert hashes['a'] == hashlib.md5(b'a2 changed').hexdigest()
+
+    time.sleep(1)
+    write(src, 'b', b'b2 changed')
+    dirty.append(['b'])
+    # The daily backup read the change of a before, weekly still has to
+    _, hashes = backup('weekly')
+    assert changed_paths() == 2
+    assert hashes == {
+        'a': hashlib.md5(b'a2 changed').hexdigest(),
+        'b': hashlib.md5(b'b2 changed').hexdigest(),
+    }
+
+    time.sleep(1)
+    _, hashes = backup('daily')
+    assert changed_paths() == 1
+    assert hashes['b'] == hashlib.md5(b'b2 changed').hexdigest()
+
+
+def test_reset_journal(tmp_path, watched):
+    src, dirty = watched
+    repo = str(tmp_path / 'repo')
+    run('init', repo)
+    write(src, 'a', b'a1')
+    run('backup', '--journal', '-n', 'test', src, repo)
+
+    # Changes between the journals are lost, so this must be a full walk
+    write(src, 'a', b'a2 changed')
+    dirty.reset(started=time.time())
+    time.sleep(1)
+    run('backup', '--journal', '-n', 'test', src, repo)
+    header, hashes = latest_manifest(repo, 'test')
+    assert hashes['a'] == hashlib.md5(b'a2 changed').hexdigest()
+    assert header['journal'] == dirty.read()[0]
@@ -0,0 +1,68 @@
+"""Tests for the repository version and object formats in hashedbackup.json"""
+import argparse
+import importlib
+import json
+import os
+
+import pytest
+
+from hashedbackup import backends, cli
+from hashedbackup.backends.local import LocalBackend
+
+
+def run(*args):
+    """Run a command like the command line would, in a new process"""
+    backends._backend_cache.clear()
+    options = cli.parser.parse_args(list(args))
+    module_name, func_name = cli.COMMANDS[options.command].split(':')
+    getattr(importlib.import_module(module_name), func_name)(options)
+
+
+def read_config(repo):
+    with open(os.path.join(repo, 'hashedbackup.json')) as f:
+        return json.load(f)
+
+
+def write_config(repo, config):
+    with open(os.path.join(repo, 'hashedbackup.json'), 'w') as f:
+        json.dump(config, f)
+
+
+@pytest.fixture
+def repo(tmp_path):
+    repo = str(tmp_path / 'repo')
+    run('init', repo)
+    return repo
+
+
+@pytest.fixture
+def src(tmp_path):
+    src = str(tmp_path / 'src')
+    os.mkdir(src)
+    with open(os.path.join(src, 'text'), 'wb') as f:
+        f.write(b'hello world\n' * 10000)
+    return src
+
+
+def test_plain_objects_keep_version_1(repo, src):
+    run('backup', '-n', 'test', src, repo)
+    assert read_config(repo) == {'version': 1}
+
+
+@pytest.mark.parametrize('jobs', ['1', '4'])
+def test_compressed_objects_raise_version(repo, src, jobs):
+    run('backup', '-n', 'test', '--compress', '-j', jobs, src, repo)
+    assert read_config(repo) == {'version': 2, 'object_formats': ['zlib']}
+    LocalBackend(repo, argparse.Namespace()).check_destination_valid()
+
+
+@pytest.mark.parametrize('config', [
+    {'version': 3},
+    {'version': 2, 'object_formats': ['zlib', 'zstd']},
+])
+def test_refuse_unknown_repository(repo, config):
+    write_config(repo, config)
+    backend = LocalBackend(repo, argparse.Namespace())
+    with pytest.raises(Exception) as excinfo:
+        backend.check_destination_valid()
+    assert 'this version of hashedbackup' in str(excinfo.value)
@@ -0,0 +1,150 @@
+"""Tests for the SFTP backend against benchmarks/sftpserver.py
+
+The command line runs in a subprocess, like in the benchmarks, and the
+server counts the SFTP requests it gets. Limits on these counts catch
+changes that add round trips per file.
+"""
+import argparse
+import hashlib
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+from benchmarks.sftpserver import ROOT, SERVE_RUNNER, SFTPTestServer
+from hashedbackup.backends.local import LocalBackend
+from hashedbackup.cmd_list_manifests import list_remote_manifests
+from hashedbackup.manifests import ManifestReader, manifest_dir
+
+# Enough files that requests per file stand out from the fixed ones
+N_FILES = 50
+FILE_SIZE = 5000
+
+# Server setups, as keyword arguments for SFTPTestServer and extra
+# global options
+SETUPS = {
+    'helper': (dict(), []),
+    # Exec requests are refused
+    'denied': (dict(allow_exec=False), []),
+    # The helper command fails to start, like when hashedbackup is not
+    # installed on the server
+    'fallback': (dict(exec_handler=lambda command: None), []),
+    'no-remote-helper': (dict(), ['--no-remote-helper']),
+}
+
+
+def hashedbackup(server, *args):
+    subprocess.run(
+        [sys.executable, '-c', SERVE_RUNNER, '--no-progress',
+         '--ssh-config', server.ssh_config] + list(args),
+        cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        check=True)
+
+
+def backup(server, options, src, *args):
+    server.stats.reset()
+    hashedbackup(server, *options, 'backup', src, server.alias + ':repo',
+                 *args)
+    return server.stats.snapshot()
+
+
+def n_requests(stats):
+    return sum(n for name, n in stats.items()
+               if name not in ('connections', 'exec'))
+
+
+def make_files(src):
+    """
+    :return: dict of file name to md5 hash
+    """
+    os.mkdir(src)
+    hashes = {}
+    for i in range(N_FILES):
+        data = os.urandom(FILE_SIZE)
+        with open(os.path.join(src, 'file{:02}'.format(i)), 'wb') as f:
+            f.write(data)
+        hashes['file{:02}'.format(i)] = hashlib.md5(data).hexdigest()
+    return hashes
+
+
+def stored_objects(repo):
+    """
+    :return: set of the hashes of all objects, checked against their data
+    """
+    objects = set()
+    for dirpath, _, filenames in os.walk(os.path.join(repo, 'objects')):
+        for name in filenames:
+            with open(os.path.join(dirpath, name), 'rb') as f:
+                assert hashlib.md5(f.read()).hexdigest() == name
+            objects.add(name)
+    return objects
+
+
+def latest_manifest(repo, namespace):
+    backend = LocalBackend(repo, argparse.Namespace())
+    latest = list_remote_manifests(backend, namespace)[namespace][-1]
+    path = os.path.join(manifest_dir(backend, namespace),
+                        latest['filename'])
+    with ManifestReader(backend, path) as reader:
+        return {record['path']: record['hash'] for record in reader
+                if record.get('type') == 'f'}
+
+
+@pytest.fixture(params=sorted(SETUPS))
+def setup(request, tmp_path):
+    server_kwargs, options = SETUPS[request.param]
+    root = tmp_path / 'root'
+    root.mkdir()
+    with SFTPTestServer(str(root), **server_kwargs) as server:
+        hashedbackup(server, 'init', server.alias + ':repo')
+        yield request.param, server, options
+
+
+def test_backup(tmp_path, setup):
+    name, server, options = setup
+    src = str(tmp_path / 'src')
+    hashes = make_files(src)
+    repo = server.local_path('repo')
+
+    stats = backup(server, options, src, '-n', 'first', '-j', '4')
+    assert stored_objects(repo) == set(hashes.values())
+    assert latest_manifest(repo, 'first') == hashes
+    assert os.listdir(os.path.join(repo, 'tmp')) == []
+    # Without the helper, objects are checked and committed over SFTP
+    assert ('stat' in stats) == (name != 'helper')
+
+    # Objects that exist are not uploaded again
+    os.unlink(os.path.join(src, 'file00'))
+    with open(os.path.join(src, 'new'), 'wb') as f:
+        f.write(b'new file')
+    backup(server, options, src, '-n', 'second', '--rescan-objects')
+    del hashes['file00']
+    hashes['new'] = hashlib.md5(b'new file').hexdigest()
+    assert latest_manifest(repo, 'second') == hashes
+    assert len(stored_objects(repo)) == N_FILES + 1
+
+
+def test_request_counts(tmp_path, setup):
+    name, server, options = setup
+    src = str(tmp_path / 'src')
+    make_files(src)
+
+    stats = backup(server, options, src, '-n', 'test')
+    if name == 'helper':
+        # Objects go over the helper, SFTP is only used for the manifest
+        assert n_requests(stats) < N_FILES
+    else:
+        # For every file one stat to check if the object exists and one
+        # to confirm its size after the upload
+        assert stats.get('stat', 0) <= 2 * N_FILES
+        assert n_requests(stats) <= 9 * N_FILES
+
+    # The hashes of the previous manifest are trusted, so nothing is
+    # uploaded and no object is checked on its own. Manifest names only
+    # have seconds.
+    time.sleep(1)
+    stats = backup(server, options, src, '-n', 'test')
+    assert n_requests(stats) < N_FILES
+    assert stats.get('stat', 0) == 0